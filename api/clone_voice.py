@@ -1,15 +1,15 @@
 from flask import Blueprint, request, jsonify
-import tempfile
-import os
 from services.clone_voice_service import (
     create_clone_voice,
+    delete_clone_voice,
     get_voice_list,
     text_to_speech,
     get_audio_list,
     get_detail_audio
 )
 from middlewares.auth import require_auth
-from config import VOICE_OUTPUT_DIR
+from middlewares.admission import require_admission
+from utils.upload_spool import spool_audio_upload, discard_upload
 from services.key_service_wrapper import check_key_validity
 from database import db_manager
 
@@ -83,6 +83,7 @@ def list_voices_api():
 
 @clone_voice_bp.route("/create_clone_voice", methods=["POST"])
 @require_auth(module="clone_voice")
+@require_admission(module="clone_voice")
 def create_voice_api():
     data = request.form
     file = request.files.get("audio_file")
@@ -99,19 +100,19 @@ def create_voice_api():
     if not key or not device_id:
         return jsonify(success=False, message="❌ Thiếu key hoặc device_id"), 400
 
-    # ✅ Đảm bảo thư mục tồn tại
-    os.makedirs(VOICE_OUTPUT_DIR, exist_ok=True)
-
-    # ✅ Lưu file gốc vào VOICE_OUTPUT_DIR
-    filename = file.filename
-    audio_file_path = os.path.join(VOICE_OUTPUT_DIR, filename)
-    file.save(audio_file_path)
-
-    # ✅ Gọi tạo clone voice
-    result = create_clone_voice(voice_name, language, gender, age, audio_file_path, key, device_id)
+    # ✅ Ghi file lên tmpfs theo từng chunk (tên do server sinh), MP3 convert sang WAV trong lúc ghi
+    try:
+        upload = spool_audio_upload(file)
+    except ValueError as e:
+        return jsonify(success=False, message=str(e)), 400
 
-    # ❌ Nếu muốn xóa sau khi dùng → mở dòng này
-    os.remove(audio_file_path)
+    # ✅ Gọi tạo clone voice, luôn xóa file tạm sau khi dùng
+    try:
+        result = create_clone_voice(
+            voice_name, language, gender, age, upload.path, key, device_id, audio_sha256=upload.sha256
+        )
+    finally:
+        discard_upload(upload.path)
 
     if not result.get("success"):
         return jsonify(success=False, message=result.get("error", "❌ Tạo clone voice thất bại")), 400
@@ -123,7 +124,22 @@ def create_voice_api():
         "data": voice_data
     })
 
+@clone_voice_bp.route("/delete_voice", methods=["POST"])
+@require_auth(module="clone_voice")
+def delete_voice_api():
+    key = request.form.get("key", "").strip()
+    voice_id = request.form.get("voice_id", "").strip()
+    if not key or not voice_id:
+        return jsonify(success=False, message="❌ Thiếu key hoặc voice_id"), 400
+
+    result = delete_clone_voice(voice_id, key)
+    if not result.get("success"):
+        return jsonify(success=False, message=result.get("error", "❌ Xóa voice thất bại")), 400
+
+    return jsonify({"success": True, "message": "✅ Đã xóa voice", "data": result.get("data")})
+
 @clone_voice_bp.route("/text_to_voice", methods=["POST"])
+@require_admission(module="clone_voice")
 def text_to_voice_api():
     try:
         data = request.form
@@ -1,10 +1,20 @@
-from flask import Blueprint, request, jsonify, send_from_directory
+from flask import Blueprint, current_app, request, jsonify
 from services.image_service import (
-    create_image, use_image_key, get_key_status_key
+    create_image, create_image_variants, create_image_async, create_image_variants_async, use_image_key, get_key_status_key
 )
 from services.key_service_wrapper import check_key_validity
 from middlewares.auth import require_auth
+from middlewares.admission import require_admission
+from middlewares.idempotency import idempotent
 from database import db_manager
+from config import IMAGE_MAX_VARIANTS, IMAGE_OUTPUT_DIR
+from utils.image_transcoder import pick_image_variant, derivatives_pending
+from utils.media_store import resolve_media_path
+from utils.storage import get_storage
+from utils.async_upstream import run_upstream
+from services.media_gc_service import record_media_access
+from werkzeug.security import safe_join
+import json
 import os
 
 image_bp = Blueprint('image', __name__)
@@ -56,11 +66,39 @@ def auth_api():
 
 @image_bp.route("/play/<path:filename>")
 def serve_image_sample(filename):
-    return send_from_directory("images", filename)
+    storage = get_storage()
+    filename = resolve_media_path("image", filename)
+    image_path = safe_join(IMAGE_OUTPUT_DIR, filename)
+    if not image_path or not filename.lower().endswith(".png"):
+        response = storage.response("image", filename)
+        record_media_access("image", filename)
+        return response
+
+    def relative(path):
+        return os.path.relpath(path, IMAGE_OUTPUT_DIR).replace("\\", "/")
+
+    # Derivative có thể chỉ nằm trên storage remote (được tạo ở node khác)
+    exists = os.path.exists if storage.is_local else (
+        lambda path: os.path.exists(path) or storage.exists("image", relative(path))
+    )
+
+    # Chọn WebP/AVIF theo Accept và thumbnail theo ?w=, fallback PNG khi chưa transcode xong
+    width = request.args.get("w", type=int)
+    variant_path, mimetype = pick_image_variant(image_path, request.headers.get("Accept"), width, exists=exists)
+    response = storage.response("image", relative(variant_path), mimetype=mimetype)
+    response.vary.add("Accept")
+    if mimetype is None and derivatives_pending(image_path):
+        # PNG tạm thời khi WebP/AVIF chưa xong -> không cho cache lâu dài
+        response.cache_control.immutable = False
+        response.cache_control.max_age = 60
+    record_media_access("image", filename)
+    return response
 
 
 @image_bp.route("/create", methods=["POST"])
+@idempotent(module="image")
 @require_auth(module="image")
+@require_admission(module="image")
 def create_image_api():
     data = request.form
     text = data.get("text", "").strip()
@@ -73,10 +111,27 @@ def create_image_api():
     lighting = data.get("lighting", "").strip()
     detail_level = data.get("detail_level", "").strip()
 
+    # ratios: JSON list hoặc "9:16,1:1"; count: số ảnh cho mỗi ratio
+    raw_ratios = data.get("ratios", "").strip()
+    if raw_ratios.startswith("["):
+        try:
+            ratios = [str(r).strip() for r in json.loads(raw_ratios)]
+        except ValueError:
+            return jsonify(success=False, message="❌ ratios không hợp lệ"), 400
+    else:
+        ratios = [r.strip() for r in raw_ratios.split(",")] if raw_ratios else [ratio]
+    ratios = [r for r in ratios if r]
+    try:
+        count = int(data.get("count", "1") or 1)
+    except ValueError:
+        return jsonify(success=False, message="❌ count phải là số nguyên"), 400
+
     if not text:
         return jsonify(success=False, message="❌ Thiếu text"), 400 
-    if not ratio:
+    if not ratios:
         return jsonify(success=False, message="❌ Thiếu ratio"), 400
+    if count < 1 or count * len(ratios) > IMAGE_MAX_VARIANTS:
+        return jsonify(success=False, message=f"❌ Tối đa {IMAGE_MAX_VARIANTS} ảnh mỗi request"), 400
     if not key or not device_id:
         return jsonify(success=False, message="❌ Thiếu key hoặc device_id"), 400
 
@@ -94,7 +149,36 @@ def create_image_api():
     
 
 
-    result = create_image(full_prompt, key, device_id, ratio)
+    variants = [r for r in ratios for _ in range(count)]
+    host_url = request.host_url.rstrip("/")
+    # ASGI: gọi Gemini qua client httpx async trên loop dùng chung của worker
+    async_upstream = current_app.config.get("ASYNC_UPSTREAM")
+
+    if len(variants) > 1:
+        if async_upstream:
+            result = run_upstream(create_image_variants_async(full_prompt, key, device_id, variants))
+        else:
+            result = create_image_variants(full_prompt, key, device_id, variants)
+        if not result.get("success"):
+            return jsonify(success=False, message=result.get("message")), 400
+
+        images = result["images"]
+        for image in images:
+            filename = image.pop("filename", None)
+            if filename:
+                image["file_url"] = f"{host_url}/api/image/play/{filename}"
+
+        return jsonify({
+            "success": True,
+            "message": result.get("message"),
+            "file_url": next(image["file_url"] for image in images if image["success"]),
+            "images": images,
+        })
+
+    if async_upstream:
+        result = run_upstream(create_image_async(full_prompt, key, device_id, variants[0]))
+    else:
+        result = create_image(full_prompt, key, device_id, variants[0])
     if not result.get("success"):
         return jsonify(success=False, message=result.get("message")), 400
 
@@ -102,7 +186,6 @@ def create_image_api():
     message = result.get("message")
     success = result.get("success")
 
-    host_url = request.host_url.rstrip("/")
     file_url = f"{host_url}/api/image/play/{filename}"
 
     return jsonify({
@@ -114,6 +197,7 @@ def create_image_api():
 
 
 @image_bp.route("/use", methods=["POST"])
+@idempotent(module="image")
 @require_auth(module="image")
 def use_image_api():
     key = request.form.get("key", "")
@@ -1,6 +1,7 @@
 from flask import Blueprint, request, jsonify
 from services.music_service import create_music, get_task_status
 from middlewares.auth import require_auth
+from middlewares.admission import require_admission
 from services.key_service_wrapper import check_key_validity
 from database import db_manager
 
@@ -70,6 +71,7 @@ def auth_api():
 
 @music_bp.route("/create_music", methods=["POST"])
 @require_auth(module="music")
+@require_admission(module="music")
 def create_music_api():
     data = request.form
     # Extract form data with validations
@@ -1,10 +1,20 @@
-from flask import Blueprint, request, jsonify, send_from_directory
+import json
+from flask import Blueprint, Response, current_app, request, jsonify
 from services.voice_service import (
-    create_voice, use_voice_key, get_voice_list, get_key_status_key
+    create_voice, create_voice_async, stream_voice, create_voice_batch, use_voice_key, get_voice_list, get_key_status_key
 )
 from services.key_service_wrapper import check_key_validity
 from middlewares.auth import require_auth
+from middlewares.admission import require_admission
+from middlewares.idempotency import idempotent
 from database import db_manager
+from config import VOICE_BATCH_MAX_ITEMS, VOICE_OUTPUT_DIR
+from utils.media_store import resolve_media_path, open_growing_media, follow_growing_file
+from utils.storage import get_storage
+from utils.catalog import catalog_response, BASE_URL_PLACEHOLDER
+from services.media_gc_service import record_media_access
+from utils.audio_encoder import AUDIO_FORMATS, normalize_audio_format, normalize_bitrate
+from utils.async_upstream import run_upstream
 
 voice_bp = Blueprint('voice', __name__)
 
@@ -55,18 +65,39 @@ def auth_api():
 
 @voice_bp.route("/play/<path:filename>")
 def serve_voice_sample(filename):
-    return send_from_directory("voices", filename)
+    # File của /create_stream đang được tạo: gửi dần theo file staging (chunked) tới khi stream xong
+    growing = open_growing_media(VOICE_OUTPUT_DIR, filename)
+    if growing:
+        ext = filename.rsplit(".", 1)[-1]
+        mimetype = next((f["mimetype"] for f in AUDIO_FORMATS.values() if f["ext"] == ext), "application/octet-stream")
+        response = Response(follow_growing_file(*growing), mimetype=mimetype)
+        response.headers["Cache-Control"] = "no-store"
+        response.headers["X-Accel-Buffering"] = "no"
+        return response
+
+    # Tên public -> object trong store; URL cũ (<dir>/<file>, sample voice) serve như trước
+    rel_path = resolve_media_path("voice", filename)
+    response = get_storage().response("voice", rel_path)
+    record_media_access("voice", rel_path)  # chỉ ghi khi file tồn tại (404 đã raise ở trên)
+    return response
 
 
 @voice_bp.route("/list", methods=["GET"])
 def list_voices_api():
-    base_url = request.host_url.rstrip("/")
-    voices = get_voice_list(base_url=base_url)
-    return jsonify({"success": True, "voices": voices})
+    # sample_url phụ thuộc file sample có tồn tại -> build lại khi thư mục voices đổi;
+    # 1 bản cache cho mọi host, host của request được thay vào khi trả response
+    return catalog_response(
+        "voice_list",
+        lambda: {"success": True, "voices": get_voice_list(base_url=BASE_URL_PLACEHOLDER)},
+        sources=[VOICE_OUTPUT_DIR],
+        base_url=request.host_url.rstrip("/")
+    )
 
 
 @voice_bp.route("/create", methods=["POST"])
+@idempotent(module="voice")
 @require_auth(module="voice")
+@require_admission(module="voice")
 def create_voice_api():
     data = request.form
     text = data.get("text", "").strip()
@@ -79,7 +110,18 @@ def create_voice_api():
     if not key or not device_id:
         return jsonify(success=False, message="❌ Thiếu key hoặc device_id"), 400
 
-    success, message, file_name, duration  = create_voice(text, key, device_id, voice_code)
+    try:
+        audio_format = normalize_audio_format(data.get("format"))
+        bitrate = normalize_bitrate(data.get("bitrate"))
+    except ValueError as e:
+        return jsonify(success=False, message=str(e)), 400
+
+    if current_app.config.get("ASYNC_UPSTREAM"):
+        # ASGI: gọi Gemini qua client httpx async trên loop dùng chung của worker
+        result = run_upstream(create_voice_async(text, key, device_id, voice_code, audio_format, bitrate))
+    else:
+        result = create_voice(text, key, device_id, voice_code, audio_format, bitrate)
+    success, message, file_name, duration = result
     if not success:
         # Log failed voice creation
         db_manager.log_api_usage(
@@ -89,7 +131,7 @@ def create_voice_api():
             endpoint="/create",
             user_ip=request.remote_addr,
             user_agent=request.headers.get('User-Agent', ''),
-            request_data=f"text={text[:100]}&voice_code={voice_code}",
+            request_data=f"text={text[:100]}&voice_code={voice_code}&format={audio_format}",
             response_status=400,
             response_message=message
         )
@@ -106,7 +148,7 @@ def create_voice_api():
         endpoint="/create",
         user_ip=request.remote_addr,
         user_agent=request.headers.get('User-Agent', ''),
-        request_data=f"text={text[:100]}&voice_code={voice_code}",
+        request_data=f"text={text[:100]}&voice_code={voice_code}&format={audio_format}",
         response_status=200,
         response_message=f"Voice created: {file_name}"
     )
@@ -115,11 +157,126 @@ def create_voice_api():
         "success": True,
         "message": message,
         "file_url": file_url,
-        "duration": duration
+        "duration": duration,
+        "format": audio_format
+    })
+
+
+@voice_bp.route("/create_stream", methods=["POST"])
+@require_auth(module="voice")
+@require_admission(module="voice")
+def create_voice_stream_api():
+    data = request.form
+    text = data.get("text", "").strip()
+    voice_code = data.get("voice_code", "achird").strip()
+    key = data.get("key", "").strip()
+    device_id = data.get("device_id", "").strip()
+
+    if not text:
+        return jsonify(success=False, message="❌ Thiếu text"), 400
+    if not key or not device_id:
+        return jsonify(success=False, message="❌ Thiếu key hoặc device_id"), 400
+
+    try:
+        audio_format = normalize_audio_format(data.get("format"))
+        bitrate = normalize_bitrate(data.get("bitrate"))
+    except ValueError as e:
+        return jsonify(success=False, message=str(e)), 400
+
+    # Lấy thông tin request trước, generator chạy sau khi request context đã đóng
+    log_info = dict(
+        key_value=key,
+        module="voice",
+        device_id=device_id,
+        endpoint="/create_stream",
+        user_ip=request.remote_addr,
+        user_agent=request.headers.get('User-Agent', ''),
+        request_data=f"text={text[:100]}&voice_code={voice_code}&format={audio_format}",
+    )
+
+    def on_complete(ok, message):
+        db_manager.log_api_usage(**log_info, response_status=200 if ok else 500, response_message=message)
+
+    success, message, file_name, audio_chunks = stream_voice(
+        text, key, device_id, voice_code, audio_format, bitrate, on_complete=on_complete
+    )
+    if not success:
+        db_manager.log_api_usage(**log_info, response_status=400, response_message=message)
+        return jsonify(success=False, message=message), 400
+
+    host_url = request.host_url.rstrip("/")
+    response = Response(audio_chunks, mimetype=AUDIO_FORMATS[audio_format]["mimetype"])
+    response.headers["X-File-Url"] = f"{host_url}/api/voice/play/{file_name}"
+    response.headers["Cache-Control"] = "no-store"
+    response.headers["X-Accel-Buffering"] = "no"  # nginx không buffer, đẩy từng chunk ngay
+    return response
+
+
+@voice_bp.route("/create_batch", methods=["POST"])
+@require_auth(module="voice")
+@require_admission(module="voice")
+def create_voice_batch_api():
+    data = request.form
+    key = data.get("key", "").strip()
+    device_id = data.get("device_id", "").strip()
+
+    if not key or not device_id:
+        return jsonify(success=False, message="❌ Thiếu key hoặc device_id"), 400
+
+    try:
+        raw_items = json.loads(data.get("items", "") or "[]")
+    except ValueError:
+        return jsonify(success=False, message="❌ items phải là JSON list"), 400
+    if not isinstance(raw_items, list) or not raw_items:
+        return jsonify(success=False, message="❌ Thiếu items"), 400
+    if len(raw_items) > VOICE_BATCH_MAX_ITEMS:
+        return jsonify(success=False, message=f"❌ Tối đa {VOICE_BATCH_MAX_ITEMS} items mỗi batch"), 400
+
+    items = []
+    for i, item in enumerate(raw_items):
+        text = str(item.get("text", "")).strip() if isinstance(item, dict) else ""
+        if not text:
+            return jsonify(success=False, message=f"❌ Thiếu text ở item {i}"), 400
+        items.append({"text": text, "voice_code": str(item.get("voice_code") or "achird").strip()})
+
+    try:
+        audio_format = normalize_audio_format(data.get("format"))
+        bitrate = normalize_bitrate(data.get("bitrate"))
+    except ValueError as e:
+        return jsonify(success=False, message=str(e)), 400
+
+    success, message, results = create_voice_batch(items, key, device_id, audio_format, bitrate)
+
+    db_manager.log_api_usage(
+        key_value=key,
+        module="voice",
+        device_id=device_id,
+        endpoint="/create_batch",
+        user_ip=request.remote_addr,
+        user_agent=request.headers.get('User-Agent', ''),
+        request_data=f"items={len(items)}&format={audio_format}",
+        response_status=200 if success else 400,
+        response_message=message
+    )
+    if not success:
+        return jsonify(success=False, message=message), 400
+
+    host_url = request.host_url.rstrip("/")
+    for result in results:
+        filename = result.pop("filename", None)
+        if filename:
+            result["file_url"] = f"{host_url}/api/voice/play/{filename}"
+
+    return jsonify({
+        "success": True,
+        "message": message,
+        "format": audio_format,
+        "items": results
     })
 
 
 @voice_bp.route("/use", methods=["POST"])
+@idempotent(module="voice")
 @require_auth(module="voice")
 def use_voice_api():
     key = request.form.get("key", "")
@@ -7,17 +7,27 @@ from api.make_video_ai import make_video_ai_bp
 from api.merger_video_ai import merger_video_ai_bp
 from routes.misc import misc_bp
 from routes.admin import admin_bp
+from services.media_gc_service import ensure_media_gc_started
+from services.upload_service import ensure_upload_gc_started
+from utils.provider_credentials import provider_credentials
+from config import MEDIA_GC_ENABLED, MEDIA_SENDFILE_MODE, TRACING_ENABLED
+from utils.tracing import start_request_trace, record_request_status, end_request_trace
+from utils.performance_monitor import start_request_timer, record_request_metrics
 import os
 
-def create_app():
+def create_app(async_upstream=False):
     app = Flask(__name__)
     
+    # True khi chạy qua asgi.py: endpoint tạo voice/image gọi Gemini bằng client async (utils.async_upstream)
+    app.config["ASYNC_UPSTREAM"] = async_upstream
+    
     # Cấu hình secret key cho session
     app.secret_key = 'your-secret-key-change-this-in-production'
     
     # Performance optimizations
     app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 3600  # Cache static files for 1 hour
     app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
+    app.config['USE_X_SENDFILE'] = MEDIA_SENDFILE_MODE == "x-sendfile"  # web server gửi file thay worker
     # Register blueprints
     app.register_blueprint(voice_bp, url_prefix='/api/voice')
     app.register_blueprint(image_bp, url_prefix='/api/image')
@@ -28,6 +38,26 @@ def create_app():
     app.register_blueprint(misc_bp)
     app.register_blueprint(admin_bp)
     
+    # Latency theo endpoint / module (utils.performance_monitor, xem /admin/api/performance)
+    app.before_request(start_request_timer)
+    app.after_request(record_request_metrics)
+    
+    # Media GC chạy nền trong từng worker (khởi động sau fork, ở request đầu tiên)
+    if MEDIA_GC_ENABLED:
+        app.before_request(ensure_media_gc_started)
+    
+    # Upload resumable bỏ dở luôn được dọn (không phụ thuộc MEDIA_GC_ENABLED)
+    app.before_request(ensure_upload_gc_started)
+    
+    # Import key từ file txt cũ / cảnh báo khi file đã khác bảng provider_credentials (file không còn được đọc)
+    provider_credentials.check_legacy_files()
+    
+    # Tracing: span gốc cho mỗi request được lấy mẫu (utils.tracing)
+    if TRACING_ENABLED:
+        app.before_request(start_request_trace)
+        app.after_request(record_request_status)
+        app.teardown_request(end_request_trace)
+    
     # Performance middleware
     @app.after_request
     def add_performance_headers(response):
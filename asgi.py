@@ -0,0 +1,7 @@
+# Chạy dưới ASGI server: uvicorn asgi:app --workers 4 (hoặc gunicorn -k uvicorn.workers.UvicornWorker asgi:app)
+# View Flask chạy trong thread pool của a2wsgi; request tạo voice/image gửi phần gọi Gemini
+# sang event loop upstream của worker (httpx async, pool connection dùng chung).
+from a2wsgi import WSGIMiddleware
+from app import create_app
+from config import ASGI_WSGI_THREADS
+app = WSGIMiddleware(create_app(async_upstream=True), workers=ASGI_WSGI_THREADS)
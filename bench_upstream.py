@@ -0,0 +1,174 @@
+"""Benchmark in-flight generation requests per worker against a stub Gemini upstream.
+
+1. Stub upstream (answers every generateContent call after --delay seconds):
+       python bench_upstream.py stub --port 9100 --delay 1.0
+2. One worker pointed at the stub, e.g.
+       GEMINI_API_BASE=http://127.0.0.1:9100 gunicorn -w 1 -k gevent wsgi:app
+       GEMINI_API_BASE=http://127.0.0.1:9100 uvicorn asgi:app --workers 1 --port 8000
+   (gemini_key_tm.txt needs at least one line, the stub accepts any key)
+3. Load:
+       python bench_upstream.py load --url http://127.0.0.1:8000/api/voice/create --create-key \
+           --concurrency 500 --requests 2000 --stub http://127.0.0.1:9100
+
+The stub reports the highest number of upstream calls it held at once, i.e.
+how many requests the worker actually kept in flight.
+"""
+import argparse
+import asyncio
+import base64
+import json
+import statistics
+import struct
+import time
+import zlib
+
+_PCM = b"\x00\x00" * 2400  # 0.1s im lặng s16le 24kHz
+
+
+def _tiny_png():
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff)
+    raw = zlib.compress(b"\x00\xff\xff\xff")
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", struct.pack(">IIBBBBB", 1, 1, 8, 2, 0, 0, 0)) + chunk(b"IDAT", raw) + chunk(b"IEND", b"")
+
+
+def _stub_body(path):
+    if "tts" in path:
+        part = {"inlineData": {"mimeType": "audio/L16;rate=24000", "data": base64.b64encode(_PCM).decode()}}
+    else:
+        part = {"inlineData": {"mimeType": "image/png", "data": base64.b64encode(_tiny_png()).decode()}}
+    return json.dumps({"candidates": [{"content": {"parts": [part]}}]}).encode()
+
+
+async def run_stub(port, delay):
+    stats = {"in_flight": 0, "peak_in_flight": 0, "calls": 0}
+
+    async def handle(reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    return
+                method, path, _ = request_line.decode().split(" ", 2)
+                length = 0
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode().partition(":")
+                    if name.lower() == "content-length":
+                        length = int(value)
+                await reader.readexactly(length)
+
+                if path.startswith("/stats"):
+                    body = json.dumps(stats).encode()
+                    if "reset" in path:
+                        stats.update(peak_in_flight=0, calls=0)
+                else:
+                    stats["calls"] += 1
+                    stats["in_flight"] += 1
+                    stats["peak_in_flight"] = max(stats["peak_in_flight"], stats["in_flight"])
+                    try:
+                        await asyncio.sleep(delay)
+                    finally:
+                        stats["in_flight"] -= 1
+                    body = _stub_body(path)
+
+                writer.write(
+                    b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n"
+                    + f"Content-Length: {len(body)}\r\n\r\n".encode() + body
+                )
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, "127.0.0.1", port, backlog=4096)
+    print(f"🧪 Stub Gemini tại http://127.0.0.1:{port} (delay {delay}s)")
+    async with server:
+        await server.serve_forever()
+
+
+async def run_load(args):
+    import httpx
+
+    if args.create_key:
+        from database import db_manager
+        db_manager.add_key(args.key, args.module, device_id=args.device_id, expires="2099-12-31")
+
+    form = {"key": args.key, "device_id": args.device_id, "text": "Xin chào", "format": "wav"}
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    latencies = []
+    failures = 0
+    queue = asyncio.Queue()
+    for _ in range(args.requests):
+        queue.put_nowait(None)
+
+    async with httpx.AsyncClient(limits=limits, timeout=args.timeout) as client:
+        if args.stub:
+            await client.get(f"{args.stub}/stats?reset=1")
+
+        async def user():
+            nonlocal failures
+            while not queue.empty():
+                queue.get_nowait()
+                started = time.perf_counter()
+                try:
+                    response = await client.post(args.url, data=form)
+                    ok = response.status_code == 200 and response.json().get("success")
+                except Exception:
+                    ok = False
+                if ok:
+                    latencies.append(time.perf_counter() - started)
+                else:
+                    failures += 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(user() for _ in range(args.concurrency)))
+        elapsed = time.perf_counter() - started
+        stub_stats = (await client.get(f"{args.stub}/stats")).json() if args.stub else {}
+
+    latencies.sort()
+    report = {
+        "url": args.url,
+        "concurrency": args.concurrency,
+        "ok": len(latencies),
+        "failed": failures,
+        "elapsed_s": round(elapsed, 2),
+        "req_per_s": round(len(latencies) / elapsed, 1) if elapsed else 0,
+        "p50_ms": round(statistics.median(latencies) * 1000, 1) if latencies else None,
+        "p99_ms": round(latencies[int(len(latencies) * 0.99) - 1] * 1000, 1) if latencies else None,
+        "upstream_peak_in_flight": stub_stats.get("peak_in_flight"),
+    }
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    stub = sub.add_parser("stub", help="run the stub Gemini upstream")
+    stub.add_argument("--port", type=int, default=9100)
+    stub.add_argument("--delay", type=float, default=1.0, help="seconds before each upstream answer")
+
+    load = sub.add_parser("load", help="fire concurrent generation requests")
+    load.add_argument("--url", required=True)
+    load.add_argument("--concurrency", type=int, default=200)
+    load.add_argument("--requests", type=int, default=1000)
+    load.add_argument("--timeout", type=float, default=120)
+    load.add_argument("--key", default="BENCH-KEY")
+    load.add_argument("--device-id", default="bench-device")
+    load.add_argument("--module", default="voice")
+    load.add_argument("--create-key", action="store_true", help="add --key to keys.db first")
+    load.add_argument("--stub", help="stub base URL, to report its peak in-flight calls")
+
+    args = parser.parse_args()
+    if args.command == "stub":
+        asyncio.run(run_stub(args.port, args.delay))
+    else:
+        asyncio.run(run_load(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,19 @@
-import sqlite3
 import os
 import json
 from datetime import datetime
 from typing import Optional, Dict, List, Tuple
-import threading
+from config import DATABASE_URL, DB_POOL_MIN, DB_POOL_MAX
+from utils.db_backend import create_backend
+from utils.tracing import trace_methods, traced_lock
+from utils.metrics import timed_lock
 
+# Tracing bật: mỗi method public là 1 span db.<method>, kèm thời gian chờ self.lock (db.lock_wait_ms)
+@trace_methods("db", exclude=("get_connection", "parse_date", "get_vietnam_time", "init_database"))
 class DatabaseManager:
-    def __init__(self, db_path: str = "keys.db"):
+    def __init__(self, db_path: str = "keys.db", database_url: str = DATABASE_URL):
         self.db_path = db_path
-        self.lock = threading.Lock()
+        self.backend = create_backend(database_url or "", db_path, DB_POOL_MIN, DB_POOL_MAX)
+        self.lock = traced_lock(timed_lock(self.backend.make_lock()))
         self.init_database()
     
     def parse_date(self, date_str: str) -> Optional[datetime]:
@@ -42,11 +47,13 @@ class DatabaseManager:
     def init_database(self):
         """Khởi tạo database và tạo bảng nếu chưa tồn tại"""
         with self.lock:
-            conn = sqlite3.connect(self.db_path)
+            conn = self.get_connection()
+            self.backend.prepare(conn)
             cursor = conn.cursor()
+            schema = self.backend.schema
             
             # Tạo bảng keys
-            cursor.execute('''
+            cursor.execute(schema('''
                 CREATE TABLE IF NOT EXISTS keys (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
                     key TEXT UNIQUE NOT NULL,
@@ -60,10 +67,13 @@ class DatabaseManager:
                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                     updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
                 )
-            ''')
+            '''))
+            
+            # Lane ưu tiên khi hàng đợi tạo nội dung bị đầy (high/normal/low, NULL = theo max_usage)
+            self.backend.add_column(cursor, 'keys', 'priority', 'TEXT')
             
             # Tạo bảng activity_log
-            cursor.execute('''
+            cursor.execute(schema('''
                 CREATE TABLE IF NOT EXISTS activity_log (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
                     action TEXT NOT NULL,
@@ -75,10 +85,10 @@ class DatabaseManager:
                     user_agent TEXT,
                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
                 )
-            ''')
+            '''))
             
             # Tạo bảng api_usage_log để track end user usage
-            cursor.execute('''
+            cursor.execute(schema('''
                 CREATE TABLE IF NOT EXISTS api_usage_log (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
                     key_value TEXT NOT NULL,
@@ -92,10 +102,10 @@ class DatabaseManager:
                     response_message TEXT,
                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
                 )
-            ''')
+            '''))
             
             # Tạo bảng admin_users để quản lý admin accounts
-            cursor.execute('''
+            cursor.execute(schema('''
                 CREATE TABLE IF NOT EXISTS admin_users (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
                     username TEXT UNIQUE NOT NULL,
@@ -105,7 +115,80 @@ class DatabaseManager:
                     last_login TIMESTAMP,
                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
                 )
-            ''')
+            '''))
+            
+            # Tạo bảng media_index: tên file public -> object lưu theo hash (sharded)
+            cursor.execute(schema('''
+                CREATE TABLE IF NOT EXISTS media_index (
+                    public_name TEXT PRIMARY KEY,
+                    module TEXT NOT NULL,
+                    object_path TEXT NOT NULL,
+                    sha256 TEXT NOT NULL,
+                    size INTEGER,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            '''))
+            
+            # Tạo bảng media_access: lần cuối file được serve (dùng cho GC theo LRU)
+            cursor.execute(schema('''
+                CREATE TABLE IF NOT EXISTS media_access (
+                    module TEXT NOT NULL,
+                    rel_path TEXT NOT NULL,
+                    last_served_at REAL NOT NULL,
+                    PRIMARY KEY (module, rel_path)
+                )
+            '''))
+            
+            # Tạo bảng clone_voice_registry: tránh đăng ký lại cùng một sample lên AusyncLab
+            cursor.execute(schema('''
+                CREATE TABLE IF NOT EXISTS clone_voice_registry (
+                    api_key TEXT NOT NULL,
+                    audio_sha256 TEXT NOT NULL,
+                    name TEXT NOT NULL,
+                    language TEXT NOT NULL,
+                    gender TEXT NOT NULL,
+                    age TEXT NOT NULL,
+                    voice_id TEXT NOT NULL,
+                    detail TEXT,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (api_key, audio_sha256, name, language, gender, age)
+                )
+            '''))
+            
+            # Tạo bảng provider_credentials: key Gemini / Suno / ... dùng để gọi upstream
+            #   state: active | exhausted (hết credit) | disabled (admin tắt)
+            #   cooldown_until: key active bị upstream rate limit, xếp cuối tới thời điểm này (epoch)
+            cursor.execute(schema('''
+                CREATE TABLE IF NOT EXISTS provider_credentials (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    provider TEXT NOT NULL,
+                    secret TEXT NOT NULL,
+                    state TEXT NOT NULL DEFAULT 'active',
+                    remaining_credits INTEGER,
+                    last_error TEXT,
+                    cooldown_until REAL NOT NULL DEFAULT 0,
+                    updated_at TIMESTAMP,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    UNIQUE (provider, secret)
+                )
+            '''))
+            
+            # Tạo bảng idempotency_records: kết quả request có Idempotency-Key (client retry không bị trừ lượt lần 2)
+            #   state: pending (request đầu đang chạy) | done (đã có response)
+            cursor.execute(schema('''
+                CREATE TABLE IF NOT EXISTS idempotency_records (
+                    scope TEXT NOT NULL,
+                    idempotency_key TEXT NOT NULL,
+                    request_hash TEXT NOT NULL,
+                    state TEXT NOT NULL DEFAULT 'pending',
+                    status_code INTEGER,
+                    content_type TEXT,
+                    response_body TEXT,
+                    created_at REAL NOT NULL,
+                    expires_at REAL NOT NULL,
+                    PRIMARY KEY (scope, idempotency_key)
+                )
+            '''))
             
             # Tạo index để tăng tốc độ truy vấn
             cursor.execute('CREATE INDEX IF NOT EXISTS idx_key ON keys(key)')
@@ -120,13 +203,20 @@ class DatabaseManager:
             cursor.execute('CREATE INDEX IF NOT EXISTS idx_api_usage_created_at ON api_usage_log(created_at)')
             cursor.execute('CREATE INDEX IF NOT EXISTS idx_api_usage_ip ON api_usage_log(user_ip)')
             cursor.execute('CREATE INDEX IF NOT EXISTS idx_admin_username ON admin_users(username)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_media_sha256 ON media_index(sha256)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_media_object_path ON media_index(object_path)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_clone_voice_id ON clone_voice_registry(api_key, voice_id)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_provider_credentials_pick ON provider_credentials(provider, state, cooldown_until)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_idempotency_expires_at ON idempotency_records(expires_at)')
             
             conn.commit()
             conn.close()
+        # Không giữ connection của master process sang các worker (preload_app)
+        self.backend.dispose()
     
     def get_connection(self):
-        """Lấy connection đến database"""
-        return sqlite3.connect(self.db_path)
+        """Lấy connection đến database (SQLite hoặc connection mượn từ pool PostgreSQL)"""
+        return self.backend.connect()
     
     def get_key_info(self, key: str, module: str = None) -> Optional[Dict]:
         """Lấy thông tin key"""
@@ -136,12 +226,12 @@ class DatabaseManager:
             
             if module:
                 cursor.execute('''
-                    SELECT key, device_id, status, expires, max_usage, usage_count, module, note
+                    SELECT key, device_id, status, expires, max_usage, usage_count, module, note, priority
                     FROM keys WHERE key = ? AND module = ?
                 ''', (key, module))
             else:
                 cursor.execute('''
-                    SELECT key, device_id, status, expires, max_usage, usage_count, module, note
+                    SELECT key, device_id, status, expires, max_usage, usage_count, module, note, priority
                     FROM keys WHERE key = ?
                 ''', (key,))
             
@@ -157,7 +247,8 @@ class DatabaseManager:
                     'max_usage': row[4],
                     'usage_count': row[5],
                     'module': row[6],
-                    'note': row[7]
+                    'note': row[7],
+                    'priority': row[8]
                 }
             return None
     
@@ -251,7 +342,7 @@ class DatabaseManager:
             return True, "OK", expires, remaining
     
     def update_usage_count(self, key: str, device_id: str = None, module: str = None, count: int = 1):
-        """Cập nhật số lượt sử dụng"""
+        """Cập nhật số lượt sử dụng (cộng trực tiếp trên DB, không đọc-rồi-ghi)"""
         with self.lock:
             conn = self.get_connection()
             cursor = conn.cursor()
@@ -259,12 +350,12 @@ class DatabaseManager:
             # Lấy thông tin key hiện tại
             if module:
                 cursor.execute('''
-                    SELECT device_id, max_usage, usage_count
+                    SELECT device_id, module
                     FROM keys WHERE key = ? AND module = ?
                 ''', (key, module))
             else:
                 cursor.execute('''
-                    SELECT device_id, max_usage, usage_count
+                    SELECT device_id, module
                     FROM keys WHERE key = ?
                 ''', (key,))
             
@@ -273,36 +364,62 @@ class DatabaseManager:
                 conn.close()
                 raise Exception("Key không tồn tại")
             
-            current_device, max_usage, current_usage = row
+            current_device, module = row
             
             # Kiểm tra device_id
             if device_id:
                 if not current_device:
                     cursor.execute('''
                         UPDATE keys SET device_id = ?, updated_at = ?
-                        WHERE key = ? AND module = ?
+                        WHERE key = ? AND module = ? AND (device_id IS NULL OR device_id = '')
                     ''', (device_id, self.get_vietnam_time(), key, module))
                 elif current_device != device_id:
                     conn.close()
                     raise Exception("📵 KEY đã bị gán với thiết bị khác")
             
-            # Kiểm tra số lượt sử dụng
-            new_usage = (current_usage or 0) + count
-            if max_usage is not None and new_usage > max_usage:
+            # Cộng lượt và kiểm tra giới hạn trong cùng một câu UPDATE:
+            # nhiều worker/node trừ lượt cùng lúc cũng không vượt max_usage
+            cursor.execute('''
+                UPDATE keys SET usage_count = COALESCE(usage_count, 0) + ?, updated_at = ?
+                WHERE key = ? AND module = ?
+                  AND (max_usage IS NULL OR COALESCE(usage_count, 0) + ? <= max_usage)
+            ''', (count, self.get_vietnam_time(), key, module, count))
+            
+            if cursor.rowcount == 0:
+                conn.rollback()
+                cursor.execute(
+                    'SELECT max_usage, usage_count FROM keys WHERE key = ? AND module = ?',
+                    (key, module)
+                )
+                max_usage, current_usage = cursor.fetchone()
                 conn.close()
-                raise Exception(f"🚫 Vượt quá số lượt cho phép ({new_usage}/{max_usage})")
+                raise Exception(f"🚫 Vượt quá số lượt cho phép ({(current_usage or 0) + count}/{max_usage})")
+            
+            conn.commit()
+            
+            if count > 1:
+                cursor.execute('SELECT usage_count FROM keys WHERE key = ? AND module = ?', (key, module))
+                new_usage = cursor.fetchone()[0]
+                print(f"✅ Đã cộng thêm {count} lượt cho KEY '{key}' (tổng: {new_usage})")
+            conn.close()
+    
+    def refund_usage_count(self, key: str, module: str, count: int = 1):
+        """Hoàn lại lượt đã trừ (vd: item trong batch bị lỗi)"""
+        if count <= 0:
+            return
+        with self.lock:
+            conn = self.get_connection()
+            cursor = conn.cursor()
             
-            # Cập nhật usage_count
             cursor.execute('''
-                UPDATE keys SET usage_count = ?, updated_at = ?
+                UPDATE keys SET usage_count = {}(0, COALESCE(usage_count, 0) - ?), updated_at = ?
                 WHERE key = ? AND module = ?
-            ''', (new_usage, self.get_vietnam_time(), key, module))
+            '''.format(self.backend.greatest), (count, self.get_vietnam_time(), key, module))
             
             conn.commit()
             conn.close()
             
-            if count > 1:
-                print(f"✅ Đã cộng thêm {count} lượt cho KEY '{key}' (tổng: {new_usage})")
+            print(f"↩️ Đã hoàn {count} lượt cho KEY '{key}'")
     
     def get_key_status(self, key: str, device_id: str, module: str = None) -> Dict:
         """Lấy trạng thái key"""
@@ -323,7 +440,7 @@ class DatabaseManager:
     
     def add_key(self, key: str, module: str, device_id: str = None, 
                 status: str = "active", expires: str = None, 
-                max_usage: int = None, usage_count: int = 0, note: str = ""):
+                max_usage: int = None, usage_count: int = 0, note: str = "", priority: str = None):
         """Thêm key mới"""
         with self.lock:
             conn = self.get_connection()
@@ -331,12 +448,12 @@ class DatabaseManager:
             
             try:
                 cursor.execute('''
-                    INSERT INTO keys (key, device_id, status, expires, max_usage, usage_count, module, note, created_at, updated_at)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                ''', (key, device_id, status, expires, max_usage, usage_count, module, note, self.get_vietnam_time(), self.get_vietnam_time()))
+                    INSERT INTO keys (key, device_id, status, expires, max_usage, usage_count, module, note, priority, created_at, updated_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ''', (key, device_id, status, expires, max_usage, usage_count, module, note, priority, self.get_vietnam_time(), self.get_vietnam_time()))
                 conn.commit()
                 return True
-            except sqlite3.IntegrityError:
+            except self.backend.IntegrityError:
                 return False  # Key đã tồn tại
             finally:
                 conn.close()
@@ -352,7 +469,7 @@ class DatabaseManager:
             values = []
             
             for field, value in kwargs.items():
-                if field in ['device_id', 'status', 'expires', 'max_usage', 'usage_count', 'note']:
+                if field in ['device_id', 'status', 'expires', 'max_usage', 'usage_count', 'note', 'priority']:
                     set_clauses.append(f"{field} = ?")
                     values.append(value)
             
@@ -529,8 +646,8 @@ class DatabaseManager:
             cursor.execute('''
                 SELECT COUNT(*) 
                 FROM activity_log 
-                WHERE created_at >= datetime('now', '-1 day')
-            ''')
+                WHERE created_at >= {}
+            '''.format(self.backend.days_ago(1)))
             recent_24h = cursor.fetchone()[0]
             
             conn.close()
@@ -554,7 +671,7 @@ class DatabaseManager:
             count_conditions = []
             
             if days_to_keep:
-                count_conditions.append('created_at < datetime("now", "-{} days")'.format(days_to_keep))
+                count_conditions.append(f'created_at < {self.backend.days_ago(days_to_keep)}')
             
             if action_filter:
                 count_conditions.append('action = ?')
@@ -576,7 +693,7 @@ class DatabaseManager:
             delete_conditions = []
             
             if days_to_keep:
-                delete_conditions.append('created_at < datetime("now", "-{} days")'.format(days_to_keep))
+                delete_conditions.append(f'created_at < {self.backend.days_ago(days_to_keep)}')
             
             if action_filter:
                 delete_conditions.append('action = ?')
@@ -737,8 +854,8 @@ class DatabaseManager:
             cursor.execute('''
                 SELECT COUNT(*) 
                 FROM api_usage_log 
-                WHERE created_at >= datetime('now', '-1 day')
-            ''')
+                WHERE created_at >= {}
+            '''.format(self.backend.days_ago(1)))
             recent_24h = cursor.fetchone()[0]
             
             # Response status stats
@@ -762,6 +879,458 @@ class DatabaseManager:
                 'status_stats': status_stats
             }
     
+    def add_media_object(self, public_name: str, module: str, object_path: str, sha256: str, size: int) -> bool:
+        """Gán tên file public cho một object đã lưu"""
+        with self.lock:
+            conn = self.get_connection()
+            cursor = conn.cursor()
+            
+            try:
+                cursor.execute('''
+                    INSERT INTO media_index (public_name, module, object_path, sha256, size, created_at)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                ''', (public_name, module, object_path, sha256, size, self.get_vietnam_time()))
+                conn.commit()
+                return True
+            except self.backend.IntegrityError:
+                return False  # public_name đã tồn tại
+            finally:
+                conn.close()
+    
+    def get_media_object(self, public_name: str) -> Optional[Dict]:
+        """Lấy object ứng với tên file public"""
+        with self.lock:
+            conn = self.get_connection()
+            cursor = conn.cursor()
+            
+            cursor.execute('''
+                SELECT public_name, module, object_path, sha256, size, created_at
+                FROM media_index WHERE public_name = ?
+            ''', (public_name,))
+            
+            row = cursor.fetchone()
+            conn.close()
+            
+            if row:
+                return {
+                    'public_name': row[0],
+                    'module': row[1],
+                    'object_path': row[2],
+                    'sha256': row[3],
+                    'size': row[4],
+                    'created_at': row[5]
+                }
+            return None
+    
+    def delete_media_objects(self, module: str, object_paths: List[str]) -> List[str]:
+        """Xóa các tên public trỏ tới những object đã bị xóa, trả về danh sách tên đã xóa"""
+        if not object_paths:
+            return []
+        with self.lock:
+            conn = self.get_connection()
+            cursor = conn.cursor()
+            
+            public_names = []
+            for object_path in object_paths:
+                cursor.execute(
+                    'SELECT public_name FROM media_index WHERE module = ? AND object_path = ?',
+                    (module, object_path)
+                )
+                public_names.extend(row[0] for row in cursor.fetchall())
+                cursor.execute(
+                    'DELETE FROM media_index WHERE module = ? AND object_path = ?',
+                    (module, object_path)
+                )
+            
+            conn.commit()
+            conn.close()
+            return public_names
+    
+    def record_media_access(self, entries: List[Tuple[str, str, float]]):
+        """Ghi lần serve cuối của nhiều file cùng lúc: [(module, rel_path, timestamp), ...]"""
+        if not entries:
+            return
+        with self.lock:
+            conn = self.get_connection()
+            cursor = conn.cursor()
+            
+            cursor.executemany('''
+                INSERT INTO media_access (module, rel_path, last_served_at)
+                VALUES (?, ?, ?)
+                ON CONFLICT(module, rel_path)
+                DO UPDATE SET last_served_at = {}(media_access.last_served_at, excluded.last_served_at)
+            '''.format(self.backend.greatest), entries)
+            
+            conn.commit()
+            conn.close()
+    
+    def get_media_access(self, module: str) -> Dict[str, float]:
+        """Lấy thời điểm serve cuối của mọi file trong module"""
+        with self.lock:
+            conn = self.get_connection()
+            cursor = conn.cursor()
+            
+            cursor.execute(
+                'SELECT rel_path, last_served_at FROM media_access WHERE module = ?',
+                (module,)
+            )
+            
+            result = dict(cursor.fetchall())
+            conn.close()
+            return result
+    
+    def delete_media_access(self, module: str, rel_paths: List[str]):
+        """Xóa lịch sử serve của các file đã bị xóa"""
+        if not rel_paths:
+            return
+        with self.lock:
+            conn = self.get_connection()
+            cursor = conn.cursor()
+            
+            cursor.executemany(
+                'DELETE FROM media_access WHERE module = ? AND rel_path = ?',
+                [(module, rel_path) for rel_path in rel_paths]
+            )
+            
+            conn.commit()
+            conn.close()
+    
+    def get_clone_voice(self, api_key: str, audio_sha256: str, name: str,
+                        language: str, gender: str, age: str) -> Optional[Dict]:
+        """Tìm voice đã đăng ký với cùng key + sample + thông số"""
+        with self.lock:
+            conn = self.get_connection()
+            cursor = conn.cursor()
+            
+            cursor.execute('''
+                SELECT voice_id, detail, created_at FROM clone_voice_registry
+                WHERE api_key = ? AND audio_sha256 = ? AND name = ? AND language = ? AND gender = ? AND age = ?
+            ''', (api_key, audio_sha256, name, language, gender, age))
+            
+            row = cursor.fetchone()
+            conn.close()
+            
+            if row:
+                return {
+                    'voice_id': row[0],
+                    'detail': json.loads(row[1]) if row[1] else None,
+                    'created_at': row[2]
+                }
+            return None
+    
+    def add_clone_voice(self, api_key: str, audio_sha256: str, name: str, language: str,
+                        gender: str, age: str, voice_id: str, detail: Dict = None):
+        """Lưu voice vừa đăng ký thành công"""
+        with self.lock:
+            conn = self.get_connection()
+            cursor = conn.cursor()
+            
+            cursor.execute('''
+                INSERT INTO clone_voice_registry
+                (api_key, audio_sha256, name, language, gender, age, voice_id, detail, created_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(api_key, audio_sha256, name, language, gender, age)
+                DO UPDATE SET voice_id = excluded.voice_id, detail = excluded.detail, created_at = excluded.created_at
+            ''', (api_key, audio_sha256, name, language, gender, age, str(voice_id),
+                  json.dumps(detail, ensure_ascii=False) if detail else None, self.get_vietnam_time()))
+            
+            conn.commit()
+            conn.close()
+    
+    def delete_clone_voice(self, api_key: str, voice_id: str) -> int:
+        """Xóa voice khỏi registry (khi voice bị xóa trên AusyncLab)"""
+        with self.lock:
+            conn = self.get_connection()
+            cursor = conn.cursor()
+            
+            cursor.execute(
+                'DELETE FROM clone_voice_registry WHERE api_key = ? AND voice_id = ?',
+                (api_key, str(voice_id))
+            )
+            deleted_count = cursor.rowcount
+            
+            conn.commit()
+            conn.close()
+            return deleted_count
+    
+    def prune_clone_voices(self, api_key: str, live_voice_ids: List[str]) -> int:
+        """Xóa các voice của key không còn trong danh sách voice trên AusyncLab"""
+        with self.lock:
+            conn = self.get_connection()
+            cursor = conn.cursor()
+            
+            cursor.execute('SELECT DISTINCT voice_id FROM clone_voice_registry WHERE api_key = ?', (api_key,))
+            live = {str(voice_id) for voice_id in live_voice_ids}
+            stale = [row[0] for row in cursor.fetchall() if row[0] not in live]
+            
+            cursor.executemany(
+                'DELETE FROM clone_voice_registry WHERE api_key = ? AND voice_id = ?',
+                [(api_key, voice_id) for voice_id in stale]
+            )
+            
+            conn.commit()
+            conn.close()
+            return len(stale)
+    
+    def add_provider_credentials(self, provider: str, secrets: List[str], state: str = 'active') -> int:
+        """Thêm credential cho provider (bỏ qua secret đã có), trả về số dòng thêm mới"""
+        if not secrets:
+            return 0
+        with self.lock:
+            conn = self.get_connection()
+            cursor = conn.cursor()
+            
+            inserted = 0
+            now = self.get_vietnam_time()
+            for secret in secrets:
+                cursor.execute('''
+                    INSERT INTO provider_credentials (provider, secret, state, updated_at, created_at)
+                    VALUES (?, ?, ?, ?, ?)
+                    ON CONFLICT(provider, secret) DO NOTHING
+                ''', (provider, secret, state, now, now))
+                inserted += max(cursor.rowcount, 0)
+            
+            conn.commit()
+            conn.close()
+            return inserted
+    
+    def get_usable_provider_credentials(self, provider: str) -> List[Dict]:
+        """Credential active của provider (cả key đang cooldown), theo thứ tự thêm vào"""
+        with self.lock:
+            conn = self.get_connection()
+            cursor = conn.cursor()
+            
+            cursor.execute('''
+                SELECT secret, cooldown_until, remaining_credits FROM provider_credentials
+                WHERE provider = ? AND state = 'active'
+                ORDER BY id
+            ''', (provider,))
+            
+            rows = cursor.fetchall()
+            conn.close()
+            return [
+                {'secret': row[0], 'cooldown_until': row[1] or 0, 'remaining_credits': row[2]}
+                for row in rows
+            ]
+    
+    def get_provider_credentials(self, provider: str = None) -> List[Dict]:
+        """Tất cả credential (mọi state), dùng cho trang admin"""
+        with self.lock:
+            conn = self.get_connection()
+            cursor = conn.cursor()
+            
+            query = '''
+                SELECT id, provider, secret, state, remaining_credits, last_error, cooldown_until, updated_at, created_at
+                FROM provider_credentials
+            '''
+            if provider:
+                cursor.execute(query + ' WHERE provider = ? ORDER BY id', (provider,))
+            else:
+                cursor.execute(query + ' ORDER BY provider, id')
+            
+            rows = cursor.fetchall()
+            conn.close()
+            return [
+                {
+                    'id': row[0],
+                    'provider': row[1],
+                    'secret': row[2],
+                    'state': row[3],
+                    'remaining_credits': row[4],
+                    'last_error': row[5],
+                    'cooldown_until': row[6] or 0,
+                    'updated_at': row[7],
+                    'created_at': row[8]
+                }
+                for row in rows
+            ]
+    
+    def count_provider_credentials(self, provider: str) -> int:
+        """Số credential của provider (mọi state)"""
+        with self.lock:
+            conn = self.get_connection()
+            cursor = conn.cursor()
+            
+            cursor.execute('SELECT COUNT(*) FROM provider_credentials WHERE provider = ?', (provider,))
+            count = cursor.fetchone()[0]
+            conn.close()
+            return count
+    
+    def transition_provider_credential(self, provider: str, secret: str, to_state: str,
+                                       from_states: Tuple[str, ...] = ('active',),
+                                       last_error: str = None, remaining_credits: int = None) -> bool:
+        """Đổi state nếu credential đang ở một trong from_states (1 câu UPDATE, nhiều worker cùng gọi
+        thì chỉ 1 worker đổi được); trả về True nếu đã đổi"""
+        with self.lock:
+            conn = self.get_connection()
+            cursor = conn.cursor()
+            
+            cursor.execute('''
+                UPDATE provider_credentials
+                SET state = ?, last_error = COALESCE(?, last_error),
+                    remaining_credits = COALESCE(?, remaining_credits), cooldown_until = 0, updated_at = ?
+                WHERE provider = ? AND secret = ? AND state IN ({})
+            '''.format(", ".join("?" for _ in from_states)),
+                (to_state, last_error, remaining_credits, self.get_vietnam_time(), provider, secret, *from_states))
+            changed = cursor.rowcount > 0
+            
+            conn.commit()
+            conn.close()
+            return changed
+    
+    def set_provider_credential_cooldown(self, provider: str, secret: str, until: float, last_error: str = None) -> bool:
+        """Xếp credential active xuống cuối tới thời điểm `until` (không rút ngắn cooldown đang có)"""
+        with self.lock:
+            conn = self.get_connection()
+            cursor = conn.cursor()
+            
+            cursor.execute('''
+                UPDATE provider_credentials
+                SET cooldown_until = {}(cooldown_until, ?), last_error = COALESCE(?, last_error), updated_at = ?
+                WHERE provider = ? AND secret = ? AND state = 'active'
+            '''.format(self.backend.greatest), (until, last_error, self.get_vietnam_time(), provider, secret))
+            changed = cursor.rowcount > 0
+            
+            conn.commit()
+            conn.close()
+            return changed
+    
+    def get_provider_credential_stats(self) -> Dict:
+        """Số credential theo provider và state"""
+        with self.lock:
+            conn = self.get_connection()
+            cursor = conn.cursor()
+            
+            cursor.execute('SELECT provider, state, COUNT(*) FROM provider_credentials GROUP BY provider, state')
+            stats = {}
+            for provider, state, count in cursor.fetchall():
+                stats.setdefault(provider, {})[state] = count
+            
+            conn.close()
+            return stats
+    
+    def claim_idempotency_key(self, scope: str, idempotency_key: str, request_hash: str,
+                              now: float, ttl: float, stale_before: float) -> Optional[Dict]:
+        """Giữ Idempotency-Key cho request này.
+
+        Trả về None nếu request này được chạy (key mới, bản ghi cũ đã hết hạn, hoặc request đầu bị bỏ dở
+        từ trước stale_before); ngược lại trả về bản ghi hiện có (pending hoặc done).
+        """
+        with self.lock:
+            conn = self.get_connection()
+            cursor = conn.cursor()
+            
+            try:
+                cursor.execute('''
+                    INSERT INTO idempotency_records (scope, idempotency_key, request_hash, state, created_at, expires_at)
+                    VALUES (?, ?, ?, 'pending', ?, ?)
+                    ON CONFLICT(scope, idempotency_key) DO NOTHING
+                ''', (scope, idempotency_key, request_hash, now, now + ttl))
+                if cursor.rowcount > 0:
+                    conn.commit()
+                    return None
+                
+                # Bản ghi hết hạn / request đầu đã chết: chiếm lại bằng 1 câu UPDATE có điều kiện
+                cursor.execute('''
+                    UPDATE idempotency_records
+                    SET request_hash = ?, state = 'pending', status_code = NULL, content_type = NULL,
+                        response_body = NULL, created_at = ?, expires_at = ?
+                    WHERE scope = ? AND idempotency_key = ?
+                      AND (expires_at <= ? OR (state = 'pending' AND created_at < ?))
+                ''', (request_hash, now, now + ttl, scope, idempotency_key, now, stale_before))
+                if cursor.rowcount > 0:
+                    conn.commit()
+                    return None
+                conn.commit()
+                
+                cursor.execute('''
+                    SELECT request_hash, state, status_code, content_type, response_body, created_at
+                    FROM idempotency_records WHERE scope = ? AND idempotency_key = ?
+                ''', (scope, idempotency_key))
+                row = cursor.fetchone()
+            finally:
+                conn.close()
+            
+            if row:
+                return {
+                    'request_hash': row[0],
+                    'state': row[1],
+                    'status_code': row[2],
+                    'content_type': row[3],
+                    'response_body': row[4],
+                    'created_at': row[5]
+                }
+            return None
+    
+    def get_idempotency_record(self, scope: str, idempotency_key: str) -> Optional[Dict]:
+        """Bản ghi Idempotency-Key còn hạn"""
+        with self.lock:
+            conn = self.get_connection()
+            cursor = conn.cursor()
+            
+            cursor.execute('''
+                SELECT request_hash, state, status_code, content_type, response_body, created_at, expires_at
+                FROM idempotency_records WHERE scope = ? AND idempotency_key = ?
+            ''', (scope, idempotency_key))
+            
+            row = cursor.fetchone()
+            conn.close()
+            
+            if row:
+                return {
+                    'request_hash': row[0],
+                    'state': row[1],
+                    'status_code': row[2],
+                    'content_type': row[3],
+                    'response_body': row[4],
+                    'created_at': row[5],
+                    'expires_at': row[6]
+                }
+            return None
+    
+    def complete_idempotency_key(self, scope: str, idempotency_key: str, request_hash: str,
+                                 status_code: int, content_type: str, response_body: str):
+        """Lưu response cuối cùng của request đang giữ key"""
+        with self.lock:
+            conn = self.get_connection()
+            cursor = conn.cursor()
+            
+            cursor.execute('''
+                UPDATE idempotency_records
+                SET state = 'done', status_code = ?, content_type = ?, response_body = ?
+                WHERE scope = ? AND idempotency_key = ? AND request_hash = ? AND state = 'pending'
+            ''', (status_code, content_type, response_body, scope, idempotency_key, request_hash))
+            
+            conn.commit()
+            conn.close()
+    
+    def release_idempotency_key(self, scope: str, idempotency_key: str, request_hash: str):
+        """Bỏ key đang pending (request lỗi, không trừ lượt) để lần retry sau chạy lại"""
+        with self.lock:
+            conn = self.get_connection()
+            cursor = conn.cursor()
+            
+            cursor.execute('''
+                DELETE FROM idempotency_records
+                WHERE scope = ? AND idempotency_key = ? AND request_hash = ? AND state = 'pending'
+            ''', (scope, idempotency_key, request_hash))
+            
+            conn.commit()
+            conn.close()
+    
+    def purge_idempotency_records(self, now: float) -> int:
+        """Xóa bản ghi Idempotency-Key đã hết hạn"""
+        with self.lock:
+            conn = self.get_connection()
+            cursor = conn.cursor()
+            
+            cursor.execute('DELETE FROM idempotency_records WHERE expires_at <= ?', (now,))
+            deleted_count = cursor.rowcount
+            
+            conn.commit()
+            conn.close()
+            return deleted_count
+    
     def create_admin_user(self, username: str, password: str, email: str = None) -> bool:
         """Tạo admin user mới"""
         import hashlib
@@ -781,7 +1350,7 @@ class DatabaseManager:
                 
                 conn.commit()
                 return True
-            except sqlite3.IntegrityError:
+            except self.backend.IntegrityError:
                 return False  # Username đã tồn tại
             finally:
                 conn.close()
@@ -799,8 +1368,8 @@ class DatabaseManager:
             cursor.execute('''
                 SELECT id, username, email, is_active, last_login
                 FROM admin_users 
-                WHERE username = ? AND password_hash = ? AND is_active = 1
-            ''', (username, password_hash))
+                WHERE username = ? AND password_hash = ? AND is_active = ?
+            ''', (username, password_hash, True))
             
             row = cursor.fetchone()
             if row:
@@ -811,6 +1380,7 @@ class DatabaseManager:
                     WHERE id = ?
                 ''', (self.get_vietnam_time(), row[0]))
                 conn.commit()
+                conn.close()
                 
                 return {
                     'id': row[0],
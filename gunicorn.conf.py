@@ -49,6 +49,21 @@ secure_scheme_headers = {
     'X-FORWARDED-SSL': 'on'
 }
 
+# Prometheus /metrics (METRICS_ENABLED=true): mỗi worker ghi metric vào file mmap trong worker_tmp_dir,
+# /metrics gộp file của mọi worker. Phải đặt trước khi preload app import prometheus_client.
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'false').lower() == 'true'
+if METRICS_ENABLED:
+    os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', os.path.join(worker_tmp_dir, 'cloudapi_metrics'))
+    os.makedirs(os.environ['PROMETHEUS_MULTIPROC_DIR'], exist_ok=True)
+
+def on_starting(server):
+    # Xóa file metric của lần chạy trước (counter không được cộng dồn qua các lần restart)
+    if METRICS_ENABLED:
+        metrics_dir = os.environ['PROMETHEUS_MULTIPROC_DIR']
+        for filename in os.listdir(metrics_dir):
+            if filename.endswith('.db'):
+                os.remove(os.path.join(metrics_dir, filename))
+
 # Health check endpoint
 def when_ready(server):
     server.log.info("Server is ready. Spawning workers")
@@ -61,9 +76,22 @@ def pre_fork(server, worker):
 
 def post_fork(server, worker):
     server.log.info("Worker spawned (pid: %s)", worker.pid)
+    # PostgreSQL + gevent: psycopg2 phải nhường hub khi chờ DB, nếu không cả worker bị block
+    if worker_class == 'gevent' and os.environ.get('DATABASE_URL', '').startswith(('postgres://', 'postgresql://')):
+        try:
+            from psycogreen.gevent import patch_psycopg
+            patch_psycopg()
+        except ImportError:
+            server.log.warning("psycogreen chưa được cài, truy vấn PostgreSQL sẽ block gevent worker")
 
 def post_worker_init(worker):
     worker.log.info("Worker initialized (pid: %s)", worker.pid)
 
 def worker_abort(worker):
     worker.log.info("Worker aborted (pid: %s)", worker.pid)
+
+def child_exit(server, worker):
+    # Gauge hàng đợi (livesum) của worker đã thoát không còn được cộng vào /metrics
+    if METRICS_ENABLED:
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
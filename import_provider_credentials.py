@@ -0,0 +1,42 @@
+"""Import provider API keys from txt files into the provider_credentials table.
+
+    python import_provider_credentials.py                       # gemini_key_tm.txt, suno_key.txt, expired_keys.txt
+    python import_provider_credentials.py --provider gemini --file new_keys.txt
+    python import_provider_credentials.py --provider suno --file old.txt --state exhausted
+
+Safe to run again: keys that already exist for the provider are skipped (their state is kept).
+"""
+import argparse
+import sys
+from utils.provider_credentials import provider_credentials, read_secrets_file, LEGACY_FILES, STATES
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import provider keys (one per line) into provider_credentials")
+    parser.add_argument("--provider", help="gemini, suno, ... (default: every provider in LEGACY_FILES)")
+    parser.add_argument("--file", help="Key file to import (default: the provider's legacy txt files)")
+    parser.add_argument("--state", default="active", choices=STATES, help="State of imported keys (with --file)")
+    args = parser.parse_args()
+
+    if args.file and not args.provider:
+        print("❌ --file cần đi kèm --provider")
+        return 1
+
+    if args.file:
+        sources = [(args.provider, args.file, args.state)]
+    else:
+        providers = [args.provider] if args.provider else list(LEGACY_FILES)
+        sources = [(provider, path, state) for provider in providers for path, state in LEGACY_FILES.get(provider, ())]
+
+    for provider, path, state in sources:
+        secrets = read_secrets_file(path)
+        if secrets is None:
+            print(f"⏭️  {provider}: không có file {path}")
+            continue
+        inserted = provider_credentials.import_secrets(provider, secrets, state)
+        print(f"✅ {provider} ({state}): {len(secrets)} key trong {path}, thêm mới {inserted}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
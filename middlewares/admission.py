@@ -0,0 +1,42 @@
+import time
+from functools import wraps
+from flask import request, jsonify, make_response
+from config import ADMISSION_ENABLED
+from services.key_service_wrapper import get_key_info
+from utils.admission import admission_controller, lane_for_key, AdmissionRejected
+
+
+def require_admission(module):
+    """Limit in-flight generation requests of a module (see utils.admission)"""
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            gate = admission_controller.gate(module)
+            if not ADMISSION_ENABLED or gate is None:
+                return f(*args, **kwargs)
+
+            def resolve_lane():
+                # Chỉ đọc key khi phải xếp hàng
+                source = request.args if request.method == "GET" else request.form
+                key = source.get("key", "").strip()
+                return lane_for_key(get_key_info(key, module=module) if key else None)
+
+            try:
+                gate.acquire(resolve_lane)
+            except AdmissionRejected as e:
+                response = jsonify(success=False, message="⏳ Hệ thống đang quá tải, vui lòng thử lại sau")
+                response.status_code = 503
+                response.headers["Retry-After"] = str(e.retry_after)
+                return response
+
+            started = time.monotonic()
+            try:
+                response = make_response(f(*args, **kwargs))
+            except Exception:
+                gate.release(time.monotonic() - started)
+                raise
+            # Trả slot khi response gửi xong (kể cả response streaming)
+            response.call_on_close(lambda: gate.release(time.monotonic() - started))
+            return response
+        return decorated_function
+    return decorator
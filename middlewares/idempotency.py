@@ -0,0 +1,120 @@
+import hashlib
+import json
+import time
+from functools import wraps
+from flask import request, jsonify, make_response, Response
+from config import (
+    IDEMPOTENCY_TTL, IDEMPOTENCY_WAIT_TIMEOUT, IDEMPOTENCY_PENDING_TIMEOUT,
+    IDEMPOTENCY_PURGE_INTERVAL, IDEMPOTENCY_MAX_KEY_LENGTH
+)
+from database import db_manager
+
+# Idempotency-Key cho endpoint trừ lượt (/create, /use). Client gửi header Idempotency-Key (hoặc field
+# idempotency_key); retry cùng key + cùng tham số trong IDEMPOTENCY_TTL nhận lại đúng response lần đầu
+# mà không qua auth / trừ lượt / gọi upstream. Request trùng tới khi lần đầu chưa xong thì chờ lần đầu.
+# Chỉ lưu response thành công: request lỗi không trừ lượt nên retry được chạy lại bình thường.
+
+IDEMPOTENCY_HEADER = "Idempotency-Key"
+IDEMPOTENCY_FIELD = "idempotency_key"
+
+_last_purge = 0.0
+
+
+def _params():
+    return request.args if request.method == "GET" else request.form
+
+
+def _request_hash():
+    items = sorted((name, value) for name, value in _params().items(multi=True) if name != IDEMPOTENCY_FIELD)
+    payload = json.dumps([request.method, request.path, items], ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def _replay(record):
+    response = Response(record["response_body"], status=record["status_code"], content_type=record["content_type"])
+    response.headers["Idempotent-Replayed"] = "true"
+    return response
+
+
+def _is_final(response):
+    if not 200 <= response.status_code < 300 or response.is_streamed or not response.is_json:
+        return False
+    body = response.get_json(silent=True)
+    return isinstance(body, dict) and body.get("success") is not False
+
+
+def _maybe_purge(now):
+    global _last_purge
+    if now - _last_purge < IDEMPOTENCY_PURGE_INTERVAL:
+        return
+    _last_purge = now
+    try:
+        db_manager.purge_idempotency_records(now)
+    except Exception as e:
+        print(f"⚠️ Lỗi xóa idempotency record hết hạn: {e}")
+
+
+def _claim(scope, idempotency_key, request_hash):
+    now = time.time()
+    return db_manager.claim_idempotency_key(
+        scope, idempotency_key, request_hash, now, IDEMPOTENCY_TTL, now - IDEMPOTENCY_PENDING_TIMEOUT
+    )
+
+
+def idempotent(module):
+    """Replay the stored response of a request retried with the same Idempotency-Key"""
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            idempotency_key = (request.headers.get(IDEMPOTENCY_HEADER) or _params().get(IDEMPOTENCY_FIELD, "")).strip()
+            key = _params().get("key", "").strip()
+            if not idempotency_key or not key:
+                return f(*args, **kwargs)
+            if len(idempotency_key) > IDEMPOTENCY_MAX_KEY_LENGTH:
+                return jsonify(success=False, message="❌ Idempotency-Key quá dài"), 400
+
+            scope = f"{module}:{request.path}:{key}"
+            request_hash = _request_hash()
+            deadline = time.time() + IDEMPOTENCY_WAIT_TIMEOUT
+            delay = 0.05
+
+            record = _claim(scope, idempotency_key, request_hash)
+            while record is not None:
+                if record["request_hash"] != request_hash:
+                    return jsonify(success=False, message="❌ Idempotency-Key đã được dùng cho request khác"), 422
+                if record["state"] == "done":
+                    return _replay(record)
+
+                # Request đầu đang chạy: chờ nó xong (hoặc bỏ key khi lỗi)
+                now = time.time()
+                if now >= deadline:
+                    response = jsonify(success=False, message="⏳ Request cùng Idempotency-Key đang được xử lý, vui lòng thử lại sau")
+                    response.status_code = 409
+                    response.headers["Retry-After"] = "5"
+                    return response
+                time.sleep(min(delay, deadline - now))
+                delay = min(delay * 2, 1.0)
+
+                record = db_manager.get_idempotency_record(scope, idempotency_key)
+                now = time.time()
+                if (record is None or record["expires_at"] <= now
+                        or (record["state"] == "pending" and record["created_at"] < now - IDEMPOTENCY_PENDING_TIMEOUT)):
+                    record = _claim(scope, idempotency_key, request_hash)
+
+            try:
+                response = make_response(f(*args, **kwargs))
+            except Exception:
+                db_manager.release_idempotency_key(scope, idempotency_key, request_hash)
+                raise
+
+            if _is_final(response):
+                db_manager.complete_idempotency_key(
+                    scope, idempotency_key, request_hash,
+                    response.status_code, response.content_type, response.get_data(as_text=True)
+                )
+            else:
+                db_manager.release_idempotency_key(scope, idempotency_key, request_hash)
+            _maybe_purge(time.time())
+            return response
+        return decorated_function
+    return decorator
@@ -2,6 +2,14 @@ from flask import Blueprint, render_template, request, jsonify, redirect, url_fo
 from database import db_manager
 from datetime import datetime
 from middlewares.admin_auth import require_admin_login, admin_login_required
+from utils.performance_monitor import performance_monitor
+from services.media_gc_service import run_media_gc, get_media_gc_report
+from utils.shared_cache import shared_cache
+from utils.provider_registry import provider_registry
+from utils.admission import admission_controller
+from utils.tracing import tracer
+from utils.provider_credentials import provider_credentials, STATES as PROVIDER_CREDENTIAL_STATES
+from config import ADMISSION_LANE_WEIGHTS
 import json
 
 admin_bp = Blueprint('admin', __name__, url_prefix='/admin')
@@ -138,6 +146,7 @@ def add_key():
         max_usage = data.get('max_usage')
         usage_count = data.get('usage_count', 0)
         note = (data.get('note') or '').strip()
+        priority = (data.get('priority') or '').strip() or None
         
         # Validation
         if not key:
@@ -146,6 +155,9 @@ def add_key():
         if module not in AVAILABLE_MODULES:
             return jsonify({'success': False, 'message': 'Module không hợp lệ'})
         
+        if priority and priority not in ADMISSION_LANE_WEIGHTS:
+            return jsonify({'success': False, 'message': 'Mức ưu tiên không hợp lệ'})
+        
         if max_usage:
             try:
                 max_usage = int(max_usage)
@@ -171,7 +183,8 @@ def add_key():
             expires=expires,
             max_usage=max_usage,
             usage_count=usage_count,
-            note=note
+            note=note,
+            priority=priority
         )
         
         if success:
@@ -187,14 +200,16 @@ def add_key():
                     'status': status,
                     'expires': expires,
                     'max_usage': max_usage,
-                    'usage_count': usage_count
+                    'usage_count': usage_count,
+                    'priority': priority
                 }
             )
             return jsonify({'success': True, 'message': 'Thêm key thành công'})
         else:
             return jsonify({'success': False, 'message': 'Key đã tồn tại'})
     
-    return render_template('admin/add_key.html', modules=AVAILABLE_MODULES)
+    return render_template('admin/add_key.html', modules=AVAILABLE_MODULES,
+                           priorities=list(ADMISSION_LANE_WEIGHTS))
 
 @admin_bp.route('/keys/<module>/<key>/edit', methods=['GET', 'POST'])
 @require_admin_login
@@ -212,8 +227,12 @@ def edit_key(module, key):
         max_usage = data.get('max_usage')
         usage_count = data.get('usage_count', 0)
         note = (data.get('note') or '').strip() or None
+        priority = (data.get('priority') or '').strip() or None
         
         # Validation
+        if priority and priority not in ADMISSION_LANE_WEIGHTS:
+            return jsonify({'success': False, 'message': 'Mức ưu tiên không hợp lệ'})
+        
         if max_usage:
             try:
                 max_usage = int(max_usage)
@@ -239,7 +258,8 @@ def edit_key(module, key):
             expires=expires,
             max_usage=max_usage,
             usage_count=usage_count,
-            note=note
+            note=note,
+            priority=priority
         )
         
         if success:
@@ -255,7 +275,8 @@ def edit_key(module, key):
                     'expires': expires,
                     'max_usage': max_usage,
                     'usage_count': usage_count,
-                    'note': note
+                    'note': note,
+                    'priority': priority
                 }
             )
             return jsonify({'success': True, 'message': 'Cập nhật key thành công'})
@@ -267,7 +288,8 @@ def edit_key(module, key):
     if not key_info:
         return jsonify({'success': False, 'message': 'Key không tồn tại'})
     
-    return render_template('admin/edit_key.html', key_info=key_info, modules=AVAILABLE_MODULES)
+    return render_template('admin/edit_key.html', key_info=key_info, modules=AVAILABLE_MODULES,
+                           priorities=list(ADMISSION_LANE_WEIGHTS))
 
 @admin_bp.route('/keys/<module>/<key>/delete', methods=['POST'])
 @require_admin_login
@@ -680,6 +702,99 @@ def api_api_usage_stats():
     stats = db_manager.get_api_usage_stats()
     return jsonify({'success': True, 'data': stats})
 
+@admin_bp.route('/api/performance')
+@admin_login_required
+def api_performance():
+    """API endpoint để lấy thống kê hiệu năng của worker (encode, cache, ...)"""
+    return jsonify({'success': True, 'data': performance_monitor.get_performance_stats()})
+
+@admin_bp.route('/api/media-gc')
+@admin_login_required
+def api_media_gc_report():
+    """API endpoint để xem báo cáo lần dọn media (voice/image) gần nhất"""
+    return jsonify({'success': True, 'data': get_media_gc_report()})
+
+@admin_bp.route('/api/media-gc/run', methods=['POST'])
+@admin_login_required
+def api_media_gc_run():
+    """API endpoint để chạy dọn media ngay (mặc định dry-run, không xóa gì)"""
+    try:
+        data = request.get_json(silent=True) or {}
+        dry_run = data.get('dry_run', True) not in (False, 'false', '0', 0)
+        
+        report = run_media_gc(dry_run=dry_run)
+        
+        if not dry_run:
+            log_activity(
+                action='MEDIA_GC',
+                old_values={module: {
+                    'expired_files': stats['expired_files'],
+                    'quota_files': stats['quota_files']
+                } for module, stats in report['modules'].items()}
+            )
+        
+        return jsonify({'success': True, 'data': report})
+        
+    except Exception as e:
+        return jsonify({'success': False, 'message': f'Lỗi khi dọn media: {str(e)}'})
+
+@admin_bp.route('/api/cache')
+@admin_login_required
+def api_cache_stats():
+    """API endpoint để xem hit/miss của shared cache (key provider, proxy) trên worker này"""
+    return jsonify({'success': True, 'data': shared_cache.get_stats()})
+
+@admin_bp.route('/api/providers')
+@admin_login_required
+def api_provider_files():
+    """API endpoint để xem file proxy đang được nạp trên worker này"""
+    return jsonify({'success': True, 'data': provider_registry.get_status()})
+
+@admin_bp.route('/api/admission')
+@admin_login_required
+def api_admission_stats():
+    """API endpoint để xem request đang chạy / đang chờ, thời gian chờ theo lane ưu tiên và số lần từ chối (503) theo module trên worker này"""
+    return jsonify({'success': True, 'data': admission_controller.get_stats()})
+
+@admin_bp.route('/api/provider-credentials')
+@admin_login_required
+def api_provider_credentials():
+    """API endpoint để xem key Gemini/Suno trong provider_credentials (state, credit, lỗi cuối, cooldown)"""
+    return jsonify({'success': True, 'data': provider_credentials.get_status()})
+
+@admin_bp.route('/api/provider-credentials/<int:credential_id>/state', methods=['POST'])
+@admin_login_required
+def api_provider_credential_state(credential_id):
+    """API endpoint để bật lại / tắt một key provider (active, exhausted, disabled)"""
+    data = request.get_json(silent=True) or request.form
+    state = (data.get('state') or '').strip()
+    if state not in PROVIDER_CREDENTIAL_STATES:
+        return jsonify({'success': False, 'message': f"State không hợp lệ (chọn {', '.join(PROVIDER_CREDENTIAL_STATES)})"}), 400
+
+    changed = provider_credentials.set_state_by_id(credential_id, state)
+    if changed is None:
+        return jsonify({'success': False, 'message': 'Không tìm thấy credential'}), 404
+    if changed:
+        log_activity(action='UPDATE_PROVIDER_CREDENTIAL', new_values={'id': credential_id, 'state': state})
+    return jsonify({'success': True, 'data': {'id': credential_id, 'state': state, 'changed': changed}})
+
+@admin_bp.route('/api/tracing')
+@admin_login_required
+def api_tracing_stats():
+    """API endpoint để xem cấu hình tracing và số span đã export / bị bỏ trên worker này"""
+    return jsonify({'success': True, 'data': tracer.get_stats()})
+
+@admin_bp.route('/api/cache/clear', methods=['POST'])
+@admin_login_required
+def api_cache_clear():
+    """API endpoint để xóa shared cache (sau khi sửa file key/proxy)"""
+    try:
+        shared_cache.clear()
+        log_activity(action='CLEAR_CACHE')
+        return jsonify({'success': True, 'message': 'Đã xóa shared cache'})
+    except Exception as e:
+        return jsonify({'success': False, 'message': f'Lỗi khi xóa cache: {str(e)}'})
+
 @admin_bp.route('/keys/export-excel')
 @admin_login_required
 def export_keys_excel():
@@ -1,4 +1,12 @@
-from flask import Blueprint, jsonify, send_file, send_from_directory, request
+from flask import Blueprint, jsonify, send_from_directory, request, Response
+from werkzeug.exceptions import NotFound
+from config import BASE_DIR, UPLOAD_FOLDER, METRICS_ENABLED, METRICS_TOKEN
+from services.upload_service import (
+    init_upload, get_upload_status, append_chunk, finalize_upload, discard_upload
+)
+from services.key_service_wrapper import check_key_validity
+from utils.catalog import catalog_response
+from utils import metrics
 import os
 from telethon import TelegramClient
 from urllib.parse import urlparse
@@ -6,6 +14,8 @@ import asyncio
 
 misc_bp = Blueprint("misc", __name__)
 
+VERSION_FILE = os.path.join(BASE_DIR, 'version.json')
+
 api_id = 29797888
 api_hash = '3a8c11f2cd481c12f4184eddf560395f'
 
@@ -108,96 +118,112 @@ def get_clone_voice_keys():
         return jsonify({"error": str(e)}), 500
 
 
+GEMINI_LANGUAGES = [
+    {"name": "Vietnam", "code": "vi"},
+    {"name": "English", "code": "en"},
+    {"name": "Spanish", "code": "es"},
+    {"name": "French", "code": "fr"},
+    {"name": "German", "code": "de"},
+    {"name": "Italian", "code": "it"},
+    {"name": "Portuguese", "code": "pt"},
+    {"name": "Dutch", "code": "nl"},
+    {"name": "Russian", "code": "ru"},
+    {"name": "Polish", "code": "pl"},
+    {"name": "Ukrainian", "code": "uk"},
+    {"name": "Chinese (Simplified)", "code": "zh"},
+    {"name": "Chinese (Traditional)", "code": "zh-TW"},
+    {"name": "Japanese", "code": "ja"},
+    {"name": "Korean", "code": "ko"},
+    {"name": "Arabic", "code": "ar"},
+    {"name": "Hindi", "code": "hi"},
+    {"name": "Bengali", "code": "bn"},
+    {"name": "Turkish", "code": "tr"},
+    {"name": "Greek", "code": "el"},
+    {"name": "Czech", "code": "cs"},
+    {"name": "Romanian", "code": "ro"},
+    {"name": "Hungarian", "code": "hu"},
+    {"name": "Finnish", "code": "fi"},
+    {"name": "Swedish", "code": "sv"},
+    {"name": "Danish", "code": "da"},
+    {"name": "Norwegian", "code": "no"},
+    {"name": "Thai", "code": "th"},
+    {"name": "Vietnamese", "code": "vi"},
+    {"name": "Indonesian", "code": "id"},
+    {"name": "Malay", "code": "ms"},
+    {"name": "Tamil", "code": "ta"},
+    {"name": "Telugu", "code": "te"},
+    {"name": "Marathi", "code": "mr"},
+    {"name": "Punjabi", "code": "pa"},
+    {"name": "Gujarati", "code": "gu"},
+    {"name": "Burmese", "code": "my"},
+    {"name": "Filipino (Tagalog)", "code": "tl"},
+    {"name": "Urdu", "code": "ur"},
+    {"name": "Persian", "code": "fa"},
+    {"name": "Hebrew", "code": "he"},
+    {"name": "Swahili", "code": "sw"},
+    {"name": "Catalan", "code": "ca"},
+    {"name": "Basque", "code": "eu"},
+    {"name": "Serbian", "code": "sr"},
+    {"name": "Croatian", "code": "hr"},
+    {"name": "Slovak", "code": "sk"},
+    {"name": "Slovenian", "code": "sl"},
+    {"name": "Bulgarian", "code": "bg"},
+    {"name": "Lithuanian", "code": "lt"},
+    {"name": "Latvian", "code": "lv"},
+    {"name": "Estonian", "code": "et"},
+    {"name": "Macedonian", "code": "mk"},
+    {"name": "Albanian", "code": "sq"},
+    {"name": "Belarusian", "code": "be"},
+    {"name": "Icelandic", "code": "is"},
+    {"name": "Georgian", "code": "ka"},
+    {"name": "Armenian", "code": "hy"},
+    {"name": "Malayalam", "code": "ml"},
+    {"name": "Sinhalese", "code": "si"},
+    {"name": "Khmer", "code": "km"},
+    {"name": "Lao", "code": "lo"},
+    {"name": "Mongolian", "code": "mn"},
+    {"name": "Tajik", "code": "tg"},
+    {"name": "Pashto", "code": "ps"},
+    {"name": "Amharic", "code": "am"},
+    {"name": "Haitian Creole", "code": "ht"},
+    {"name": "Yoruba", "code": "yo"},
+    {"name": "Igbo", "code": "ig"},
+    {"name": "Zulu", "code": "zu"},
+    {"name": "Quechua", "code": "qu"},
+    {"name": "Azerbaijani", "code": "az"},
+    {"name": "Uzbek", "code": "uz"},
+    {"name": "Kazakh", "code": "kk"},
+    {"name": "Hmong", "code": "hmn"},
+    {"name": "Somali", "code": "so"},
+    {"name": "Nepali", "code": "ne"},
+    {"name": "Tigrinya", "code": "ti"}
+]
+
 @misc_bp.route("/api/get_gemini_languages", methods=["GET"])
 def get_gemini_languages():
-    return jsonify({
-        "languages": [
-            {"name": "Vietnam", "code": "vi"},
-            {"name": "English", "code": "en"},
-            {"name": "Spanish", "code": "es"},
-            {"name": "French", "code": "fr"},
-            {"name": "German", "code": "de"},
-            {"name": "Italian", "code": "it"},
-            {"name": "Portuguese", "code": "pt"},
-            {"name": "Dutch", "code": "nl"},
-            {"name": "Russian", "code": "ru"},
-            {"name": "Polish", "code": "pl"},
-            {"name": "Ukrainian", "code": "uk"},
-            {"name": "Chinese (Simplified)", "code": "zh"},
-            {"name": "Chinese (Traditional)", "code": "zh-TW"},
-            {"name": "Japanese", "code": "ja"},
-            {"name": "Korean", "code": "ko"},
-            {"name": "Arabic", "code": "ar"},
-            {"name": "Hindi", "code": "hi"},
-            {"name": "Bengali", "code": "bn"},
-            {"name": "Turkish", "code": "tr"},
-            {"name": "Greek", "code": "el"},
-            {"name": "Czech", "code": "cs"},
-            {"name": "Romanian", "code": "ro"},
-            {"name": "Hungarian", "code": "hu"},
-            {"name": "Finnish", "code": "fi"},
-            {"name": "Swedish", "code": "sv"},
-            {"name": "Danish", "code": "da"},
-            {"name": "Norwegian", "code": "no"},
-            {"name": "Thai", "code": "th"},
-            {"name": "Vietnamese", "code": "vi"},
-            {"name": "Indonesian", "code": "id"},
-            {"name": "Malay", "code": "ms"},
-            {"name": "Tamil", "code": "ta"},
-            {"name": "Telugu", "code": "te"},
-            {"name": "Marathi", "code": "mr"},
-            {"name": "Punjabi", "code": "pa"},
-            {"name": "Gujarati", "code": "gu"},
-            {"name": "Burmese", "code": "my"},
-            {"name": "Filipino (Tagalog)", "code": "tl"},
-            {"name": "Urdu", "code": "ur"},
-            {"name": "Persian", "code": "fa"},
-            {"name": "Hebrew", "code": "he"},
-            {"name": "Swahili", "code": "sw"},
-            {"name": "Catalan", "code": "ca"},
-            {"name": "Basque", "code": "eu"},
-            {"name": "Serbian", "code": "sr"},
-            {"name": "Croatian", "code": "hr"},
-            {"name": "Slovak", "code": "sk"},
-            {"name": "Slovenian", "code": "sl"},
-            {"name": "Bulgarian", "code": "bg"},
-            {"name": "Lithuanian", "code": "lt"},
-            {"name": "Latvian", "code": "lv"},
-            {"name": "Estonian", "code": "et"},
-            {"name": "Macedonian", "code": "mk"},
-            {"name": "Albanian", "code": "sq"},
-            {"name": "Belarusian", "code": "be"},
-            {"name": "Icelandic", "code": "is"},
-            {"name": "Georgian", "code": "ka"},
-            {"name": "Armenian", "code": "hy"},
-            {"name": "Malayalam", "code": "ml"},
-            {"name": "Sinhalese", "code": "si"},
-            {"name": "Khmer", "code": "km"},
-            {"name": "Lao", "code": "lo"},
-            {"name": "Mongolian", "code": "mn"},
-            {"name": "Tajik", "code": "tg"},
-            {"name": "Pashto", "code": "ps"},
-            {"name": "Amharic", "code": "am"},
-            {"name": "Haitian Creole", "code": "ht"},
-            {"name": "Yoruba", "code": "yo"},
-            {"name": "Igbo", "code": "ig"},
-            {"name": "Zulu", "code": "zu"},
-            {"name": "Quechua", "code": "qu"},
-            {"name": "Azerbaijani", "code": "az"},
-            {"name": "Uzbek", "code": "uz"},
-            {"name": "Kazakh", "code": "kk"},
-            {"name": "Hmong", "code": "hmn"},
-            {"name": "Somali", "code": "so"},
-            {"name": "Nepali", "code": "ne"},
-            {"name": "Tigrinya", "code": "ti"}
-        ]
-    })
+    return catalog_response("gemini_languages", lambda: {"languages": GEMINI_LANGUAGES})
 
 
+def _read_version_file():
+    try:
+        with open(VERSION_FILE, 'rb') as f:
+            return f.read()
+    except FileNotFoundError:
+        raise NotFound()
 
 @misc_bp.route('/api/version.json')
 def get_version():
-    return send_file('version.json', mimetype='application/json')
+    return catalog_response("version", _read_version_file, sources=[VERSION_FILE])
+
+# ✅ Prometheus scrape (gộp mọi worker gunicorn, xem utils.metrics)
+@misc_bp.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    if not METRICS_ENABLED:
+        return jsonify({"error": "Metrics chưa được bật (METRICS_ENABLED=true)"}), 404
+    if METRICS_TOKEN and request.headers.get("Authorization", "") != f"Bearer {METRICS_TOKEN}":
+        return jsonify({"error": "Unauthorized"}), 401
+    body, content_type = metrics.render()
+    return Response(body, content_type=content_type)
 
 @misc_bp.route('/downloads/<filename>')
 def download_file(filename):
@@ -205,7 +231,6 @@ def download_file(filename):
     return send_from_directory(directory=download_folder, path=filename, as_attachment=True)
 
 
-UPLOAD_FOLDER = os.path.join(os.getcwd(), 'uploads')
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 @misc_bp.route('/api/upload', methods=['POST'])
 def upload_file():
@@ -222,4 +247,56 @@ def upload_file():
         file.save(save_path)
         return jsonify({"message": f"Upload thành công file: {file.filename}"}), 200
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
\ No newline at end of file
+        return jsonify({"error": str(e)}), 500
+
+
+# ✅ Upload resumable: POST /init -> PATCH /<id> (header Upload-Offset) -> POST /<id>/finalize
+def _upload_response(result, success_status=200):
+    if not result.get("success"):
+        body = {"error": result["message"]}
+        if "offset" in result:
+            body["offset"] = result["offset"]
+        response = jsonify(body)
+        response.status_code = result["status"]
+    else:
+        response = jsonify({k: v for k, v in result.items() if k != "success"})
+        response.status_code = success_status
+    if "offset" in result:
+        response.headers["Upload-Offset"] = str(result["offset"])
+    return response
+
+@misc_bp.route('/api/upload/init', methods=['POST'])
+def upload_init():
+    data = request.get_json(silent=True) or request.form
+    # Upload resumable tới UPLOAD_MAX_MB: chỉ key hợp lệ mới được mở, tối đa UPLOAD_MAX_OPEN_PER_KEY upload cùng lúc
+    key = str(data.get("key") or "").strip()
+    device_id = str(data.get("device_id") or "").strip()
+    if not key or not device_id:
+        return jsonify({"error": "🔒 Thiếu trường key hoặc device_id"}), 400
+    is_valid, msg, _, _ = check_key_validity(key, device_id)
+    if not is_valid:
+        return jsonify({"error": msg}), 403
+    result = init_upload(data.get("filename"), data.get("size"), data.get("sha256"), owner=key)
+    return _upload_response(result, 201)
+
+@misc_bp.route('/api/upload/<upload_id>', methods=['GET', 'HEAD'])
+def upload_status(upload_id):
+    return _upload_response(get_upload_status(upload_id))
+
+@misc_bp.route('/api/upload/<upload_id>', methods=['PATCH'])
+def upload_chunk(upload_id):
+    offset = request.headers.get("Upload-Offset", request.args.get("offset"))
+    return _upload_response(append_chunk(upload_id, offset, request.stream))
+
+@misc_bp.route('/api/upload/<upload_id>', methods=['DELETE'])
+def upload_cancel(upload_id):
+    discard_upload(upload_id)
+    return "", 204
+
+@misc_bp.route('/api/upload/<upload_id>/finalize', methods=['POST'])
+def upload_finalize(upload_id):
+    data = request.get_json(silent=True) or request.form
+    result = finalize_upload(upload_id, data.get("sha256"))
+    if result.get("success"):
+        result["message"] = f"Upload thành công file: {result['filename']}"
+    return _upload_response(result)
@@ -3,10 +3,12 @@ import time  # <- bổ sung
 
 from config import PROXIES_FILE
 from utils.file_utils import load_proxies
+from database import db_manager
 from services.key_service_wrapper import update_usage_count_by
 from utils.ausynclab import (
     create_clone_voice_tts,
     get_voice_list as ausync_get_voice_list,
+    delete_voice as ausync_delete_voice,
     text_to_speech as ausync_text_to_speech,
     get_audio_list as ausync_get_audio_list,
     get_audio_detail as ausync_get_audio_detail,
@@ -15,7 +17,17 @@ from utils.ausynclab import (
 def _get_proxies():
     return load_proxies(PROXIES_FILE)
 
-def create_clone_voice(voice_name, language, gender, age, audio_file_path, key, device_id=None):
+def create_clone_voice(voice_name, language, gender, age, audio_file_path, key, device_id=None, audio_sha256=None):
+    """
+    Đăng ký clone voice trên AusyncLab.
+    - Cùng key + cùng sample (sha256) + cùng name/language/gender/age -> trả voice đã có, không gọi API.
+    """
+    if audio_sha256:
+        existing = db_manager.get_clone_voice(key, audio_sha256, voice_name, language, gender, age)
+        if existing:
+            print(f"♻️ Dùng lại voice_id={existing['voice_id']} (sample đã đăng ký)")
+            return {"success": True, "voice_id": existing["voice_id"], "data": existing["detail"], "cached": True}
+
     result = create_clone_voice_tts(
         voice_name=voice_name,
         language=language,
@@ -25,11 +37,29 @@ def create_clone_voice(voice_name, language, gender, age, audio_file_path, key,
         key=key,
         proxies=_get_proxies()
     )
+
+    # Chỉ lưu khi có đủ chi tiết voice, để lần sau trả về giống hệt lần đầu
+    if audio_sha256 and result.get("success") and result.get("detail_loaded"):
+        db_manager.add_clone_voice(
+            key, audio_sha256, voice_name, language, gender, age, result["voice_id"], result["data"]
+        )
     return result
 
 def get_voice_list(key):
     result = ausync_get_voice_list(key, proxies=_get_proxies())
-    return result["data"] if result.get("success") else []
+    if not result.get("success"):
+        return []
+
+    # Voice bị xóa trực tiếp trên AusyncLab -> bỏ khỏi registry
+    voices = result["data"] or []
+    db_manager.prune_clone_voices(key, [voice.get("id") for voice in voices if isinstance(voice, dict)])
+    return voices
+
+def delete_clone_voice(voice_id, key):
+    result = ausync_delete_voice(voice_id, key, proxies=_get_proxies())
+    if result.get("success"):
+        db_manager.delete_clone_voice(key, voice_id)
+    return result
 
 def get_detail_audio(audio_id, key):
     result = ausync_get_audio_detail(audio_id, key, proxies=_get_proxies())
@@ -1,37 +1,22 @@
+import asyncio
 import os
-from config import IMAGE_OUTPUT_DIR, GEMINI_KEYS_FILE, PROXIES_FILE
-from services.key_service_wrapper import update_usage_count, get_key_status, get_key_info, parse_int
-from utils.file_utils import create_unique_output_dir, load_proxies
-from utils.gemini_client import gemini_image_request
+from config import IMAGE_OUTPUT_DIR, PROXIES_FILE
+from services.key_service_wrapper import (
+    update_usage_count, update_usage_count_by, refund_usage_count,
+    get_key_status, get_key_info, parse_int
+)
+from utils.file_utils import load_proxies
+from utils.provider_credentials import provider_credentials
+from utils.media_store import create_staging_dir, discard_staging_dir, store_media
+from utils.gemini_client import gemini_image_request, gemini_image_variants
+from utils.async_upstream import gemini_image_request_async, gemini_image_variants_async
+from utils.image_transcoder import enqueue_image_derivatives
 import time
 
-# Performance optimizations
-_api_keys_cache = {}
-_api_keys_cache_timestamp = {}
-API_KEYS_CACHE_TTL = 300  # Cache API keys for 5 minutes
-
 def load_gemini_keys():
-    """Load Gemini API keys with caching"""
-    current_time = time.time()
-    
-    # Check if cache is valid
-    if (GEMINI_KEYS_FILE in _api_keys_cache and 
-        current_time - _api_keys_cache_timestamp.get(GEMINI_KEYS_FILE, 0) < API_KEYS_CACHE_TTL):
-        return _api_keys_cache[GEMINI_KEYS_FILE]
-    
-    # Load fresh keys
-    if not os.path.exists(GEMINI_KEYS_FILE):
-        return []
-    
+    """Active Gemini API keys from provider_credentials (cached across workers)"""
     try:
-        with open(GEMINI_KEYS_FILE, 'r', encoding='utf-8') as f:
-            keys = [l.strip() for l in f if l.strip()]
-        
-        # Cache the result
-        _api_keys_cache[GEMINI_KEYS_FILE] = keys
-        _api_keys_cache_timestamp[GEMINI_KEYS_FILE] = current_time
-        
-        return keys
+        return provider_credentials.secrets("gemini")
     except Exception as e:
         print(f"Error loading Gemini keys: {e}")
         return []
@@ -50,33 +35,66 @@ def generate_extra_prompt(ratio):
     )
     return f"{base_prompts.get(ratio, '')}, {quality_prompt}"
 
+def _prepare_upstream():
+    """(api_keys, staging dir, proxies) for one request; (None, None, None) without Gemini keys.
+
+    DB query + makedirs + proxy file: the async paths run this in a thread, off the shared upstream loop.
+    """
+    api_keys = load_gemini_keys()
+    if not api_keys:
+        return None, None, None
+    return api_keys, create_staging_dir(IMAGE_OUTPUT_DIR), load_proxies(PROXIES_FILE)
+
+def _finish_image(key, device_id, image_path):
+    """Store the generated image and charge one usage; returns (filename, message)"""
+    filename, object_path = store_media(IMAGE_OUTPUT_DIR, "image", image_path)
+    enqueue_image_derivatives(object_path)
+
+    # Update usage count
+    update_usage_count(key, device_id, module="image")
+    
+    # Get key info for message
+    info = get_key_info(key, module="image")
+    usage_count = parse_int(info.get('usage_count')) if info else None
+    max_usage = parse_int(info.get('max_usage')) if info else None
+
+    return filename, f"🖼️ Đã tạo ảnh ({usage_count}/{max_usage if max_usage else '∞'})"
+
 def create_image(text, key, device_id, ratio="1:1"):
     """Create image with improved performance"""
     api_keys = load_gemini_keys()
     if not api_keys:
         return {"success": False, "message": "No Gemini API key configured"}
 
+    output_dir = create_staging_dir(IMAGE_OUTPUT_DIR)
     try:
-        prompt = text.strip()
-        extra_prompt = generate_extra_prompt(ratio)
-        if extra_prompt:
-            prompt = f"{prompt}, {extra_prompt}"
+        prompt = build_image_prompt(text, ratio)
 
-        output_dir = create_unique_output_dir(IMAGE_OUTPUT_DIR)
         proxies = load_proxies(PROXIES_FILE)
         image_path = gemini_image_request(prompt, output_dir, api_keys, proxies)
-
-        # Update usage count
-        update_usage_count(key, device_id, module="image")
-        
-        filename = os.path.relpath(image_path, IMAGE_OUTPUT_DIR).replace("\\", "/")
+        filename, message = _finish_image(key, device_id, image_path)
+        return {
+            "success": True,
+            "message": message,
+            "filename": filename
+        }
         
-        # Get key info for message
-        info = get_key_info(key, module="image")
-        usage_count = parse_int(info.get('usage_count')) if info else None
-        max_usage = parse_int(info.get('max_usage')) if info else None
+    except Exception as e:
+        discard_staging_dir(output_dir)
+        return {"success": False, "message": f"Lỗi tạo ảnh: {e}"}
+
+async def create_image_async(text, key, device_id, ratio="1:1"):
+    """create_image for async views: the Gemini call runs on the upstream event loop"""
+    # Mọi việc chặn (DB, file) chạy trong thread: loop upstream dùng chung cho mọi request của worker
+    api_keys, output_dir, proxies = await asyncio.to_thread(_prepare_upstream)
+    if not api_keys:
+        return {"success": False, "message": "No Gemini API key configured"}
+
+    try:
+        prompt = build_image_prompt(text, ratio)
 
-        message = f"🖼️ Đã tạo ảnh ({usage_count}/{max_usage if max_usage else '∞'})"
+        image_path = await gemini_image_request_async(prompt, output_dir, api_keys, proxies)
+        filename, message = await asyncio.to_thread(_finish_image, key, device_id, image_path)
         return {
             "success": True,
             "message": message,
@@ -84,8 +102,86 @@ def create_image(text, key, device_id, ratio="1:1"):
         }
         
     except Exception as e:
+        await asyncio.to_thread(discard_staging_dir, output_dir)
         return {"success": False, "message": f"Lỗi tạo ảnh: {e}"}
 
+def build_image_prompt(text, ratio):
+    prompt = text.strip()
+    extra_prompt = generate_extra_prompt(ratio)
+    if extra_prompt:
+        prompt = f"{prompt}, {extra_prompt}"
+    return prompt
+
+def create_image_variants(text, key, device_id, ratios):
+    """Create one image per entry of `ratios` concurrently.
+
+    All variants are charged in a single usage update up front and the failed
+    ones are refunded afterwards.
+    """
+    api_keys = load_gemini_keys()
+    if not api_keys:
+        return {"success": False, "message": "No Gemini API key configured"}
+
+    try:
+        update_usage_count_by(key, len(ratios), device_id=device_id, module="image")
+    except Exception as e:
+        return {"success": False, "message": str(e)}
+
+    output_dir = create_staging_dir(IMAGE_OUTPUT_DIR)
+    proxies = load_proxies(PROXIES_FILE)
+    prompts = [build_image_prompt(text, ratio) for ratio in ratios]
+    outcomes = gemini_image_variants(prompts, output_dir, api_keys, proxies)
+    return _finish_image_variants(key, ratios, outcomes, output_dir)
+
+async def create_image_variants_async(text, key, device_id, ratios):
+    """create_image_variants for async views"""
+    api_keys, output_dir, proxies = await asyncio.to_thread(_prepare_upstream)
+    if not api_keys:
+        return {"success": False, "message": "No Gemini API key configured"}
+
+    try:
+        await asyncio.to_thread(update_usage_count_by, key, len(ratios), device_id=device_id, module="image")
+    except Exception as e:
+        await asyncio.to_thread(discard_staging_dir, output_dir)
+        return {"success": False, "message": str(e)}
+
+    prompts = [build_image_prompt(text, ratio) for ratio in ratios]
+    outcomes = await gemini_image_variants_async(prompts, output_dir, api_keys, proxies)
+    return await asyncio.to_thread(_finish_image_variants, key, ratios, outcomes, output_dir)
+
+def _finish_image_variants(key, ratios, outcomes, output_dir):
+    """Store the generated variants and refund the failed ones"""
+    images = []
+    for ratio, outcome in zip(ratios, outcomes):
+        try:
+            if isinstance(outcome, BaseException):
+                raise outcome
+            filename, object_path = store_media(IMAGE_OUTPUT_DIR, "image", outcome)
+            enqueue_image_derivatives(object_path)
+            images.append({"ratio": ratio, "success": True, "filename": filename})
+        except Exception as e:
+            images.append({"ratio": ratio, "success": False, "message": f"Lỗi tạo ảnh: {e}"})
+    discard_staging_dir(output_dir)
+
+    failed = sum(1 for image in images if not image["success"])
+    if failed:
+        try:
+            refund_usage_count(key, failed, module="image")
+        except Exception as e:
+            print(f"❌ Không hoàn được {failed} lượt cho KEY '{key}': {e}")
+    if failed == len(images):
+        return {"success": False, "message": images[0]["message"]}
+
+    info = get_key_info(key, module="image")
+    usage_count = parse_int(info.get('usage_count')) if info else None
+    max_usage = parse_int(info.get('max_usage')) if info else None
+
+    return {
+        "success": True,
+        "message": f"🖼️ Đã tạo {len(images) - failed}/{len(images)} ảnh ({usage_count}/{max_usage if max_usage else '∞'})",
+        "images": images
+    }
+
 def use_image_key(key, device_id):
     """Use image key with error handling"""
     try:
@@ -100,6 +196,4 @@ def get_key_status_key(key, device_id):
 
 def clear_api_keys_cache():
     """Clear API keys cache"""
-    global _api_keys_cache, _api_keys_cache_timestamp
-    _api_keys_cache.clear()
-    _api_keys_cache_timestamp.clear()
+    provider_credentials.invalidate("gemini")
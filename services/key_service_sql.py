@@ -43,6 +43,10 @@ def update_usage_count_by(key: str, count: int, device_id: str = None, module: s
     
     db_manager.update_usage_count(key, device_id, module, count)
 
+def refund_usage_count(key: str, count: int, module: str = None):
+    """Hoàn lại lượt sử dụng đã trừ"""
+    db_manager.refund_usage_count(key, module, count)
+
 def get_key_status(key: str, device_id: str, module: str = None) -> Dict:
     """Lấy trạng thái key"""
     return db_manager.get_key_status(key, device_id, module)
@@ -50,9 +54,9 @@ def get_key_status(key: str, device_id: str, module: str = None) -> Dict:
 # Các hàm tiện ích để quản lý keys
 def add_key(key: str, module: str, device_id: str = None, 
             status: str = "active", expires: str = None, 
-            max_usage: int = None, usage_count: int = 0) -> bool:
+            max_usage: int = None, usage_count: int = 0, note: str = "", priority: str = None) -> bool:
     """Thêm key mới"""
-    return db_manager.add_key(key, module, device_id, status, expires, max_usage, usage_count)
+    return db_manager.add_key(key, module, device_id, status, expires, max_usage, usage_count, note, priority)
 
 def update_key(key: str, module: str, **kwargs) -> bool:
     """Cập nhật thông tin key"""
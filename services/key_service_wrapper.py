@@ -28,6 +28,7 @@ __all__ = [
 # Thêm các functions mới chỉ có trong SQL version
 if USE_SQL_DATABASE:
     __all__.extend([
+        'refund_usage_count',
         'add_key',
         'update_key', 
         'delete_key',
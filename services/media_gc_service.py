@@ -0,0 +1,287 @@
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+from config import (
+    MEDIA_OUTPUT_DIRS, MEDIA_GC_DRY_RUN, MEDIA_GC_INTERVAL,
+    MEDIA_MAX_AGE_DAYS, MEDIA_DISK_QUOTA_BYTES, MEDIA_STAGING_MAX_AGE,
+    MEDIA_ACCESS_FLUSH_INTERVAL
+)
+from database import db_manager
+from services.voice_service import voice_sample_filenames
+from utils.media_store import OBJECTS_DIRNAME, STAGING_DIRNAME, forget_media
+from utils.storage import get_storage
+from utils import metrics
+
+try:
+    import fcntl
+except ImportError:  # Windows: không có flock, mỗi process tự sweep
+    fcntl = None
+
+# Derivative `<base>_w320.webp` / `<base>.avif` đi cùng ảnh gốc `<base>.png`
+_DERIVATIVE_RE = re.compile(r"^(?P<base>.+?)(?:_w\d+)?\.(?:webp|avif)$")
+
+# Lock + báo cáo dùng chung giữa các worker gunicorn
+_LOCK_PATH = os.path.join(tempfile.gettempdir(), "cloudapi_media_gc.lock")
+_REPORT_PATH = os.path.join(tempfile.gettempdir(), "cloudapi_media_gc.json")
+REPORT_SAMPLE_SIZE = 50
+
+_access_buffer = {}
+_access_lock = threading.Lock()
+_last_flush = time.time()
+
+_sweep_lock = threading.Lock()
+_sweeper_pid = None
+
+
+def record_media_access(module, rel_path):
+    """Remember that a file was served; written to the DB in batches"""
+    global _last_flush
+    now = time.time()
+    with _access_lock:
+        _access_buffer[(module, rel_path)] = now
+        if now - _last_flush < MEDIA_ACCESS_FLUSH_INTERVAL:
+            return
+        entries = _drain_access_buffer(now)
+    _write_access(entries)
+
+
+def flush_media_access():
+    """Write buffered accesses now (before a sweep)"""
+    with _access_lock:
+        entries = _drain_access_buffer(time.time())
+    _write_access(entries)
+
+
+def _drain_access_buffer(now):
+    global _last_flush
+    entries = [(module, rel_path, ts) for (module, rel_path), ts in _access_buffer.items()]
+    _access_buffer.clear()
+    _last_flush = now
+    return entries
+
+
+def _write_access(entries):
+    try:
+        db_manager.record_media_access(entries)
+    except Exception as e:
+        print(f"⚠️ Không ghi được lịch sử serve media: {e}")
+
+
+def _group_key(module, rel_path):
+    """Files that live and die together (an image and its derivatives)"""
+    if module == "image":
+        match = _DERIVATIVE_RE.match(rel_path)
+        if match:
+            return f"{match.group('base')}.png"
+    return rel_path
+
+
+def _scan_module(module, base_dir, protected, now):
+    """Walk base_dir with os.scandir.
+
+    Returns (groups, protected_count, stale staging dirs). A group is
+    {"paths": [...], "size": bytes, "mtime": newest mtime}.
+    """
+    groups = {}
+    protected_count = 0
+    stale_staging = []
+    stack = [""]
+    while stack:
+        rel_dir = stack.pop()
+        try:
+            with os.scandir(os.path.join(base_dir, rel_dir)) as entries:
+                for entry in entries:
+                    rel_path = f"{rel_dir}/{entry.name}" if rel_dir else entry.name
+                    if entry.is_dir(follow_symlinks=False):
+                        if rel_path == STAGING_DIRNAME:
+                            stale_staging.extend(_stale_staging_dirs(entry.path, now))
+                        else:
+                            stack.append(rel_path)
+                        continue
+                    if not entry.is_file(follow_symlinks=False) or entry.name.endswith(".tmp"):
+                        continue
+                    if rel_path in protected:
+                        protected_count += 1
+                        continue
+
+                    stat = entry.stat(follow_symlinks=False)
+                    group = groups.setdefault(_group_key(module, rel_path), {"paths": [], "size": 0, "mtime": 0})
+                    group["paths"].append(rel_path)
+                    group["size"] += stat.st_size
+                    group["mtime"] = max(group["mtime"], stat.st_mtime)
+        except FileNotFoundError:
+            continue
+    return groups, protected_count, stale_staging
+
+
+def _stale_staging_dirs(staging_root, now):
+    stale = []
+    with os.scandir(staging_root) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False) and now - entry.stat().st_mtime > MEDIA_STAGING_MAX_AGE:
+                stale.append(entry.path)
+    return stale
+
+
+def _remove_empty_parents(base_dir, rel_path):
+    """Remove now-empty legacy `<timestamp_uuid>/` dirs; shard dirs under objects/ are kept"""
+    parent = os.path.dirname(rel_path)
+    while parent and not parent.startswith(OBJECTS_DIRNAME):
+        try:
+            os.rmdir(os.path.join(base_dir, parent))
+        except OSError:
+            return
+        parent = os.path.dirname(parent)
+
+
+def _evict(module, base_dir, paths):
+    for rel_path in paths:
+        try:
+            os.remove(os.path.join(base_dir, rel_path))
+        except FileNotFoundError:
+            pass
+        _remove_empty_parents(base_dir, rel_path)
+    db_manager.delete_media_access(module, paths)
+
+    # Với S3 thư mục local chỉ là cache: object trên bucket (và tên public) vẫn còn
+    if get_storage().is_local:
+        for public_name in db_manager.delete_media_objects(module, paths):
+            forget_media(public_name)
+
+
+def run_media_gc(dry_run=None):
+    """Delete expired media, then least-recently-served media until under quota.
+
+    With dry_run nothing is deleted; the report shows what would be.
+    Abandoned uploads have their own sweeper (services.upload_service).
+    """
+    dry_run = MEDIA_GC_DRY_RUN if dry_run is None else dry_run
+    with _sweep_lock:
+        flush_media_access()
+        start_time = time.time()
+        report = {
+            "dry_run": dry_run,
+            "started_at": db_manager.get_vietnam_time(),
+            "quota_bytes": MEDIA_DISK_QUOTA_BYTES,
+            "modules": {},
+            "evicted_sample": [],
+        }
+
+        quota_candidates = []
+        remaining_bytes = 0
+        for module, base_dir in MEDIA_OUTPUT_DIRS.items():
+            protected = voice_sample_filenames() if module == "voice" else set()
+            groups, protected_count, stale_staging = _scan_module(module, base_dir, protected, start_time)
+            access = db_manager.get_media_access(module)
+            max_age = MEDIA_MAX_AGE_DAYS.get(module, 0) * 86400
+
+            stats = {
+                "files": 0, "bytes": 0, "protected_files": protected_count,
+                "expired_files": 0, "expired_bytes": 0,
+                "quota_files": 0, "quota_bytes": 0,
+                "stale_staging_dirs": len(stale_staging),
+            }
+            report["modules"][module] = stats
+
+            for group in groups.values():
+                stats["files"] += len(group["paths"])
+                stats["bytes"] += group["size"]
+                last_used = max([group["mtime"]] + [access.get(p, 0) for p in group["paths"]])
+
+                if max_age > 0 and start_time - last_used > max_age:
+                    stats["expired_files"] += len(group["paths"])
+                    stats["expired_bytes"] += group["size"]
+                    _record_eviction(report, module, group, "age", dry_run, base_dir)
+                else:
+                    remaining_bytes += group["size"]
+                    quota_candidates.append((last_used, module, group))
+
+            if not dry_run:
+                for staging_dir in stale_staging:
+                    shutil.rmtree(staging_dir, ignore_errors=True)
+
+        # Quota chung cho cả voice + image: xóa file serve lâu nhất trước
+        if MEDIA_DISK_QUOTA_BYTES > 0 and remaining_bytes > MEDIA_DISK_QUOTA_BYTES:
+            quota_candidates.sort(key=lambda candidate: candidate[0])
+            for last_used, module, group in quota_candidates:
+                if remaining_bytes <= MEDIA_DISK_QUOTA_BYTES:
+                    break
+                stats = report["modules"][module]
+                stats["quota_files"] += len(group["paths"])
+                stats["quota_bytes"] += group["size"]
+                remaining_bytes -= group["size"]
+                _record_eviction(report, module, group, "quota", dry_run, MEDIA_OUTPUT_DIRS[module])
+
+        report["remaining_bytes"] = remaining_bytes
+        report["duration"] = round(time.time() - start_time, 3)
+        _save_report(report)
+        metrics.observe_media_gc(report)
+        return report
+
+
+def _record_eviction(report, module, group, reason, dry_run, base_dir):
+    if len(report["evicted_sample"]) < REPORT_SAMPLE_SIZE:
+        report["evicted_sample"].append({"module": module, "paths": group["paths"], "size": group["size"], "reason": reason})
+    if not dry_run:
+        _evict(module, base_dir, group["paths"])
+
+
+def _save_report(report):
+    try:
+        tmp_path = f"{_REPORT_PATH}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False)
+        os.replace(tmp_path, _REPORT_PATH)
+    except OSError as e:
+        print(f"⚠️ Không lưu được báo cáo media GC: {e}")
+
+
+def get_media_gc_report():
+    """Last sweep report (from any worker), or None"""
+    try:
+        with open(_REPORT_PATH, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _sweep_if_due():
+    """Run one sweep across all workers per MEDIA_GC_INTERVAL"""
+    if fcntl is None:
+        run_media_gc()
+        return
+    with open(_LOCK_PATH, "a") as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            return  # worker khác đang sweep
+        try:
+            last_run = os.fstat(lock_file.fileno()).st_mtime
+            if time.time() - last_run < MEDIA_GC_INTERVAL and get_media_gc_report() is not None:
+                return
+            os.utime(_LOCK_PATH)
+            run_media_gc()
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _sweeper_loop():
+    while True:
+        time.sleep(MEDIA_GC_INTERVAL)
+        try:
+            _sweep_if_due()
+        except Exception as e:
+            print(f"❌ Lỗi media GC: {e}")
+
+
+def ensure_media_gc_started():
+    """Start the background sweeper once per worker process (after fork)"""
+    global _sweeper_pid
+    if _sweeper_pid == os.getpid():
+        return
+    _sweeper_pid = os.getpid()
+    threading.Thread(target=_sweeper_loop, name="media-gc", daemon=True).start()
@@ -1,55 +1,29 @@
 import os
 import logging
-from config import SUDO_KEYS_FILE, PROXIES_FILE
+from config import PROXIES_FILE
 from services.key_service_wrapper import update_usage_count, get_key_status
 from utils.file_utils import load_proxies
 from utils.suno import generate_music, check_task_status
 from services.key_service import update_usage_count, get_key_status
 from utils.file_utils import load_proxies
+from utils.provider_credentials import provider_credentials
 from utils.suno import generate_music, check_task_status
 import time
 
 # Set up logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-# Performance optimizations
-_api_keys_cache = {}
-_api_keys_cache_timestamp = {}
-API_KEYS_CACHE_TTL = 300  # Cache API keys for 5 minutes
-
 def load_sudo_keys():
-    """Load Sudo API keys with caching"""
-    current_time = time.time()
-    
-    # Check if cache is valid
-    if (SUDO_KEYS_FILE in _api_keys_cache and 
-        current_time - _api_keys_cache_timestamp.get(SUDO_KEYS_FILE, 0) < API_KEYS_CACHE_TTL):
-        return _api_keys_cache[SUDO_KEYS_FILE]
-    
-    # Load fresh keys
-    if not os.path.exists(SUDO_KEYS_FILE):
-        logging.warning(f"Sudo keys file '{SUDO_KEYS_FILE}' not found.")
-        return []
-    
+    """Active Suno API keys from provider_credentials (cached across workers)"""
     try:
-        with open(SUDO_KEYS_FILE) as f:
-            keys = [l.strip() for l in f if l.strip()]
-        if not keys:
-            logging.warning("No valid keys found in the Sudo keys file.")
-        with open(SUDO_KEYS_FILE, 'r', encoding='utf-8') as f:
-            keys = [l.strip() for l in f if l.strip()]
-        
-        if not keys:
-            logging.warning("No valid keys found in the Sudo keys file.")
-        
-        # Cache the result
-        _api_keys_cache[SUDO_KEYS_FILE] = keys
-        _api_keys_cache_timestamp[SUDO_KEYS_FILE] = current_time
-        
-        return keys
+        keys = provider_credentials.secrets("suno")
     except Exception as e:
         logging.error(f"Error loading Sudo keys: {e}")
         return []
+    
+    if not keys:
+        logging.warning("No active Suno key in provider_credentials.")
+    return keys
 
 def create_music(prompt_text, title, style, instrumental, key, device_id):
     """Create music with improved performance"""
@@ -126,6 +100,4 @@ def get_task_status(task_id, api_key):
 
 def clear_api_keys_cache():
     """Clear API keys cache"""
-    global _api_keys_cache, _api_keys_cache_timestamp
-    _api_keys_cache.clear()
-    _api_keys_cache_timestamp.clear()
+    provider_credentials.invalidate("suno")
@@ -0,0 +1,342 @@
+import hashlib
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+import uuid
+from werkzeug.utils import secure_filename
+from config import (
+    UPLOAD_FOLDER, UPLOAD_SPOOL_DIR, UPLOAD_CHUNK_SIZE, UPLOAD_MAX_BYTES,
+    UPLOAD_MAX_CHUNK_BYTES, UPLOAD_RESUMABLE_TTL, UPLOAD_SPOOL_MAX_AGE, UPLOAD_GC_INTERVAL,
+    UPLOAD_HASH_STATE_TTL, UPLOAD_MAX_OPEN_PER_KEY
+)
+from utils.file_utils import ensure_dir
+
+try:
+    import fcntl
+except ImportError:  # Windows: không khóa file, chỉ dựa vào kiểm tra offset
+    fcntl = None
+
+# Upload resumable: init -> PATCH từng chunk theo offset -> finalize với sha256.
+# Trạng thái nằm trên đĩa (<id>.json + <id>.part) nên mọi worker đều xử lý được,
+# offset hiện tại chính là kích thước file .part.
+# Thư mục .partial nằm trong UPLOAD_FOLDER để finalize chỉ là một os.replace.
+RESUMABLE_DIR = os.path.join(UPLOAD_FOLDER, ".partial")
+_UPLOAD_ID_RE = re.compile(r"^[0-9a-f]{32}$")
+
+# sha256 tính dần theo từng chunk để finalize không phải đọc lại cả file (tới 2 GB).
+# Object hashlib không serialize được nên trạng thái nằm trong RAM của worker, cạnh metadata trên đĩa:
+# upload_id -> (số byte đã hash, hashlib object, lần dùng cuối). Chunk rơi vào worker khác thì worker đó
+# hash lại phần đầu file .part một lần (trong flock) rồi tiếp tục. Trạng thái không dùng quá
+# UPLOAD_HASH_STATE_TTL bị bỏ ngay trong request, không chờ sweep.
+_hash_states = {}
+_HASH_STATE_PRUNE_INTERVAL = 60
+_last_hash_prune = 0.0
+
+# Sweep upload bỏ dở: chạy nền ở mọi worker, flock để mỗi UPLOAD_GC_INTERVAL chỉ một worker quét
+_GC_LOCK_PATH = os.path.join(tempfile.gettempdir(), "cloudapi_upload_gc.lock")
+_sweeper_pid = None
+
+
+def _paths(upload_id):
+    if not _UPLOAD_ID_RE.match(upload_id or ""):
+        return None, None
+    base = os.path.join(RESUMABLE_DIR, upload_id)
+    return f"{base}.json", f"{base}.part"
+
+
+def _error(message, status, **extra):
+    return {"success": False, "message": message, "status": status, **extra}
+
+
+def _load_meta(meta_path):
+    try:
+        with open(meta_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _open_uploads(owner):
+    """Number of resumable uploads still open for this key"""
+    count = 0
+    if not os.path.isdir(RESUMABLE_DIR):
+        return count
+    with os.scandir(RESUMABLE_DIR) as entries:
+        for entry in entries:
+            if entry.name.endswith(".json"):
+                meta = _load_meta(entry.path)
+                if meta and meta.get("owner") == owner:
+                    count += 1
+    return count
+
+
+def init_upload(filename, size, sha256=None, owner=None):
+    """Start a resumable upload for the key `owner`; returns its id and the chunk size to use"""
+    filename = secure_filename(filename or "")
+    if not filename:
+        return _error("Tên file không hợp lệ", 400)
+    try:
+        size = int(size)
+    except (TypeError, ValueError):
+        return _error("Thiếu hoặc sai kích thước file (size)", 400)
+    if size <= 0 or size > UPLOAD_MAX_BYTES:
+        return _error(f"Kích thước file phải từ 1 đến {UPLOAD_MAX_BYTES} bytes", 413)
+    if owner and _open_uploads(owner) >= UPLOAD_MAX_OPEN_PER_KEY:
+        return _error(f"Key đã có {UPLOAD_MAX_OPEN_PER_KEY} upload chưa hoàn tất, hãy finalize hoặc hủy bớt", 429)
+
+    ensure_dir(RESUMABLE_DIR)
+    upload_id = uuid.uuid4().hex
+    meta_path, part_path = _paths(upload_id)
+    with open(meta_path, "w", encoding="utf-8") as f:
+        json.dump({
+            "filename": filename,
+            "size": size,
+            "sha256": (sha256 or "").lower() or None,
+            "owner": owner,
+            "created_at": time.time(),
+        }, f)
+    open(part_path, "wb").close()
+
+    return {
+        "success": True,
+        "upload_id": upload_id,
+        "offset": 0,
+        "size": size,
+        "chunk_size": UPLOAD_MAX_CHUNK_BYTES,
+    }
+
+
+def get_upload_status(upload_id):
+    meta_path, part_path = _paths(upload_id)
+    meta = _load_meta(meta_path) if meta_path else None
+    if not meta or not os.path.exists(part_path):
+        return _error("Không tìm thấy upload", 404)
+    return {
+        "success": True,
+        "upload_id": upload_id,
+        "filename": meta["filename"],
+        "offset": os.path.getsize(part_path),
+        "size": meta["size"],
+    }
+
+
+def _lock(part, status_offset):
+    """Take the per-upload flock without blocking; returns an error dict if another request holds it"""
+    if fcntl is None:
+        return None
+    try:
+        fcntl.flock(part, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        return _error("Upload đang được ghi bởi request khác", 409, offset=status_offset)
+    return None
+
+
+def _running_hash(upload_id, part_path, offset):
+    """sha256 object covering the first `offset` bytes of the .part file (call under the flock)"""
+    hashed, digest, _ = _hash_states.pop(upload_id, (0, None, 0))
+    if digest is None or hashed > offset:
+        hashed, digest = 0, hashlib.sha256()
+    if hashed < offset:
+        with open(part_path, "rb") as f:
+            f.seek(hashed)
+            while hashed < offset:
+                block = f.read(min(UPLOAD_CHUNK_SIZE, offset - hashed))
+                if not block:
+                    break
+                digest.update(block)
+                hashed += len(block)
+    return digest
+
+
+def _store_hash_state(upload_id, hashed, digest):
+    global _last_hash_prune
+    now = time.time()
+    _hash_states[upload_id] = (hashed, digest, now)
+    if now - _last_hash_prune < _HASH_STATE_PRUNE_INTERVAL:
+        return
+    _last_hash_prune = now
+    for state_id, state in list(_hash_states.items()):
+        if now - state[2] > UPLOAD_HASH_STATE_TTL:
+            _hash_states.pop(state_id, None)
+
+
+def append_chunk(upload_id, offset, stream):
+    """Append a chunk at `offset`, streamed straight from the request body.
+
+    A chunk cut off mid-way keeps what was written; the client resumes from
+    the offset reported by get_upload_status.
+    """
+    status = get_upload_status(upload_id)
+    if not status["success"]:
+        return status
+    try:
+        offset = int(offset)
+    except (TypeError, ValueError):
+        return _error("Thiếu hoặc sai Upload-Offset", 400)
+
+    _, part_path = _paths(upload_id)
+    with open(part_path, "ab") as part:
+        locked = _lock(part, status["offset"])
+        if locked:
+            return locked
+
+        current = os.fstat(part.fileno()).st_size
+        if offset != current:
+            return _error("Offset không khớp", 409, offset=current)
+
+        digest = _running_hash(upload_id, part_path, current)
+        hashed = current
+        remaining = status["size"] - current
+        try:
+            for chunk in iter(lambda: stream.read(UPLOAD_CHUNK_SIZE), b""):
+                if len(chunk) > remaining:
+                    part.truncate(current)
+                    digest, hashed = None, 0
+                    return _error("Chunk vượt quá kích thước file đã khai báo", 413, offset=current)
+                part.write(chunk)
+                digest.update(chunk)
+                hashed += len(chunk)
+                remaining -= len(chunk)
+            part.flush()
+        finally:
+            # Client ngắt giữa chừng vẫn giữ phần đã hash; byte trên đĩa lệch với `hashed` sẽ được _running_hash bù lại
+            if digest is not None:
+                _store_hash_state(upload_id, hashed, digest)
+        new_offset = status["size"] - remaining
+
+    return {"success": True, "upload_id": upload_id, "offset": new_offset, "size": status["size"]}
+
+
+def finalize_upload(upload_id, sha256=None):
+    """Verify the checksum and move the completed file into UPLOAD_FOLDER"""
+    status = get_upload_status(upload_id)
+    if not status["success"]:
+        return status
+    if status["offset"] != status["size"]:
+        return _error("Upload chưa hoàn tất", 409, offset=status["offset"])
+
+    meta_path, part_path = _paths(upload_id)
+    expected = (sha256 or "").lower() or _load_meta(meta_path).get("sha256")
+    if not expected:
+        return _error("Thiếu checksum sha256", 400)
+
+    # Cùng flock với append_chunk: không hash/publish file khi một PATCH khác còn đang ghi
+    with open(part_path, "rb") as part:
+        locked = _lock(part, status["offset"])
+        if locked:
+            return locked
+        size = os.fstat(part.fileno()).st_size
+        if size != status["size"]:
+            return _error("Upload chưa hoàn tất", 409, offset=size)
+
+        actual = _running_hash(upload_id, part_path, size).hexdigest()
+        if actual != expected:
+            discard_upload(upload_id)
+            return _error("Checksum không khớp, vui lòng upload lại", 422, sha256=actual)
+
+        save_path = os.path.join(UPLOAD_FOLDER, status["filename"])
+        os.replace(part_path, save_path)
+        os.remove(meta_path)
+    return {"success": True, "filename": status["filename"], "size": status["size"], "sha256": actual}
+
+
+def discard_upload(upload_id):
+    _hash_states.pop(upload_id, None)
+    for path in _paths(upload_id):
+        if path:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def clean_incomplete_uploads(dry_run=False):
+    """Remove resumable uploads idle for UPLOAD_RESUMABLE_TTL and stale spooled files"""
+    now = time.time()
+    removed = {"resumable": 0, "resumable_bytes": 0, "spool": 0, "spool_bytes": 0}
+
+    last_activity = {}
+    sizes = {}
+    if os.path.isdir(RESUMABLE_DIR):
+        with os.scandir(RESUMABLE_DIR) as entries:
+            for entry in entries:
+                upload_id, ext = os.path.splitext(entry.name)
+                if ext not in (".json", ".part") or not entry.is_file():
+                    continue
+                stat = entry.stat()
+                last_activity[upload_id] = max(last_activity.get(upload_id, 0), stat.st_mtime)
+                sizes[upload_id] = sizes.get(upload_id, 0) + stat.st_size
+
+    for upload_id, mtime in last_activity.items():
+        if now - mtime > UPLOAD_RESUMABLE_TTL:
+            removed["resumable"] += 1
+            removed["resumable_bytes"] += sizes[upload_id]
+            if not dry_run:
+                discard_upload(upload_id)
+
+    if not dry_run:
+        # Trạng thái hash của upload đã được worker khác finalize/xóa
+        for upload_id in list(_hash_states):
+            if upload_id not in last_activity:
+                _hash_states.pop(upload_id, None)
+
+    if os.path.isdir(UPLOAD_SPOOL_DIR):
+        with os.scandir(UPLOAD_SPOOL_DIR) as entries:
+            for entry in entries:
+                if entry.is_file() and now - entry.stat().st_mtime > UPLOAD_SPOOL_MAX_AGE:
+                    removed["spool"] += 1
+                    removed["spool_bytes"] += entry.stat().st_size
+                    if not dry_run:
+                        try:
+                            os.remove(entry.path)
+                        except OSError:
+                            pass
+    return removed
+
+
+def _sweep_if_due():
+    """Run clean_incomplete_uploads once across all workers per UPLOAD_GC_INTERVAL"""
+    if fcntl is None:
+        return clean_incomplete_uploads()
+    with open(_GC_LOCK_PATH, "a+") as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            return None  # worker khác đang sweep
+        try:
+            lock_file.seek(0)
+            try:
+                last_run = float(lock_file.read() or 0)
+            except ValueError:
+                last_run = 0
+            if time.time() - last_run < UPLOAD_GC_INTERVAL:
+                return None
+            lock_file.truncate(0)
+            lock_file.write(str(time.time()))
+            lock_file.flush()
+            return clean_incomplete_uploads()
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _sweeper_loop():
+    while True:
+        try:
+            removed = _sweep_if_due()
+            if removed and (removed["resumable"] or removed["spool"]):
+                print(f"🧹 Đã xóa upload bỏ dở: {removed}")
+        except Exception as e:
+            print(f"❌ Lỗi dọn upload bỏ dở: {e}")
+        time.sleep(UPLOAD_GC_INTERVAL)
+
+
+def ensure_upload_gc_started():
+    """Start the abandoned-upload sweeper once per worker process (after fork)"""
+    global _sweeper_pid
+    if _sweeper_pid == os.getpid():
+        return
+    _sweeper_pid = os.getpid()
+    threading.Thread(target=_sweeper_loop, name="upload-gc", daemon=True).start()
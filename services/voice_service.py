@@ -1,71 +1,220 @@
+import asyncio
 import os
-from config import VOICE_OUTPUT_DIR, GEMINI_KEYS_FILE, PROXIES_FILE
-from services.key_service_wrapper import update_usage_count, get_key_status, get_key_info, parse_int
-from utils.file_utils import create_unique_output_dir, load_proxies
-from utils.gemini_client import gemini_tts_request
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from config import (
+    VOICE_OUTPUT_DIR, PROXIES_FILE, TTS_CHUNK_MAX_CHARS,
+    VOICE_BATCH_KEY_CONCURRENCY
+)
+from services.key_service_wrapper import (
+    update_usage_count, update_usage_count_by, refund_usage_count,
+    get_key_status, get_key_info, parse_int
+)
+from utils.file_utils import load_proxies, ensure_dir
+from utils.provider_credentials import provider_credentials
+from utils.media_store import (
+    create_staging_dir, discard_staging_dir, new_public_name, stream_staging_path, store_media
+)
+from utils.gemini_client import gemini_tts_request, submit_tts_chunks, tts_executor
+from utils.async_upstream import gemini_tts_request_async
+from utils.audio_encoder import AUDIO_FORMATS, encode_pcm
+from utils.text_utils import split_text_for_streaming
+from utils.performance_monitor import performance_monitor
+from utils.tracing import propagate
 import time
 
-# Performance optimizations
-_api_keys_cache = {}
-_api_keys_cache_timestamp = {}
-API_KEYS_CACHE_TTL = 300  # Cache API keys for 5 minutes
+# Định dạng có thể nối từng đoạn đã encode mà vẫn phát được
+STREAMABLE_AUDIO_FORMATS = ("mp3", "pcm")
+
+# Giới hạn số item batch chạy đồng thời cho mỗi key (dùng chung giữa các request)
+_batch_semaphores = {}
+_batch_semaphores_lock = threading.Lock()
 
 def load_gemini_keys():
-    """Load Gemini API keys with caching"""
-    current_time = time.time()
-    
-    # Check if cache is valid
-    if (GEMINI_KEYS_FILE in _api_keys_cache and 
-        current_time - _api_keys_cache_timestamp.get(GEMINI_KEYS_FILE, 0) < API_KEYS_CACHE_TTL):
-        return _api_keys_cache[GEMINI_KEYS_FILE]
-    
-    # Load fresh keys
-    if not os.path.exists(GEMINI_KEYS_FILE):
-        return []
-    
+    """Active Gemini API keys from provider_credentials (cached across workers)"""
     try:
-        with open(GEMINI_KEYS_FILE, 'r', encoding='utf-8') as f:
-            keys = [l.strip() for l in f if l.strip()]
-        
-        # Cache the result
-        _api_keys_cache[GEMINI_KEYS_FILE] = keys
-        _api_keys_cache_timestamp[GEMINI_KEYS_FILE] = current_time
-        
-        return keys
+        return provider_credentials.secrets("gemini")
     except Exception as e:
         print(f"Error loading Gemini keys: {e}")
         return []
 
-def create_voice(text, key, device_id, voice_code="achird"):
-    """Create voice with improved performance"""
+def _prepare_upstream():
+    """(api_keys, staging dir, proxies) for one request; (None, None, None) without Gemini keys.
+
+    DB query + makedirs + proxy file: the async path runs this in a thread, off the shared upstream loop.
+    """
     api_keys = load_gemini_keys()
     if not api_keys:
-        return {"success": False, "message": "No Gemini API key configured"}
+        return None, None, None
+    return api_keys, create_staging_dir(VOICE_OUTPUT_DIR), load_proxies(PROXIES_FILE)
 
-    output_dir = create_unique_output_dir(VOICE_OUTPUT_DIR)
-    proxies = load_proxies(PROXIES_FILE)
-    mp3_path, duration = gemini_tts_request(text, voice_code, output_dir, api_keys, proxies)
+def _finish_voice(key, device_id, audio_path):
+    """Store the generated file and charge one usage; returns (filename, message)"""
+    filename, _ = store_media(VOICE_OUTPUT_DIR, "voice", audio_path)
+
+    # Update usage count
+    update_usage_count(key, device_id, module="voice")
+    
+    # Get key info for message
+    info = get_key_info(key, module="voice")
+    usage_count = parse_int(info.get('usage_count')) if info else None
+    max_usage = parse_int(info.get('max_usage')) if info else None
+
+    return filename, f"✅ Voice created ({usage_count}/{max_usage if max_usage else '∞'})"
 
+def create_voice(text, key, device_id, voice_code="achird", audio_format="mp3", bitrate=None):
+    """Create voice with improved performance"""
+    api_keys = load_gemini_keys()
+    if not api_keys:
+        return False, "No Gemini API key configured", None, None
+
+    output_dir = create_staging_dir(VOICE_OUTPUT_DIR)
     try:
-        output_dir = create_unique_output_dir(VOICE_OUTPUT_DIR)
         proxies = load_proxies(PROXIES_FILE)
-        mp3_path, duration = gemini_tts_request(text, voice_code, output_dir, api_keys, proxies)
-
-        # Update usage count
-        update_usage_count(key, device_id, module="voice")
-        
-        filename = os.path.relpath(mp3_path, VOICE_OUTPUT_DIR).replace("\\", "/")
+        audio_path, duration = gemini_tts_request(
+            text, voice_code, output_dir, api_keys, proxies,
+            audio_format=audio_format, bitrate=bitrate
+        )
+        filename, message = _finish_voice(key, device_id, audio_path)
+        return True, message, filename, duration
         
-        # Get key info for message
-        info = get_key_info(key, module="voice")
-        usage_count = parse_int(info.get('usage_count')) if info else None
-        max_usage = parse_int(info.get('max_usage')) if info else None
+    except Exception as e:
+        discard_staging_dir(output_dir)
+        return False, str(e), None, None
+
+async def create_voice_async(text, key, device_id, voice_code="achird", audio_format="mp3", bitrate=None):
+    """create_voice for async views: the Gemini calls run on the upstream event loop"""
+    # Mọi việc chặn (DB, file) chạy trong thread: loop upstream dùng chung cho mọi request của worker
+    api_keys, output_dir, proxies = await asyncio.to_thread(_prepare_upstream)
+    if not api_keys:
+        return False, "No Gemini API key configured", None, None
 
-        message = f"✅ Voice created ({usage_count}/{max_usage if max_usage else '∞'})"
+    try:
+        audio_path, duration = await gemini_tts_request_async(
+            text, voice_code, output_dir, api_keys, proxies,
+            audio_format=audio_format, bitrate=bitrate
+        )
+        filename, message = await asyncio.to_thread(_finish_voice, key, device_id, audio_path)
         return True, message, filename, duration
         
     except Exception as e:
-        return {"success": False, "message": str(e)}
+        await asyncio.to_thread(discard_staging_dir, output_dir)
+        return False, str(e), None, None
+
+def stream_voice(text, key, device_id, voice_code="achird", audio_format="mp3", bitrate=None, on_complete=None):
+    """Start a streaming voice generation.
+
+    Returns (success, message, filename, audio_chunks). audio_chunks yields the
+    encoded audio sentence group by sentence group, first sentence first, while
+    later groups are still being synthesized. Every chunk is also appended to a
+    staging file that /play/<filename> follows while it grows; the file is
+    indexed under `filename` once streaming completes.
+    Usage is charged only when the whole text was streamed; on_complete(ok,
+    message) is called at the end.
+    """
+    api_keys = load_gemini_keys()
+    if not api_keys:
+        return False, "No Gemini API key configured", None, None
+    if audio_format not in STREAMABLE_AUDIO_FORMATS:
+        return False, f"❌ Streaming chỉ hỗ trợ: {', '.join(STREAMABLE_AUDIO_FORMATS)}", None, None
+
+    chunks = split_text_for_streaming(text, TTS_CHUNK_MAX_CHARS)
+    if not chunks:
+        return False, "❌ Thiếu text", None, None
+
+    start_time = time.time()
+    # Tên public được cấp trước để gửi trong header; trong lúc stream, /play/<filename> đọc theo file staging
+    # đang lớn dần, stream xong file được index và serve như mọi file khác
+    filename = new_public_name(AUDIO_FORMATS[audio_format]['ext'])
+    audio_path = stream_staging_path(VOICE_OUTPUT_DIR, filename)
+    output_dir = os.path.dirname(audio_path)
+    ensure_dir(output_dir)
+    proxies = load_proxies(PROXIES_FILE)
+
+    def generate():
+        # Chunk đầu được submit trước nên được tạo trước, các chunk sau chạy song song
+        executor = tts_executor(len(chunks), api_keys)
+        futures = submit_tts_chunks(executor, chunks, voice_code, api_keys, proxies)
+        completed = False
+        message = "❌ Client ngắt kết nối"
+        try:
+            with open(audio_path, "wb") as audio_file:
+                for i, future in enumerate(futures):
+                    audio_bytes = encode_pcm(future.result(), audio_format, bitrate)
+                    audio_file.write(audio_bytes)
+                    audio_file.flush()
+                    if i == 0:
+                        performance_monitor.record_first_audio_time("/api/voice/create_stream", time.time() - start_time)
+                    yield audio_bytes
+
+            store_media(VOICE_OUTPUT_DIR, "voice", audio_path, public_name=filename)
+            update_usage_count(key, device_id, module="voice")
+            completed = True
+            message = f"Voice streamed: {filename} ({len(chunks)} chunks)"
+        except Exception as e:
+            message = str(e)
+            print(f"[VOICE STREAM] Lỗi: {e}")
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+            if not completed:
+                discard_staging_dir(output_dir)
+            if on_complete:
+                on_complete(completed, message)
+
+    return True, "✅ Voice streaming", filename, generate()
+
+def _get_batch_semaphore(key):
+    with _batch_semaphores_lock:
+        if key not in _batch_semaphores:
+            _batch_semaphores[key] = threading.BoundedSemaphore(VOICE_BATCH_KEY_CONCURRENCY)
+        return _batch_semaphores[key]
+
+def create_voice_batch(items, key, device_id, audio_format="mp3", bitrate=None):
+    """Create many voices in one call.
+
+    Usage for the whole batch is charged in one transaction up front and the
+    failed items are refunded at the end. Items run concurrently, at most
+    VOICE_BATCH_KEY_CONCURRENCY at a time per key. Returns
+    (success, message, results) where results keep the input order.
+    """
+    api_keys = load_gemini_keys()
+    if not api_keys:
+        return False, "No Gemini API key configured", []
+
+    try:
+        update_usage_count_by(key, len(items), device_id=device_id, module="voice")
+    except Exception as e:
+        return False, str(e), []
+
+    proxies = load_proxies(PROXIES_FILE)
+    semaphore = _get_batch_semaphore(key)
+
+    def run_item(index, item):
+        with semaphore:
+            output_dir = create_staging_dir(VOICE_OUTPUT_DIR)
+            try:
+                audio_path, duration = gemini_tts_request(
+                    item["text"], item["voice_code"], output_dir, api_keys, proxies,
+                    audio_format=audio_format, bitrate=bitrate, key_offset=index
+                )
+                filename, _ = store_media(VOICE_OUTPUT_DIR, "voice", audio_path)
+                return {"index": index, "success": True, "filename": filename, "duration": duration}
+            except Exception as e:
+                discard_staging_dir(output_dir)
+                return {"index": index, "success": False, "message": str(e)}
+
+    with ThreadPoolExecutor(max_workers=min(len(items), VOICE_BATCH_KEY_CONCURRENCY)) as executor:
+        results = list(executor.map(propagate(run_item), range(len(items)), items))
+
+    failed = sum(1 for r in results if not r["success"])
+    if failed:
+        try:
+            refund_usage_count(key, failed, module="voice")
+        except Exception as e:
+            print(f"❌ Không hoàn được {failed} lượt cho KEY '{key}': {e}")
+
+    message = f"✅ Batch: {len(items) - failed}/{len(items)} voice thành công"
+    return True, message, results
 
 def use_voice_key(key, device_id):
     """Use voice key with error handling"""
@@ -75,40 +224,46 @@ def use_voice_key(key, device_id):
     except Exception as e:
         return False, str(e)
 
+VOICE_LIST = [
+    {"name": "Voice 1 - Alpha", "code": "achernar"},
+    {"name": "Voice 2 - Beta", "code": "achird"},
+    {"name": "Voice 3 - Gamma", "code": "algenib"},
+    {"name": "Voice 4 - Delta", "code": "algieba"},
+    {"name": "Voice 5 - Epsilon", "code": "alnilam"},
+    {"name": "Voice 6 - Zeta", "code": "aoede"},
+    {"name": "Voice 7 - Eta", "code": "autonoe"},
+    {"name": "Voice 8 - Theta", "code": "callirrhoe"},
+    {"name": "Voice 9 - Iota", "code": "charon"},
+    {"name": "Voice 10 - Kappa", "code": "despina"},
+    {"name": "Voice 11 - Lambda", "code": "enceladus"},
+    {"name": "Voice 12 - Mu", "code": "erinome"},
+    {"name": "Voice 13 - Nu", "code": "fenrir"},
+    {"name": "Voice 14 - Xi", "code": "gacrux"},
+    {"name": "Voice 15 - Omicron", "code": "iapetus"},
+    {"name": "Voice 16 - Pi", "code": "kore"},
+    {"name": "Voice 17 - Rho", "code": "laomedeia"},
+    {"name": "Voice 18 - Sigma", "code": "leda"},
+    {"name": "Voice 19 - Tau", "code": "orus"},
+    {"name": "Voice 20 - Upsilon", "code": "puck"},
+    {"name": "Voice 21 - Phi", "code": "pulcherrima"},
+    {"name": "Voice 22 - Chi", "code": "rasalgethi"},
+    {"name": "Voice 23 - Psi", "code": "sadachbia"},
+    {"name": "Voice 24 - Omega", "code": "sadaltager"},
+    {"name": "Voice 25 - Alpha Prime", "code": "schedar"},
+    {"name": "Voice 26 - Beta Prime", "code": "sulafat"},
+    {"name": "Voice 27 - Gamma Prime", "code": "umbriel"},
+    {"name": "Voice 28 - Delta Prime", "code": "vindemiatrix"},
+    {"name": "Voice 29 - Epsilon Prime", "code": "zephyr"},
+    {"name": "Voice 30 - Zeta Prime", "code": "zubenelgenubi"},
+]
+
+def voice_sample_filenames():
+    """Sample MP3s linked from get_voice_list (never garbage-collected)"""
+    return {f"{voice['code']}.mp3" for voice in VOICE_LIST}
+
 def get_voice_list(base_url=None):
     """Get voice list with sample URLs"""
-    voices = [
-        {"name": "Voice 1 - Alpha", "code": "achernar"},
-        {"name": "Voice 2 - Beta", "code": "achird"},
-        {"name": "Voice 3 - Gamma", "code": "algenib"},
-        {"name": "Voice 4 - Delta", "code": "algieba"},
-        {"name": "Voice 5 - Epsilon", "code": "alnilam"},
-        {"name": "Voice 6 - Zeta", "code": "aoede"},
-        {"name": "Voice 7 - Eta", "code": "autonoe"},
-        {"name": "Voice 8 - Theta", "code": "callirrhoe"},
-        {"name": "Voice 9 - Iota", "code": "charon"},
-        {"name": "Voice 10 - Kappa", "code": "despina"},
-        {"name": "Voice 11 - Lambda", "code": "enceladus"},
-        {"name": "Voice 12 - Mu", "code": "erinome"},
-        {"name": "Voice 13 - Nu", "code": "fenrir"},
-        {"name": "Voice 14 - Xi", "code": "gacrux"},
-        {"name": "Voice 15 - Omicron", "code": "iapetus"},
-        {"name": "Voice 16 - Pi", "code": "kore"},
-        {"name": "Voice 17 - Rho", "code": "laomedeia"},
-        {"name": "Voice 18 - Sigma", "code": "leda"},
-        {"name": "Voice 19 - Tau", "code": "orus"},
-        {"name": "Voice 20 - Upsilon", "code": "puck"},
-        {"name": "Voice 21 - Phi", "code": "pulcherrima"},
-        {"name": "Voice 22 - Chi", "code": "rasalgethi"},
-        {"name": "Voice 23 - Psi", "code": "sadachbia"},
-        {"name": "Voice 24 - Omega", "code": "sadaltager"},
-        {"name": "Voice 25 - Alpha Prime", "code": "schedar"},
-        {"name": "Voice 26 - Beta Prime", "code": "sulafat"},
-        {"name": "Voice 27 - Gamma Prime", "code": "umbriel"},
-        {"name": "Voice 28 - Delta Prime", "code": "vindemiatrix"},
-        {"name": "Voice 29 - Epsilon Prime", "code": "zephyr"},
-        {"name": "Voice 30 - Zeta Prime", "code": "zubenelgenubi"},
-    ]
+    voices = [dict(voice) for voice in VOICE_LIST]
 
     if base_url:
         for voice in voices:
@@ -128,6 +283,4 @@ def get_key_status_key(key, device_id):
 
 def clear_api_keys_cache():
     """Clear API keys cache"""
-    global _api_keys_cache, _api_keys_cache_timestamp
-    _api_keys_cache.clear()
-    _api_keys_cache_timestamp.clear()
+    provider_credentials.invalidate("gemini")
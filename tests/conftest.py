@@ -0,0 +1,13 @@
+import atexit
+import os
+import shutil
+import sys
+import tempfile
+
+# database.py tạo db_manager lúc import: trỏ sang file SQLite tạm để test không đụng keys.db thật
+_TEST_DIR = tempfile.mkdtemp(prefix="cloudapi_test_")
+atexit.register(shutil.rmtree, _TEST_DIR, ignore_errors=True)
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{os.path.join(_TEST_DIR, 'test.db')}")
+os.environ.setdefault("SHARED_CACHE_BACKEND", "none")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
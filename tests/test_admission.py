@@ -0,0 +1,99 @@
+import threading
+import time
+
+import pytest
+
+from utils.admission import AdmissionGate, AdmissionRejected
+
+
+def _queue_waiters(gate, lanes):
+    """Start one blocked acquire() per lane name, in order; returns the threads once all are queued"""
+    threads = []
+    already_waiting = gate.get_stats()["waiting"]
+    for lane in lanes:
+        thread = threading.Thread(target=gate.acquire, args=(lambda lane=lane: lane,), daemon=True)
+        thread.start()
+        threads.append(thread)
+        _wait_until(lambda: gate.get_stats()["waiting"] == already_waiting + len(threads))
+    return threads
+
+
+def _wait_until(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, "timed out waiting for the gate"
+        time.sleep(0.005)
+
+
+def _admitted_by_lane(gate):
+    return {name: lane["admitted"] for name, lane in gate.get_stats()["lanes"].items()}
+
+
+def _drain(gate, threads):
+    while gate.get_stats()["waiting"]:
+        gate.release(0.1)
+    for thread in threads:
+        thread.join(timeout=5)
+
+
+def test_rejects_immediately_when_queue_full():
+    gate = AdmissionGate("test", max_in_flight=1, max_queue=0, max_wait=5)
+    assert gate.acquire() == 0.0
+
+    with pytest.raises(AdmissionRejected) as excinfo:
+        gate.acquire()
+
+    assert excinfo.value.reason == "queue_full"
+    assert excinfo.value.retry_after >= 1
+    stats = gate.get_stats()
+    assert stats["rejected_queue_full"] == 1
+    assert stats["in_flight"] == 1
+    assert stats["waiting"] == 0
+
+
+def test_rejects_after_max_wait():
+    gate = AdmissionGate("test", max_in_flight=1, max_queue=1, max_wait=0.05)
+    gate.acquire()
+
+    with pytest.raises(AdmissionRejected) as excinfo:
+        gate.acquire(lambda: "low")
+
+    assert excinfo.value.reason == "timeout"
+    stats = gate.get_stats()
+    assert stats["rejected_timeout"] == 1
+    assert stats["waiting"] == 0
+    assert stats["lanes"]["low"]["rejected"] == 1
+
+    # Slot giải phóng được giao bình thường, không còn ticket hết hạn trong hàng đợi
+    gate.release(0.1)
+    assert gate.acquire() == 0.0
+
+
+def test_lanes_share_slots_by_weight_under_contention():
+    gate = AdmissionGate("test", max_in_flight=1, max_queue=30, max_wait=30,
+                         lane_weights={"high": 4, "normal": 2, "low": 1}, starvation_seconds=60)
+    gate.acquire()
+    threads = _queue_waiters(gate, ["low"] * 10 + ["normal"] * 10 + ["high"] * 10)
+
+    # Mỗi release giao đúng 1 slot cho request đang chờ; 14 slot chia theo 4:2:1
+    for _ in range(14):
+        gate.release(0.1)
+    assert _admitted_by_lane(gate) == {"high": 8, "normal": 4, "low": 2}
+
+    _drain(gate, threads)
+
+
+def test_starving_request_is_promoted():
+    gate = AdmissionGate("test", max_in_flight=1, max_queue=10, max_wait=30,
+                         lane_weights={"high": 4, "normal": 2, "low": 1}, starvation_seconds=0.05)
+    gate.acquire()
+    threads = _queue_waiters(gate, ["low"])
+    time.sleep(0.1)
+    threads += _queue_waiters(gate, ["high"] * 3)
+
+    # high có pass nhỏ nhất nhưng request low đã chờ quá starvation_seconds -> được phục vụ trước
+    gate.release(0.1)
+    assert _admitted_by_lane(gate) == {"high": 0, "normal": 0, "low": 1}
+    assert gate.get_stats()["lanes"]["low"]["promoted"] == 1
+
+    _drain(gate, threads)
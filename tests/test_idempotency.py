@@ -0,0 +1,93 @@
+import time
+
+import pytest
+from flask import Flask, jsonify, request
+
+from database import db_manager
+from middlewares.idempotency import idempotent
+
+TTL = 3600
+PENDING_TIMEOUT = 300
+
+
+def _claim(scope, idempotency_key, request_hash, now=None):
+    now = time.time() if now is None else now
+    return db_manager.claim_idempotency_key(scope, idempotency_key, request_hash, now, TTL, now - PENDING_TIMEOUT)
+
+
+def test_first_claim_runs_and_retry_sees_done_record():
+    assert _claim("voice:/create:k1", "first", "hash-a") is None
+
+    pending = _claim("voice:/create:k1", "first", "hash-a")
+    assert pending["state"] == "pending"
+
+    db_manager.complete_idempotency_key("voice:/create:k1", "first", "hash-a", 200, "application/json", '{"success": true}')
+    done = _claim("voice:/create:k1", "first", "hash-a")
+    assert done["state"] == "done"
+    assert done["status_code"] == 200
+    assert done["response_body"] == '{"success": true}'
+
+
+def test_stale_pending_claim_is_taken_over():
+    started = time.time() - PENDING_TIMEOUT - 10
+    assert _claim("voice:/create:k1", "stale", "hash-a", now=started) is None
+
+    # Request đầu chết khi đang pending quá IDEMPOTENCY_PENDING_TIMEOUT: retry được chạy lại
+    assert _claim("voice:/create:k1", "stale", "hash-a") is None
+    record = db_manager.get_idempotency_record("voice:/create:k1", "stale")
+    assert record["state"] == "pending"
+    assert record["created_at"] > started
+
+
+def test_release_lets_the_retry_run_again():
+    assert _claim("voice:/create:k1", "released", "hash-a") is None
+    db_manager.release_idempotency_key("voice:/create:k1", "released", "hash-a")
+
+    assert db_manager.get_idempotency_record("voice:/create:k1", "released") is None
+    assert _claim("voice:/create:k1", "released", "hash-a") is None
+
+
+@pytest.fixture
+def client():
+    app = Flask(__name__)
+    app.calls = 0
+
+    @app.route("/create", methods=["POST"])
+    @idempotent(module="voice")
+    def create():
+        app.calls += 1
+        if request.form.get("fail"):
+            return jsonify(success=False, message="upstream error"), 502
+        return jsonify(success=True, call=app.calls)
+
+    return app.test_client()
+
+
+def test_retry_replays_the_first_response(client):
+    form = {"key": "k2", "text": "xin chào"}
+    first = client.post("/create", data=form, headers={"Idempotency-Key": "replay"})
+    second = client.post("/create", data=form, headers={"Idempotency-Key": "replay"})
+
+    assert first.status_code == second.status_code == 200
+    assert second.get_json() == first.get_json() == {"success": True, "call": 1}
+    assert second.headers["Idempotent-Replayed"] == "true"
+    assert client.application.calls == 1
+
+
+def test_same_key_with_different_params_is_rejected(client):
+    client.post("/create", data={"key": "k2", "text": "một"}, headers={"Idempotency-Key": "mismatch"})
+    response = client.post("/create", data={"key": "k2", "text": "hai"}, headers={"Idempotency-Key": "mismatch"})
+
+    assert response.status_code == 422
+    assert response.get_json()["success"] is False
+    assert client.application.calls == 1
+
+
+def test_failed_request_releases_the_key(client):
+    form = {"key": "k2", "text": "lỗi", "fail": "1"}
+    assert client.post("/create", data=form, headers={"Idempotency-Key": "failed"}).status_code == 502
+    assert db_manager.get_idempotency_record("voice:/create:k2", "failed") is None
+
+    # Lần đầu lỗi không trừ lượt -> retry cùng key được chạy lại chứ không replay lỗi
+    assert client.post("/create", data=form, headers={"Idempotency-Key": "failed"}).status_code == 502
+    assert client.application.calls == 2
@@ -0,0 +1,111 @@
+import sqlite3
+from types import SimpleNamespace
+
+import pytest
+
+from database import DatabaseManager
+import migrate_db
+
+# Kiểu cột của bảng admin_users trên PostgreSQL (schema() của PostgresBackend)
+PG_COLUMN_TYPES = {
+    "admin_users": {
+        "id": "integer",
+        "username": "text",
+        "password_hash": "text",
+        "email": "text",
+        "is_active": "boolean",
+        "last_login": "timestamp without time zone",
+        "created_at": "timestamp without time zone",
+    },
+}
+
+
+class RecordingCursor:
+    """Stand-in for the psycopg2 cursor: answers information_schema, records inserts"""
+
+    def __init__(self, inserts):
+        self.inserts = inserts
+        self.rowcount = 0
+        self._result = []
+
+    def execute(self, sql, params=()):
+        if "information_schema.columns" in sql:
+            self._result = list(PG_COLUMN_TYPES.get(params[0], {}).items())
+        elif sql.startswith("INSERT INTO"):
+            self.inserts.append((sql, params))
+            self.rowcount = 1
+        else:
+            self._result = []
+
+    def fetchall(self):
+        return self._result
+
+
+class RecordingConnection:
+    def __init__(self, inserts):
+        self.inserts = inserts
+
+    def cursor(self):
+        return RecordingCursor(self.inserts)
+
+    def commit(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def _postgres_target(inserts):
+    return SimpleNamespace(
+        backend=SimpleNamespace(name="postgresql"),
+        get_connection=lambda: RecordingConnection(inserts),
+    )
+
+
+@pytest.fixture
+def source_db(tmp_path):
+    path = str(tmp_path / "keys.db")
+    manager = DatabaseManager(database_url=f"sqlite:///{path}")
+    manager.create_admin_user("active_admin", "secret")
+    manager.create_admin_user("disabled_admin", "secret")
+    conn = sqlite3.connect(path)
+    conn.execute("UPDATE admin_users SET is_active = 0 WHERE username = 'disabled_admin'")
+    conn.commit()
+    conn.close()
+    source = sqlite3.connect(path)
+    yield source
+    source.close()
+
+
+def test_boolean_columns_are_converted_for_postgres(source_db):
+    inserts = []
+    read, inserted = migrate_db.copy_table(source_db, _postgres_target(inserts), "admin_users")
+
+    assert read == inserted == len(inserts) >= 2
+    columns = migrate_db._source_columns(source_db, "admin_users")
+    is_active = {params[columns.index("username")]: params[columns.index("is_active")] for _, params in inserts}
+    assert is_active["active_admin"] is True
+    assert is_active["disabled_admin"] is False
+
+
+def test_columns_without_conversion_are_copied_as_read(source_db):
+    inserts = []
+    migrate_db.copy_table(source_db, _postgres_target(inserts), "admin_users")
+
+    columns = migrate_db._source_columns(source_db, "admin_users")
+    expected = source_db.execute(f"SELECT {', '.join(columns)} FROM admin_users").fetchall()
+    for (_, params), row in zip(inserts, expected):
+        for column, value, original in zip(columns, params, row):
+            if column != "is_active":
+                assert value == original
+
+
+def test_null_boolean_stays_null():
+    convert = migrate_db._row_converter(["flag", "name"], {"flag": "boolean"})
+    assert convert((None, "a")) == (None, "a")
+    assert convert((1, "b")) == (True, "b")
+
+
+def test_sqlite_target_keeps_rows_unchanged():
+    convert = migrate_db._row_converter(["is_active"], {})
+    assert convert((1,)) == (1,)
@@ -0,0 +1,228 @@
+import math
+import threading
+import time
+from collections import deque
+from config import (
+    ADMISSION_MAX_IN_FLIGHT, ADMISSION_MAX_QUEUE, ADMISSION_MAX_WAIT,
+    ADMISSION_LANE_WEIGHTS, ADMISSION_DEFAULT_LANE, ADMISSION_STARVATION_SECONDS,
+    ADMISSION_HIGH_TIER_MIN_USAGE, ADMISSION_LOW_TIER_MAX_USAGE
+)
+from utils.performance_monitor import performance_monitor
+from utils import metrics
+
+# Admission control cho các endpoint tạo nội dung (voice/image/music/clone voice), tính theo worker.
+# Mỗi module có 1 cổng: tối đa max_in_flight request đang gọi upstream, thêm tối đa max_queue request
+# chờ không quá ADMISSION_MAX_WAIT giây. Hàng đợi đầy hoặc chờ quá lâu -> 503 + Retry-After ngay,
+# nên khi Gemini chậm request không dồn tới gunicorn timeout và /auth, /status, admin vẫn trả lời bình thường.
+#
+# Request phải chờ được xếp vào lane theo hạng key (high/normal/low, xem lane_for_key). Slot trống được
+# giao thẳng cho request kế tiếp theo weighted fair queuing (stride: lane weight cao được chọn thường hơn);
+# request đã chờ quá ADMISSION_STARVATION_SECONDS được ưu tiên trước để lane thấp không bị bỏ đói.
+
+
+def lane_for_key(key_info):
+    """Lane of a key: explicit keys.priority, else its max_usage tier"""
+    if not key_info:
+        return ADMISSION_DEFAULT_LANE
+    if key_info.get("priority") in ADMISSION_LANE_WEIGHTS:
+        return key_info["priority"]
+    try:
+        max_usage = int(key_info["max_usage"]) if key_info.get("max_usage") not in (None, "") else None
+    except (TypeError, ValueError):
+        return ADMISSION_DEFAULT_LANE
+    if max_usage is None or max_usage >= ADMISSION_HIGH_TIER_MIN_USAGE:
+        return "high"  # không giới hạn / gói lớn
+    if max_usage <= ADMISSION_LOW_TIER_MAX_USAGE:
+        return "low"  # key dùng thử
+    return ADMISSION_DEFAULT_LANE
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, module, reason, retry_after):
+        super().__init__(f"{module}: {reason}")
+        self.module = module
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class _Ticket:
+    __slots__ = ("lane", "enqueued_at", "granted")
+
+    def __init__(self, lane):
+        self.lane = lane
+        self.enqueued_at = time.monotonic()
+        self.granted = False
+
+
+class _Lane:
+    def __init__(self, name, weight):
+        self.name = name
+        self.weight = max(1, weight)
+        self.waiters = deque()
+        self.pass_value = 0.0  # stride scheduling: lane có pass nhỏ nhất được phục vụ trước
+        self.stats = {"admitted": 0, "queued": 0, "rejected": 0, "promoted": 0, "total_wait": 0.0, "max_wait": 0.0}
+
+    def get_stats(self):
+        stats = dict(self.stats)
+        stats["weight"] = self.weight
+        stats["waiting"] = len(self.waiters)
+        stats["average_wait_ms"] = stats["total_wait"] / stats["admitted"] * 1000 if stats["admitted"] else 0
+        stats["max_wait_ms"] = stats.pop("max_wait") * 1000
+        del stats["total_wait"]
+        return stats
+
+
+class AdmissionGate:
+    def __init__(self, module, max_in_flight, max_queue, max_wait,
+                 lane_weights=ADMISSION_LANE_WEIGHTS, starvation_seconds=ADMISSION_STARVATION_SECONDS):
+        self.module = module
+        self.max_in_flight = max(1, max_in_flight)
+        self.max_queue = max(0, max_queue)
+        self.max_wait = max_wait
+        self.starvation_seconds = starvation_seconds
+        self.in_flight = 0
+        self.waiting = 0
+        self._lanes = {name: _Lane(name, weight) for name, weight in lane_weights.items()}
+        self._virtual_time = 0.0  # pass của lane vừa được phục vụ
+        self._cond = threading.Condition()
+        self._avg_hold = 1.0  # EWMA thời gian giữ slot, dùng để ước lượng Retry-After
+        self._stats = {
+            "admitted": 0, "queued": 0, "rejected_queue_full": 0, "rejected_timeout": 0,
+            "total_wait": 0.0, "max_wait": 0.0, "peak_in_flight": 0, "peak_waiting": 0,
+        }
+
+    def _retry_after(self):
+        # Thời gian ước lượng để xả hết hàng đợi hiện tại
+        backlog = (self.waiting + 1) / self.max_in_flight
+        return max(1, min(60, math.ceil(backlog * self._avg_hold)))
+
+    def _reject(self, reason, lane=None):
+        self._stats[f"rejected_{reason}"] += 1
+        if lane is not None:
+            lane.stats["rejected"] += 1
+        performance_monitor.record_error(f"admission:{self.module}", reason)
+        metrics.observe_admission_rejected(self.module, lane.name if lane is not None else "", reason)
+        return AdmissionRejected(self.module, reason, self._retry_after())
+
+    def _has_free_slot(self):
+        return self.in_flight < self.max_in_flight and self.waiting == 0
+
+    def acquire(self, lane_resolver=None):
+        """Take a slot, waiting in a priority lane if needed; returns seconds waited or raises AdmissionRejected.
+
+        lane_resolver() is only called when the request has to queue.
+        """
+        with self._cond:
+            if self._has_free_slot():
+                return self._admit(0.0)
+
+        lane_name = lane_resolver() if lane_resolver else ADMISSION_DEFAULT_LANE
+        lane = self._lanes.get(lane_name) or self._lanes[ADMISSION_DEFAULT_LANE]
+
+        with self._cond:
+            if self._has_free_slot():
+                return self._admit(0.0, lane)
+            if self.waiting >= self.max_queue:
+                raise self._reject("queue_full", lane)
+
+            ticket = _Ticket(lane)
+            if not lane.waiters:
+                # Lane vừa có việc lại: không được dồn "tín dụng" từ lúc rảnh
+                lane.pass_value = max(lane.pass_value, self._virtual_time)
+            lane.waiters.append(ticket)
+            lane.stats["queued"] += 1
+            self.waiting += 1
+            self._stats["queued"] += 1
+            self._stats["peak_waiting"] = max(self._stats["peak_waiting"], self.waiting)
+            self._publish_depth()
+
+            deadline = ticket.enqueued_at + self.max_wait
+            while not ticket.granted:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    lane.waiters.remove(ticket)
+                    self.waiting -= 1
+                    self._publish_depth()
+                    raise self._reject("timeout", lane)
+                self._cond.wait(remaining)
+            # Slot đã được release() giao cho ticket này (in_flight đã tăng sẵn)
+            return time.monotonic() - ticket.enqueued_at
+
+    def _publish_depth(self):
+        metrics.set_admission_depth(self.module, self.in_flight, self.waiting)
+
+    def _admit(self, waited, lane=None):
+        self.in_flight += 1
+        self._publish_depth()
+        stats = self._stats
+        stats["admitted"] += 1
+        stats["total_wait"] += waited
+        stats["max_wait"] = max(stats["max_wait"], waited)
+        stats["peak_in_flight"] = max(stats["peak_in_flight"], self.in_flight)
+        if lane is not None:
+            lane.stats["admitted"] += 1
+            lane.stats["total_wait"] += waited
+            lane.stats["max_wait"] = max(lane.stats["max_wait"], waited)
+        return waited
+
+    def _next_lane(self):
+        now = time.monotonic()
+        # Chống bỏ đói: request chờ lâu nhất được phục vụ nếu đã quá ngưỡng
+        oldest = min(
+            (lane for lane in self._lanes.values() if lane.waiters),
+            key=lambda lane: lane.waiters[0].enqueued_at,
+        )
+        if now - oldest.waiters[0].enqueued_at >= self.starvation_seconds:
+            oldest.stats["promoted"] += 1
+            return oldest
+        return min((lane for lane in self._lanes.values() if lane.waiters), key=lambda lane: lane.pass_value)
+
+    def release(self, held):
+        with self._cond:
+            self.in_flight -= 1
+            self._avg_hold = self._avg_hold * 0.9 + held * 0.1
+            self._publish_depth()
+            if self.waiting and self.in_flight < self.max_in_flight:
+                lane = self._next_lane()
+                ticket = lane.waiters.popleft()
+                self._virtual_time = lane.pass_value
+                lane.pass_value += 1.0 / lane.weight
+                self.waiting -= 1
+                ticket.granted = True
+                self._admit(time.monotonic() - ticket.enqueued_at, lane)
+                self._cond.notify_all()
+
+    def get_stats(self):
+        with self._cond:
+            stats = dict(self._stats)
+            stats.update(
+                in_flight=self.in_flight,
+                waiting=self.waiting,
+                max_in_flight=self.max_in_flight,
+                max_queue=self.max_queue,
+                max_wait_seconds=self.max_wait,
+                average_hold_seconds=round(self._avg_hold, 3),
+                lanes={name: lane.get_stats() for name, lane in self._lanes.items()},
+            )
+        stats["average_wait_ms"] = stats["total_wait"] / stats["admitted"] * 1000 if stats["admitted"] else 0
+        stats["max_wait_ms"] = stats.pop("max_wait") * 1000
+        del stats["total_wait"]
+        return stats
+
+
+class AdmissionController:
+    def __init__(self, max_in_flight, max_queue, max_wait):
+        self._gates = {
+            module: AdmissionGate(module, limit, max_queue.get(module, limit), max_wait)
+            for module, limit in max_in_flight.items()
+        }
+
+    def gate(self, module):
+        """Gate of a module, None when the module has no limit"""
+        return self._gates.get(module)
+
+    def get_stats(self):
+        return {module: gate.get_stats() for module, gate in self._gates.items()}
+
+
+admission_controller = AdmissionController(ADMISSION_MAX_IN_FLIGHT, ADMISSION_MAX_QUEUE, ADMISSION_MAX_WAIT)
@@ -0,0 +1,154 @@
+import asyncio
+import os
+import threading
+import time
+import weakref
+import httpx
+from config import (
+    TTS_CHUNK_MAX_CHARS, TTS_MAX_PARALLEL, IMAGE_MAX_PARALLEL,
+    UPSTREAM_MAX_CONNECTIONS, UPSTREAM_MAX_KEEPALIVE, UPSTREAM_TIMEOUT
+)
+from utils.gemini_client import (
+    GEMINI_TTS_URL, GEMINI_IMAGE_URL, gemini_headers, tts_payload, parse_tts_response,
+    image_payload, parse_image_response, write_image, write_tts_audio,
+    get_healthy_keys, mark_key_ok, mark_key_failed, UpstreamHTTPError
+)
+from utils.text_utils import split_text_for_tts
+from utils.performance_monitor import performance_monitor
+from utils.metrics import upstream_outcome
+from utils.tracing import tracer, mask_key, mask_proxy
+from utils.audio_encoder import normalize_audio_format, normalize_bitrate
+
+# Client upstream async (httpx) cho các endpoint tạo voice/image khi chạy qua asgi.py.
+# Mỗi worker có 1 event loop nền: mọi request đang chờ Gemini dùng chung loop + pool connection,
+# view chỉ chờ kết quả (run_upstream). Phần blocking (encode ffmpeg, ghi file, DB) đẩy sang thread.
+# Không dùng với worker gevent: asyncio trong hub gevent tốn CPU hơn nhiều so với requests + greenlet,
+# nên wsgi.py giữ đường đồng bộ (utils.gemini_client).
+
+_clients = weakref.WeakKeyDictionary()  # event loop -> {proxy: AsyncClient}
+
+_loop = None
+_loop_pid = None
+_loop_lock = threading.Lock()
+
+
+def get_client(proxy=None):
+    """Pooled AsyncClient for the running loop (one per proxy)"""
+    clients = _clients.setdefault(asyncio.get_running_loop(), {})
+    client = clients.get(proxy)
+    if client is None:
+        client = httpx.AsyncClient(
+            proxy=proxy,
+            timeout=UPSTREAM_TIMEOUT,
+            limits=httpx.Limits(max_connections=UPSTREAM_MAX_CONNECTIONS, max_keepalive_connections=UPSTREAM_MAX_KEEPALIVE),
+        )
+        clients[proxy] = client
+    return client
+
+
+def _get_loop():
+    # Loop tạo sau fork: mỗi worker có loop + thread riêng
+    global _loop, _loop_pid
+    if _loop_pid != os.getpid():
+        with _loop_lock:
+            if _loop_pid != os.getpid():
+                _loop = asyncio.new_event_loop()
+                threading.Thread(target=_loop.run_forever, name="upstream-loop", daemon=True).start()
+                _loop_pid = os.getpid()
+    return _loop
+
+
+def run_upstream(coro):
+    """Run a coroutine on the worker's upstream loop and wait for its result"""
+    return asyncio.run_coroutine_threadsafe(coro, _get_loop()).result()
+
+
+async def _post_json(url, api_key, payload, proxy, operation):
+    # Mỗi coroutine chạy trong task riêng (context riêng) nên span của các chunk song song không lẫn nhau
+    with tracer.span("upstream.gemini", **{
+        "upstream.operation": operation, "upstream.key": mask_key(api_key), "upstream.proxy": mask_proxy(proxy)
+    }):
+        started = time.time()
+        error = None
+        try:
+            response = await get_client(proxy).post(url, headers=gemini_headers(api_key), json=payload)
+            if response.status_code != 200:
+                raise UpstreamHTTPError(response.status_code, f"Lỗi HTTP {response.status_code} từ Gemini: {response.text[:300]}")
+            return response.json()
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            performance_monitor.record_api_call_time(
+                f"gemini:{operation}", time.time() - started, error is None, api_key, proxy, upstream_outcome(error)
+            )
+
+
+async def gemini_tts_pcm_async(text, voice_name, api_key_list, proxies=None, start_index=0):
+    """Async gemini_tts_pcm: same key rotation, starting at start_index"""
+    proxies = proxies or [None]
+    total = len(api_key_list)
+    for n in range(total):
+        i = (start_index + n) % total
+        api_key = api_key_list[i]
+        proxy = proxies[i % len(proxies)]
+        try:
+            pcm_bytes = parse_tts_response(await _post_json(GEMINI_TTS_URL, api_key, tts_payload(text, voice_name), proxy, "tts"))
+            mark_key_ok(api_key)
+            return pcm_bytes
+        except Exception as e:
+            print(f"Key {api_key[:20]} lỗi: {e}")
+            await asyncio.to_thread(mark_key_failed, api_key, e)  # 429 ghi cooldown xuống DB
+
+    raise Exception("Không có key nào khả dụng để tạo voice.")
+
+
+async def gemini_tts_request_async(text, voice_name, output_dir, api_key_list, proxies=None,
+                                   audio_format="mp3", bitrate=None, key_offset=0):
+    """Async gemini_tts_request: chunks are synthesized concurrently on the loop"""
+    audio_format = normalize_audio_format(audio_format)
+    bitrate = normalize_bitrate(bitrate)
+
+    chunks = split_text_for_tts(text, TTS_CHUNK_MAX_CHARS) or [text]
+    ordered_keys, healthy_count = get_healthy_keys(api_key_list)
+    spread = max(healthy_count, 1)
+    limit = asyncio.Semaphore(max(1, min(len(chunks), TTS_MAX_PARALLEL, len(api_key_list))))
+
+    async def synthesize(index, chunk):
+        async with limit:
+            return await gemini_tts_pcm_async(chunk, voice_name, ordered_keys, proxies, (key_offset + index) % spread)
+
+    pcm_parts = await asyncio.gather(*(synthesize(i, chunk) for i, chunk in enumerate(chunks)))
+    return await asyncio.to_thread(write_tts_audio, b"".join(pcm_parts), output_dir, audio_format, bitrate)
+
+
+async def gemini_image_request_async(prompt_text, output_dir, api_key_list, proxies=None, start_index=0):
+    """Async gemini_image_request; returns the saved image path"""
+    proxies = proxies or [None]
+    total = len(api_key_list)
+    for n in range(total):
+        i = (start_index + n) % total
+        api_key = api_key_list[i]
+        proxy = proxies[i % len(proxies)]
+        try:
+            image_bytes = parse_image_response(await _post_json(GEMINI_IMAGE_URL, api_key, image_payload(prompt_text), proxy, "image"))
+            mark_key_ok(api_key)
+            return await asyncio.to_thread(write_image, image_bytes, output_dir)
+        except Exception as e:
+            print(f"🔥 Key {api_key[:20]} lỗi: {e}")
+            await asyncio.to_thread(mark_key_failed, api_key, e)
+
+    raise Exception("🚫 Không có key nào khả dụng để tạo ảnh.")
+
+
+async def gemini_image_variants_async(prompts, output_dir, api_key_list, proxies=None):
+    """Async gemini_image_variants: image path or exception per prompt, in order"""
+    ordered_keys, healthy_count = get_healthy_keys(api_key_list)
+    spread = max(healthy_count, 1)
+    limit = asyncio.Semaphore(max(1, min(len(prompts), IMAGE_MAX_PARALLEL, len(api_key_list))))
+
+    async def generate(index):
+        async with limit:
+            return await gemini_image_request_async(prompts[index], output_dir, ordered_keys, proxies, index % spread)
+
+    return await asyncio.gather(*(generate(i) for i in range(len(prompts))), return_exceptions=True)
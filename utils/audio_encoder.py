@@ -0,0 +1,132 @@
+import os
+import re
+import time
+import wave
+import ffmpeg
+from utils.performance_monitor import performance_monitor
+from utils.tracing import tracer
+
+# Gemini TTS trả về PCM s16le, 24kHz, mono
+PCM_SAMPLE_RATE = 24000
+PCM_CHANNELS = 1
+PCM_SAMPLE_WIDTH = 2
+
+# Các định dạng output hỗ trợ. codec = None -> ghi thẳng PCM, không qua ffmpeg
+AUDIO_FORMATS = {
+    "mp3": {"ext": "mp3", "container": "mp3", "codec": "libmp3lame", "default_bitrate": "128k", "mimetype": "audio/mpeg"},
+    "opus": {"ext": "opus", "container": "opus", "codec": "libopus", "default_bitrate": "48k", "mimetype": "audio/ogg"},
+    "ogg": {"ext": "ogg", "container": "ogg", "codec": "libvorbis", "default_bitrate": "96k", "mimetype": "audio/ogg"},
+    "wav": {"ext": "wav", "container": None, "codec": None, "default_bitrate": None, "mimetype": "audio/wav"},
+    "pcm": {"ext": "pcm", "container": None, "codec": None, "default_bitrate": None, "mimetype": "application/octet-stream"},
+}
+DEFAULT_AUDIO_FORMAT = "mp3"
+
+_BITRATE_RE = re.compile(r"^(\d{2,3})k$")
+MIN_BITRATE_KBPS = 16
+MAX_BITRATE_KBPS = 320
+
+
+def normalize_audio_format(audio_format):
+    """Validate format name, fallback to mp3 when empty"""
+    audio_format = (audio_format or DEFAULT_AUDIO_FORMAT).strip().lower()
+    if audio_format not in AUDIO_FORMATS:
+        raise ValueError(f"❌ Định dạng không hỗ trợ: {audio_format} (hỗ trợ: {', '.join(AUDIO_FORMATS)})")
+    return audio_format
+
+
+def normalize_bitrate(bitrate):
+    """Validate bitrate like '64k' or '64', return None when empty"""
+    if bitrate is None:
+        return None
+    bitrate = str(bitrate).strip().lower()
+    if not bitrate:
+        return None
+    if bitrate.isdigit():
+        bitrate = f"{bitrate}k"
+    match = _BITRATE_RE.match(bitrate)
+    if not match or not MIN_BITRATE_KBPS <= int(match.group(1)) <= MAX_BITRATE_KBPS:
+        raise ValueError(f"❌ Bitrate không hợp lệ: {bitrate} ({MIN_BITRATE_KBPS}k-{MAX_BITRATE_KBPS}k)")
+    return bitrate
+
+
+def pcm_duration(pcm_bytes):
+    """Duration (seconds) of raw PCM without decoding anything"""
+    frame_size = PCM_SAMPLE_WIDTH * PCM_CHANNELS
+    return round(len(pcm_bytes) / frame_size / PCM_SAMPLE_RATE, 2)
+
+
+def _ffmpeg_output_args(audio_format, bitrate):
+    spec = AUDIO_FORMATS[audio_format]
+    args = {"format": spec["container"], "acodec": spec["codec"]}
+    bitrate = bitrate or spec["default_bitrate"]
+    if bitrate:
+        args["audio_bitrate"] = bitrate
+    return args
+
+
+def _pcm_input():
+    return ffmpeg.input("pipe:", f="s16le", ar=str(PCM_SAMPLE_RATE), ac=str(PCM_CHANNELS))
+
+
+def encode_pcm(pcm_bytes, audio_format=DEFAULT_AUDIO_FORMAT, bitrate=None):
+    """Encode PCM in memory and return the encoded bytes"""
+    audio_format = normalize_audio_format(audio_format)
+    start_time = time.time()
+    try:
+        if audio_format == "pcm":
+            return pcm_bytes
+        if audio_format == "wav":
+            return _wav_header(len(pcm_bytes)) + pcm_bytes
+
+        with tracer.span("audio.encode", **{"audio.format": audio_format, "audio.pcm_bytes": len(pcm_bytes)}):
+            out, _ = _pcm_input() \
+                .output("pipe:", **_ffmpeg_output_args(audio_format, bitrate)) \
+                .run(input=pcm_bytes, capture_stdout=True, capture_stderr=True)
+        return out
+    finally:
+        performance_monitor.record_encode_time(audio_format, time.time() - start_time, len(pcm_bytes))
+
+
+def write_audio(pcm_bytes, output_base, audio_format=DEFAULT_AUDIO_FORMAT, bitrate=None):
+    """Write PCM to `output_base.<ext>`, encoding only when the format needs it"""
+    audio_format = normalize_audio_format(audio_format)
+    output_path = f"{output_base}.{AUDIO_FORMATS[audio_format]['ext']}"
+    # ffmpeg ghi thẳng ra file: 1 span cho cả encode + ghi
+    span_name = "audio.encode" if AUDIO_FORMATS[audio_format]["codec"] else "file.write_audio"
+    start_time = time.time()
+    try:
+        with tracer.span(span_name, **{"audio.format": audio_format, "audio.pcm_bytes": len(pcm_bytes)}):
+            if audio_format == "pcm":
+                with open(output_path, "wb") as f:
+                    f.write(pcm_bytes)
+            elif audio_format == "wav":
+                with wave.open(output_path, "wb") as wav_file:
+                    wav_file.setnchannels(PCM_CHANNELS)
+                    wav_file.setsampwidth(PCM_SAMPLE_WIDTH)
+                    wav_file.setframerate(PCM_SAMPLE_RATE)
+                    wav_file.writeframes(pcm_bytes)
+            else:
+                _pcm_input() \
+                    .output(output_path, **_ffmpeg_output_args(audio_format, bitrate)) \
+                    .run(input=pcm_bytes, overwrite_output=True, quiet=True)
+    except Exception:
+        if os.path.exists(output_path):
+            os.remove(output_path)
+        raise
+    finally:
+        performance_monitor.record_encode_time(audio_format, time.time() - start_time, len(pcm_bytes))
+    return output_path
+
+
+def _wav_header(data_size):
+    """RIFF header for PCM s16le mono 24kHz"""
+    byte_rate = PCM_SAMPLE_RATE * PCM_CHANNELS * PCM_SAMPLE_WIDTH
+    block_align = PCM_CHANNELS * PCM_SAMPLE_WIDTH
+    return b"".join([
+        b"RIFF", (36 + data_size).to_bytes(4, "little"), b"WAVE",
+        b"fmt ", (16).to_bytes(4, "little"), (1).to_bytes(2, "little"),
+        PCM_CHANNELS.to_bytes(2, "little"), PCM_SAMPLE_RATE.to_bytes(4, "little"),
+        byte_rate.to_bytes(4, "little"), block_align.to_bytes(2, "little"),
+        (PCM_SAMPLE_WIDTH * 8).to_bytes(2, "little"),
+        b"data", data_size.to_bytes(4, "little"),
+    ])
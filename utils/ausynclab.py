@@ -1,30 +1,24 @@
 import os
+import uuid
 import requests
-from pydub import AudioSegment
-
-def _ensure_proxies(proxies):
-    return proxies if proxies else [None]
-
-def _prepare_audio(audio_file_path):
-    if audio_file_path.lower().endswith(".mp3"):
-        audio = AudioSegment.from_mp3(audio_file_path)
-        wav_path = audio_file_path.rsplit(".", 1)[0] + ".wav"
-        audio.export(wav_path, format="wav")
-        return wav_path
+import ffmpeg
 import time
-from pydub import AudioSegment
+from urllib.parse import urlsplit
+from config import UPLOAD_CHUNK_SIZE
+from utils.performance_monitor import performance_monitor
+from utils.metrics import upstream_outcome
+from utils.tracing import tracer, mask_key, mask_proxy
 
 def _ensure_proxies(proxies):
     """Ensure proxies is always a list"""
     return proxies if proxies else [None]
 
 def _prepare_audio(audio_file_path):
-    """Convert MP3 to WAV if needed"""
+    """Convert MP3 to WAV if needed (ffmpeg file -> file, không decode vào RAM)"""
     if audio_file_path.lower().endswith(".mp3"):
         try:
-            audio = AudioSegment.from_mp3(audio_file_path)
             wav_path = audio_file_path.rsplit(".", 1)[0] + ".wav"
-            audio.export(wav_path, format="wav")
+            ffmpeg.input(audio_file_path).output(wav_path, format="wav").run(overwrite_output=True, quiet=True)
             return wav_path
         except Exception as e:
             print(f"❌ Lỗi khi convert MP3 sang WAV: {e}")
@@ -52,9 +46,21 @@ def create_clone_voice_tts(voice_name, language, gender, age, audio_file_path, k
 def _safe_request(method, url, headers, proxies, **kwargs):
     """Make HTTP request with proxy support and error handling"""
     for proxy in _ensure_proxies(proxies):
+        span = tracer.span("upstream.ausynclab", **{
+            "upstream.operation": f"{method} {urlsplit(url).path}",
+            "upstream.key": mask_key(headers.get("X-API-Key")),
+            "upstream.proxy": mask_proxy(proxy),
+        })
+        started = time.time()
         try:
-            proxy_dict = {"http": proxy, "https": proxy} if proxy else None
-            resp = requests.request(method, url, headers=headers, proxies=proxy_dict, **kwargs)
+            with span:
+                proxy_dict = {"http": proxy, "https": proxy} if proxy else None
+                resp = requests.request(method, url, headers=headers, proxies=proxy_dict, **kwargs)
+                span.set_attribute("http.status_code", resp.status_code)
+            performance_monitor.record_api_call_time(
+                "ausynclab", time.time() - started, resp.status_code < 400, headers.get("X-API-Key"), proxy,
+                upstream_outcome(status_code=resp.status_code)
+            )
             print(f"🔍 {method} {url} -> {resp.status_code}")
             print(f"📄 Response: {resp.text[:200]}...")
             
@@ -71,26 +77,61 @@ def _safe_request(method, url, headers, proxies, **kwargs):
                 return resp
                 
         except Exception as e:
+            performance_monitor.record_api_call_time(
+                "ausynclab", time.time() - started, False, headers.get("X-API-Key"), proxy, upstream_outcome(e)
+            )
             print(f"❌ Request error with proxy {proxy}: {e}")
             continue
     
     return None
 
+class MultipartFileBody:
+    """multipart/form-data body for one file, streamed from disk.
+
+    Has a known length (so requests sends Content-Length, not chunked) and
+    re-opens the file on every iteration, so a retry through another proxy
+    sends the whole body again.
+    """
+    def __init__(self, field_name, file_path, filename, content_type):
+        self.file_path = file_path
+        self.boundary = uuid.uuid4().hex
+        self.content_type = f"multipart/form-data; boundary={self.boundary}"
+        self.head = (
+            f"--{self.boundary}\r\n"
+            f'Content-Disposition: form-data; name="{field_name}"; filename="{filename}"\r\n'
+            f"Content-Type: {content_type}\r\n\r\n"
+        ).encode("utf-8")
+        self.tail = f"\r\n--{self.boundary}--\r\n".encode("utf-8")
+
+    def __len__(self):
+        return len(self.head) + os.path.getsize(self.file_path) + len(self.tail)
+
+    def __iter__(self):
+        yield self.head
+        with open(self.file_path, "rb") as f:
+            for chunk in iter(lambda: f.read(UPLOAD_CHUNK_SIZE), b""):
+                yield chunk
+        yield self.tail
+
 def create_clone_voice_tts(voice_name, language, gender, age, audio_file_path, key, use_case="CASUAL", proxies=None):
     """Create voice clone with TTS capability"""
     print(f"🎯 Creating voice clone: {voice_name}")
     
     # Prepare audio file
-    audio_file_path = _prepare_audio(audio_file_path)
-    if not audio_file_path:
+    wav_path = _prepare_audio(audio_file_path)
+    if not wav_path:
         return {"success": False, "error": "❌ File không hợp lệ. Chỉ hỗ trợ mp3 hoặc wav."}
 
     url = "https://api.ausynclab.org/api/v1/voices/register"
     params = dict(name=voice_name, language=language, gender=gender, age=age, use_case=use_case)
-    headers = {"accept": "application/json", "X-API-Key": key}
-    files = {"audio_file": (os.path.basename(audio_file_path), open(audio_file_path, "rb"), "audio/wav")}
+    body = MultipartFileBody("audio_file", wav_path, os.path.basename(wav_path), "audio/wav")
+    headers = {"accept": "application/json", "X-API-Key": key, "Content-Type": body.content_type}
 
-    resp = _safe_request("POST", url, headers, proxies, params=params, files=files)
+    try:
+        resp = _safe_request("POST", url, headers, proxies, params=params, data=body)
+    finally:
+        if wav_path != audio_file_path:
+            os.remove(wav_path)  # WAV tạm convert từ MP3
     if not resp:
         return {"success": False, "error": "❌ Không thể tạo voice (proxy hoặc API lỗi)."}
 
@@ -114,7 +155,12 @@ def create_clone_voice_tts(voice_name, language, gender, age, audio_file_path, k
         return {"success": False, "error": "❌ Không nhận được voice_id từ phản hồi."}
 
     detail = get_voice_detail(voice_id, key, proxies)
-    return {"success": True, "data": detail.get("data") if detail.get("success") else {}}
+    return {
+        "success": True,
+        "voice_id": voice_id,
+        "data": detail.get("data") if detail.get("success") else {},
+        "detail_loaded": bool(detail.get("success"))
+    }
 
 def get_voice_detail(voice_id, key, proxies=None):
     url = f"https://api.ausynclab.org/api/v1/voices/{voice_id}"
@@ -0,0 +1,85 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from flask import Response, current_app, request
+
+# Payload tĩnh (voice list, languages, version.json) được serialize sẵn thành bytes + ETag.
+# Chỉ build lại khi mtime của file/thư mục nguồn thay đổi; client gửi If-None-Match -> 304.
+CATALOG_CHECK_INTERVAL = 1.0  # giây giữa hai lần stat file nguồn
+CATALOG_MAX_ENTRIES = 64
+# Payload có URL tuyệt đối (voice list) build 1 lần với BASE_URL_PLACEHOLDER, host của request được thay vào lúc
+# trả response -> cache không phụ thuộc header Host do client gửi
+BASE_URL_PLACEHOLDER = "__CATALOG_BASE_URL__"
+
+_entries = {}
+_lock = threading.Lock()
+
+
+class CatalogEntry:
+    def __init__(self, body, mtimes):
+        self.body = body
+        self.etag = hashlib.sha1(body).hexdigest()
+        self.mtimes = mtimes
+        self.checked_at = time.time()
+
+
+def _source_mtimes(sources):
+    mtimes = []
+    for path in sources:
+        try:
+            mtimes.append(os.stat(path).st_mtime_ns)
+        except OSError:
+            mtimes.append(None)
+    return tuple(mtimes)
+
+
+def _serialize(payload):
+    if isinstance(payload, bytes):
+        return payload
+    return current_app.json.dumps(payload).encode("utf-8") + b"\n"
+
+
+def get_catalog_entry(key, builder, sources=()):
+    """Cached entry for `key`, rebuilt when any source file's mtime changed"""
+    entry = _entries.get(key)
+    now = time.time()
+    if entry is not None and now - entry.checked_at < CATALOG_CHECK_INTERVAL:
+        return entry
+
+    mtimes = _source_mtimes(sources)
+    if entry is not None and entry.mtimes == mtimes:
+        entry.checked_at = now
+        return entry
+
+    with _lock:
+        entry = _entries.get(key)
+        if entry is None or entry.mtimes != mtimes:
+            if len(_entries) >= CATALOG_MAX_ENTRIES:
+                _entries.clear()
+            entry = CatalogEntry(_serialize(builder()), mtimes)
+            _entries[key] = entry
+    return entry
+
+
+def catalog_response(key, builder, sources=(), mimetype="application/json", base_url=None):
+    """Serve a precomputed payload with a strong ETag (304 on If-None-Match).
+
+    With base_url, BASE_URL_PLACEHOLDER in the cached body is replaced by it.
+    """
+    entry = get_catalog_entry(key, builder, sources)
+    body, etag = entry.body, entry.etag
+    if base_url is not None:
+        escaped = json.dumps(base_url)[1:-1].encode("utf-8")  # host do client gửi: escape trước khi chèn vào JSON
+        body = body.replace(BASE_URL_PLACEHOLDER.encode("utf-8"), escaped)
+        etag = hashlib.sha1(etag.encode("utf-8") + escaped).hexdigest()
+    response = Response(body, mimetype=mimetype)
+    response.set_etag(etag)
+    response.cache_control.no_cache = True  # luôn revalidate, 304 gần như miễn phí
+    return response.make_conditional(request)
+
+
+def clear_catalog():
+    with _lock:
+        _entries.clear()
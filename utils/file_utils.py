@@ -1,12 +1,8 @@
 import os
 import time
 import uuid
-from functools import lru_cache
-
-# Performance optimizations
-_proxy_cache = {}
-_proxy_cache_timestamp = {}
-PROXY_CACHE_TTL = 300  # Cache proxies for 5 minutes
+from config import PROXIES_FILE
+from utils.provider_registry import provider_registry
 
 
 def ensure_dir(path):
@@ -22,9 +18,8 @@ def create_unique_output_dir(base_dir):
     ensure_dir(path)
     return path
 
-@lru_cache(maxsize=32)
 def _load_proxies_from_file(file_path):
-    """Load proxies from file with caching"""
+    """Parse proxies file (ip:port:user:pass or a full URL per line)"""
     proxies = []
     try:
         with open(file_path, "r", encoding='utf-8') as f:
@@ -43,28 +38,12 @@ def _load_proxies_from_file(file_path):
     return proxies
 
 def load_proxies(file_path):
-    """Load proxies with intelligent caching"""
-    current_time = time.time()
-    
-    # Check if cache is valid
-    if (file_path in _proxy_cache and 
-        current_time - _proxy_cache_timestamp.get(file_path, 0) < PROXY_CACHE_TTL):
-        return _proxy_cache[file_path]
-    
-    # Load fresh proxies
-    proxies = _load_proxies_from_file(file_path)
-    
-    # Cache the result
-    _proxy_cache[file_path] = proxies
-    _proxy_cache_timestamp[file_path] = current_time
-    
-    return proxies
+    """Load proxies (reloaded when the file changes, see utils.provider_registry)"""
+    return provider_registry.get(file_path, _load_proxies_from_file)
 
-def clear_proxy_cache():
-    """Clear proxy cache"""
-    global _proxy_cache, _proxy_cache_timestamp
-    _proxy_cache.clear()
-    _proxy_cache_timestamp.clear()
+def clear_proxy_cache(file_path=None):
+    """Re-read the proxies file now"""
+    provider_registry.reload(file_path or PROXIES_FILE)
 
 def get_file_size(file_path):
     """Get file size efficiently"""
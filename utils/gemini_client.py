@@ -3,17 +3,27 @@ import base64
 import os
 import random
 import time
-import ffmpeg
+import uuid
 from mutagen.mp3 import MP3
 from requests.exceptions import SSLError, Timeout, ProxyError, ConnectionError
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
 from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from config import TTS_CHUNK_MAX_CHARS, TTS_MAX_PARALLEL, IMAGE_MAX_PARALLEL, GEMINI_API_BASE
+from utils.text_utils import split_text_for_tts
+from utils.audio_encoder import normalize_audio_format, normalize_bitrate, pcm_duration, write_audio
+from utils.provider_credentials import provider_credentials
+from utils.performance_monitor import performance_monitor
+from utils.metrics import upstream_outcome
+from utils.tracing import tracer, traced, propagate, mask_key, mask_proxy
 
 # Performance optimizations
 _session_cache = {}
 _session_cache_timestamp = {}
 SESSION_CACHE_TTL = 600  # Cache sessions for 10 minutes
+_key_cooldown_until = {}
+KEY_COOLDOWN_SECONDS = 60  # Key lỗi bị xếp cuối danh sách trong 60s
 
 def create_session_with_retry():
     """Create requests session with retry strategy and connection pooling"""
@@ -63,78 +73,195 @@ def get_audio_duration(file_path):
         print(f"Error getting audio duration: {e}")
         return 0
 
-def gemini_tts_request(text, voice_name, output_dir, api_key_list, proxies=None):
-    """Generate TTS with improved performance and error handling"""
+class UpstreamHTTPError(Exception):
+    def __init__(self, status_code, message):
+        super().__init__(message)
+        self.status_code = status_code
+
+def mark_key_failed(api_key, error=None):
+    """Tạm loại key khỏi nhóm 'healthy' trong KEY_COOLDOWN_SECONDS.
+
+    Gemini trả 429 (hết quota) -> ghi cooldown vào provider_credentials để mọi worker cùng xếp key xuống cuối.
+    """
+    _key_cooldown_until[api_key] = time.time() + KEY_COOLDOWN_SECONDS
+    if isinstance(error, UpstreamHTTPError) and error.status_code == 429:
+        provider_credentials.cool_down("gemini", api_key, KEY_COOLDOWN_SECONDS, str(error)[:300])
+
+def mark_key_ok(api_key):
+    _key_cooldown_until.pop(api_key, None)
+
+def get_healthy_keys(api_key_list):
+    """Keys not in cooldown first, cooling-down keys last (still usable as fallback)"""
+    now = time.time()
+    healthy = [k for k in api_key_list if _key_cooldown_until.get(k, 0) <= now]
+    cooling = [k for k in api_key_list if _key_cooldown_until.get(k, 0) > now]
+    return healthy + cooling, len(healthy)
+
+GEMINI_TTS_URL = f"{GEMINI_API_BASE}/v1beta/models/gemini-2.5-flash-preview-tts:generateContent"
+GEMINI_IMAGE_URL = f"{GEMINI_API_BASE}/v1beta/models/gemini-2.0-flash-preview-image-generation:generateContent"
+
+# Payload / parse dùng chung cho client đồng bộ (requests) và async (utils.async_upstream)
+def gemini_headers(api_key):
+    return {
+        "x-goog-api-key": api_key,
+        "Content-Type": "application/json"
+    }
+
+def tts_payload(text, voice_name):
+    return {
+        "contents": [{"parts": [{"text": text}]}],
+        "generationConfig": {
+            "responseModalities": ["AUDIO"],
+            "speechConfig": {
+                "voiceConfig": {
+                    "prebuiltVoiceConfig": {
+                        "voiceName": voice_name
+                    }
+                }
+            }
+        },
+        "model": "gemini-2.5-flash-preview-tts",
+    }
+
+def parse_tts_response(res_json):
+    audio_data = res_json['candidates'][0]['content']['parts'][0]['inlineData']['data']
+    return base64.b64decode(audio_data)
+
+def image_payload(prompt_text):
+    return {
+        "contents": [{
+            "parts": [{"text": prompt_text}]
+        }],
+        "generationConfig": {
+            "responseModalities": ["TEXT", "IMAGE"]
+        }
+    }
+
+def parse_image_response(res_json):
+    parts = res_json.get("candidates", [])[0].get("content", {}).get("parts", [])
+    image_part = next((p for p in parts if "inlineData" in p and "image" in p["inlineData"]["mimeType"]), None)
+
+    if not image_part:
+        raise Exception("⚠️ Không tìm thấy dữ liệu hình ảnh trong response.")
+    return base64.b64decode(image_part["inlineData"]["data"])
+
+@traced("file.write_image")
+def write_image(image_bytes, output_dir):
+    # uuid thay vì randint: các variant song song ghi chung một thư mục
+    uid = f"{int(time.time())}_{uuid.uuid4().hex[:8]}"
+    image_path = os.path.join(output_dir, f"{uid}.png")
+    
+    with open(image_path, "wb") as f:
+        f.write(image_bytes)
+    return image_path
+
+def gemini_tts_pcm(text, voice_name, api_key_list, proxies=None, start_index=0):
+    """Call Gemini TTS and return raw PCM (s16le 24kHz mono).
+
+    Keys are tried starting at start_index so concurrent callers spread across keys.
+    """
     if proxies is None or not proxies:
         proxies = [None]
 
     def task(api_key, proxy_dict):
         try:
-            url = "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash-preview-tts:generateContent"
-            headers = {
-                "x-goog-api-key": api_key,
-                "Content-Type": "application/json"
-            }
-            data = {
-                "contents": [{"parts": [{"text": text}]}],
-                "generationConfig": {
-                    "responseModalities": ["AUDIO"],
-                    "speechConfig": {
-                        "voiceConfig": {
-                            "prebuiltVoiceConfig": {
-                                "voiceName": voice_name
-                            }
-                        }
-                    }
-                },
-                "model": "gemini-2.5-flash-preview-tts",
-            }
-
             session = get_session(proxy_dict)
-            response = session.post(url, headers=headers, json=data, timeout=30)
+            response = session.post(GEMINI_TTS_URL, headers=gemini_headers(api_key), json=tts_payload(text, voice_name), timeout=30)
             
             if response.status_code != 200:
-                raise Exception(f"Lỗi HTTP {response.status_code} từ Gemini: {response.text[:300]}")
-
-            res_json = response.json()
-            audio_data = res_json['candidates'][0]['content']['parts'][0]['inlineData']['data']
-
-            uid = f"{int(time.time())}_{random.randint(1000,9999)}"
-            temp_pcm = os.path.join(output_dir, f"{uid}.pcm")
-            
-            with open(temp_pcm, "wb") as f:
-                f.write(base64.b64decode(audio_data))
+                raise UpstreamHTTPError(response.status_code, f"Lỗi HTTP {response.status_code} từ Gemini: {response.text[:300]}")
 
-            mp3_file = os.path.join(output_dir, f"{uid}.mp3")
-            try:
-                ffmpeg.input(temp_pcm, f='s16le', ar='24000', ac='1') \
-                    .output(mp3_file, **{'y': None}) \
-                    .run(overwrite_output=True, quiet=True)
-                os.remove(temp_pcm)
-                duration = get_audio_duration(mp3_file)
-            except Exception as e:
-                raise Exception(f"Lỗi convert hoặc đo thời lượng: {e}")
-
-            return mp3_file, duration
+            return parse_tts_response(response.json()), None
 
         except Exception as e:
             print(f"Key {api_key[:20]} lỗi: {e}")
-            return None
+            return None, e
 
     # Phân chia proxy theo key
     # Try each API key with proxy rotation
-    for i, api_key in enumerate(api_key_list):
+    total = len(api_key_list)
+    for n in range(total):
+        i = (start_index + n) % total
+        api_key = api_key_list[i]
         proxy_str = proxies[i % len(proxies)]
         proxy_dict = {"http": proxy_str, "https": proxy_str} if proxy_str else None
-        print(f"[VOICE] Thử key {i+1}/{len(api_key_list)}: {api_key[:20]} với proxy: {proxy_str}")
-        result = task(api_key, proxy_dict)
-        if result:
-            return result
+        print(f"[VOICE] Thử key {i+1}/{total}: {api_key[:20]} với proxy: {proxy_str}")
+        with tracer.span("upstream.gemini", **{
+            "upstream.operation": "tts", "upstream.key": mask_key(api_key), "upstream.proxy": mask_proxy(proxy_str)
+        }) as span:
+            started = time.time()
+            pcm_bytes, error = task(api_key, proxy_dict)
+            performance_monitor.record_api_call_time(
+                "gemini:tts", time.time() - started, error is None, api_key, proxy_str, upstream_outcome(error)
+            )
+            if error is not None:
+                span.record_error(error)
+        if pcm_bytes:
+            mark_key_ok(api_key)
+            return pcm_bytes
+        mark_key_failed(api_key, error)
 
     raise Exception("Không có key nào khả dụng để tạo voice.")
 
-def gemini_image_request(prompt_text, output_dir, api_key_list, proxies=None):
-    """Generate image with improved performance and error handling"""
+def submit_tts_chunks(executor, chunks, voice_name, api_key_list, proxies=None, key_offset=0):
+    """Submit one gemini_tts_pcm job per chunk, in order, spread over healthy keys"""
+    ordered_keys, healthy_count = get_healthy_keys(api_key_list)
+    spread = max(healthy_count, 1)
+    return [
+        executor.submit(propagate(gemini_tts_pcm), chunk, voice_name, ordered_keys, proxies, (key_offset + i) % spread)
+        for i, chunk in enumerate(chunks)
+    ]
+
+def tts_executor(chunk_count, api_key_list):
+    """Thread pool sized to the chunk count, capped by TTS_MAX_PARALLEL and the key count"""
+    return ThreadPoolExecutor(max_workers=max(1, min(chunk_count, TTS_MAX_PARALLEL, len(api_key_list))))
+
+def gemini_tts_chunks(chunks, voice_name, api_key_list, proxies=None, key_offset=0):
+    """Synthesize text chunks concurrently and return their PCM in order.
+
+    Chunk i starts on healthy key i, so chunks fan out across keys; a failed
+    chunk falls through to the next keys on its own without redoing the others.
+    """
+    if len(chunks) == 1:
+        ordered_keys, healthy_count = get_healthy_keys(api_key_list)
+        return [gemini_tts_pcm(chunks[0], voice_name, ordered_keys, proxies, key_offset % max(healthy_count, 1))]
+
+    with tts_executor(len(chunks), api_key_list) as executor:
+        futures = submit_tts_chunks(executor, chunks, voice_name, api_key_list, proxies, key_offset)
+        return [future.result() for future in futures]
+
+def gemini_tts_request(text, voice_name, output_dir, api_key_list, proxies=None, audio_format="mp3", bitrate=None, key_offset=0):
+    """Generate TTS; long texts are split at sentence boundaries and synthesized in parallel.
+
+    key_offset shifts the starting key so parallel callers (batch items) don't all hit key 0.
+    """
+    audio_format = normalize_audio_format(audio_format)
+    bitrate = normalize_bitrate(bitrate)
+
+    chunks = split_text_for_tts(text, TTS_CHUNK_MAX_CHARS) or [text]
+    if len(chunks) > 1:
+        print(f"[VOICE] Chia text {len(text)} ký tự thành {len(chunks)} đoạn")
+
+    # PCM nối trực tiếp (không có header/padding) nên ghép liền mạch trước khi encode 1 lần
+    pcm_bytes = b"".join(gemini_tts_chunks(chunks, voice_name, api_key_list, proxies, key_offset))
+    return write_tts_audio(pcm_bytes, output_dir, audio_format, bitrate)
+
+def write_tts_audio(pcm_bytes, output_dir, audio_format, bitrate):
+    """Encode synthesized PCM into output_dir; returns (audio_file, duration)"""
+    uid = f"{int(time.time())}_{random.randint(1000,9999)}"
+    try:
+        # wav/pcm ghi thẳng PCM, chỉ mp3/opus/ogg mới qua ffmpeg
+        audio_file = write_audio(pcm_bytes, os.path.join(output_dir, uid), audio_format, bitrate)
+    except Exception as e:
+        raise Exception(f"Lỗi convert audio ({audio_format}): {e}")
+
+    return audio_file, pcm_duration(pcm_bytes)
+
+def gemini_image_request(prompt_text, output_dir, api_key_list, proxies=None, start_index=0):
+    """Generate image with improved performance and error handling.
+
+    Keys are tried starting at start_index so parallel variants use different keys.
+    """
     if proxies is None or not proxies:
         proxies = [None]
 
@@ -142,68 +269,78 @@ def gemini_image_request(prompt_text, output_dir, api_key_list, proxies=None):
 
     def task(api_key, proxy_dict):
         try:
-            url = "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash-preview-image-generation:generateContent"
-            headers = {
-                "x-goog-api-key": api_key,
-                "Content-Type": "application/json"
-            }
-            data = {
-                "contents": [{
-                    "parts": [{"text": prompt_text}]
-                }],
-                "generationConfig": {
-                    "responseModalities": ["TEXT", "IMAGE"]
-                }
-            }
-
             print(f"🚀 Đang gọi API với key: {api_key[:20]}..., proxy: {proxy_dict}")
 
             session = get_session(proxy_dict)
-            response = session.post(url, headers=headers, json=data, timeout=30)
+            response = session.post(GEMINI_IMAGE_URL, headers=gemini_headers(api_key), json=image_payload(prompt_text), timeout=30)
 
             if response.status_code != 200:
-                raise Exception(f"❌ HTTP {response.status_code}: {response.text[:300]}")
+                raise UpstreamHTTPError(response.status_code, f"❌ HTTP {response.status_code}: {response.text[:300]}")
 
-            res_json = response.json()
-            parts = res_json.get("candidates", [])[0].get("content", {}).get("parts", [])
-            image_part = next((p for p in parts if "inlineData" in p and "image" in p["inlineData"]["mimeType"]), None)
-
-            if not image_part:
-                raise Exception("⚠️ Không tìm thấy dữ liệu hình ảnh trong response.")
-
-            uid = f"{int(time.time())}_{random.randint(1000,9999)}"
-            image_path = os.path.join(output_dir, f"{uid}.png")
-            
-            with open(image_path, "wb") as f:
-                f.write(base64.b64decode(image_part["inlineData"]["data"]))
+            image_path = write_image(parse_image_response(response.json()), output_dir)
 
             print(f"✅ Tạo ảnh thành công: {image_path}")
-            return image_path
+            return image_path, None
 
         except SSLError as e:
             print(f"❌ SSL Error với key {api_key[:20]}: {e}")
-        except Timeout:
+            return None, e
+        except Timeout as e:
             print(f"⏳ Timeout với key {api_key[:20]}")
+            return None, e
         except ProxyError as e:
             print(f"🔌 Proxy Error với key {api_key[:20]}: {e}")
+            return None, e
         except ConnectionError as e:
             print(f"📡 Lỗi kết nối với key {api_key[:20]}: {e}")
+            return None, e
         except Exception as e:
             print(f"🔥 Key {api_key[:20]} lỗi khác: {e}")
-
-        return None
+            return None, e
 
     # 🔄 Duyệt từng key với proxy tương ứng
-    for i, api_key in enumerate(api_key_list):
+    total = len(api_key_list)
+    for n in range(total):
+        i = (start_index + n) % total
+        api_key = api_key_list[i]
         proxy_str = proxies[i % len(proxies)]
         proxy_dict = {"http": proxy_str, "https": proxy_str} if proxy_str else None
-        print(f"[IMAGE] ⚙️ Thử key {i+1}/{len(api_key_list)} với proxy: {proxy_str}")
-        result = task(api_key, proxy_dict)
+        print(f"[IMAGE] ⚙️ Thử key {i+1}/{total} với proxy: {proxy_str}")
+        with tracer.span("upstream.gemini", **{
+            "upstream.operation": "image", "upstream.key": mask_key(api_key), "upstream.proxy": mask_proxy(proxy_str)
+        }) as span:
+            started = time.time()
+            result, error = task(api_key, proxy_dict)
+            performance_monitor.record_api_call_time(
+                "gemini:image", time.time() - started, error is None, api_key, proxy_str, upstream_outcome(error)
+            )
+            if error is not None:
+                span.record_error(error)
         if result:
+            mark_key_ok(api_key)
             return result
+        mark_key_failed(api_key, error)
 
     raise Exception("🚫 Không có key nào khả dụng để tạo ảnh.")
 
+def gemini_image_variants(prompts, output_dir, api_key_list, proxies=None):
+    """Generate one image per prompt concurrently (at most IMAGE_MAX_PARALLEL at a time).
+
+    Returns a list in prompt order with the image path, or the exception for failed variants.
+    """
+    ordered_keys, healthy_count = get_healthy_keys(api_key_list)
+    spread = max(healthy_count, 1)
+
+    def run(index):
+        try:
+            return gemini_image_request(prompts[index], output_dir, ordered_keys, proxies, index % spread)
+        except Exception as e:
+            return e
+
+    max_workers = max(1, min(len(prompts), IMAGE_MAX_PARALLEL, len(api_key_list)))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(propagate(run), range(len(prompts))))
+
 def clear_session_cache():
     """Clear session cache"""
     global _session_cache, _session_cache_timestamp
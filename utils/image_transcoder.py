@@ -0,0 +1,191 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image, features
+from config import (
+    IMAGE_OUTPUT_DIR, IMAGE_DERIVATIVE_WIDTHS, IMAGE_ENABLE_AVIF, IMAGE_WEBP_QUALITY,
+    IMAGE_AVIF_QUALITY, IMAGE_TRANSCODE_WORKERS
+)
+from utils.performance_monitor import performance_monitor
+from utils.storage import get_storage
+
+# Derivative của `<dir>/<uid>.png`:
+#   <uid>.webp, <uid>.avif            - cùng kích thước
+#   <uid>_w320.webp, <uid>_w320.avif  - thumbnail theo chiều rộng
+FORMAT_MIMETYPES = {"avif": "image/avif", "webp": "image/webp"}
+
+_pending = set()
+_pending_lock = threading.Lock()
+_executor = None
+
+
+def avif_enabled():
+    return IMAGE_ENABLE_AVIF and features.check("avif")
+
+
+def derivative_formats():
+    """Formats in preference order (best compression first)"""
+    return ("avif", "webp") if avif_enabled() else ("webp",)
+
+
+def derivative_path(image_path, image_format, width=None):
+    base = os.path.splitext(image_path)[0]
+    suffix = f"_w{width}" if width else ""
+    return f"{base}{suffix}.{image_format}"
+
+
+def _save(image, path, image_format):
+    # Ghi ra file tạm rồi rename để route serve không bao giờ thấy file ghi dở
+    tmp_path = f"{path}.tmp"
+    if image_format == "webp":
+        image.save(tmp_path, "WEBP", quality=IMAGE_WEBP_QUALITY, method=4)
+    else:
+        image.save(tmp_path, "AVIF", quality=IMAGE_AVIF_QUALITY)
+    os.replace(tmp_path, path)
+    return os.path.getsize(path)
+
+
+def encode_derivatives(image_path):
+    """Write full-size and thumbnail derivatives for one PNG; skips existing ones. Returns the created paths.
+
+    Pure Pillow + file work (no locks, no storage client): safe on the gevent hub's native threadpool.
+    """
+    created = []
+    original_bytes = os.path.getsize(image_path)
+    with Image.open(image_path) as source:
+        source.load()
+        image = source.convert("RGBA" if source.mode in ("RGBA", "LA", "P") else "RGB")
+
+    for image_format in derivative_formats():
+        full_path = derivative_path(image_path, image_format)
+        if not os.path.exists(full_path):
+            saved = _save(image, full_path, image_format)
+            performance_monitor.record_image_savings(image_format, original_bytes, saved)
+            created.append(full_path)
+
+        for width in IMAGE_DERIVATIVE_WIDTHS:
+            if width >= image.width:
+                continue
+            thumb_path = derivative_path(image_path, image_format, width)
+            if os.path.exists(thumb_path):
+                continue
+            height = max(1, round(image.height * width / image.width))
+            _save(image.resize((width, height), Image.LANCZOS), thumb_path, image_format)
+            created.append(thumb_path)
+    return created
+
+
+def _finish_derivatives(image_path, created, error=None):
+    """Upload created derivatives to remote storage and drop the image from _pending"""
+    try:
+        if error is not None:
+            print(f"❌ Lỗi transcode ảnh {image_path}: {error}")
+        storage = get_storage()
+        if not storage.is_local:
+            for path in created:
+                storage.save("image", os.path.relpath(path, IMAGE_OUTPUT_DIR).replace("\\", "/"), path)
+    except Exception as e:
+        print(f"❌ Lỗi upload derivative ảnh {image_path}: {e}")
+    finally:
+        with _pending_lock:
+            _pending.discard(image_path)
+
+
+def _encode_or_error(image_path):
+    """(created paths, error) of encode_derivatives; never raises"""
+    try:
+        return encode_derivatives(image_path), None
+    except Exception as e:
+        return [], e
+
+
+def transcode_image(image_path):
+    """Create derivatives for one PNG and upload them (runs on a normal thread)"""
+    _finish_derivatives(image_path, *_encode_or_error(image_path))
+
+
+def _submit(image_path):
+    global _executor
+    try:
+        from gevent import monkey
+        if monkey.is_module_patched("threading"):
+            # Dưới gevent worker: chỉ phần encode chạy trên threadpool thật của hub (không chặn event loop).
+            # Lock/storage client đã bị patch thành bản gevent, không được dùng từ thread thật ->
+            # upload + cập nhật _pending chạy trong greenlet, được spawn từ callback trên hub.
+            import gevent
+            result = gevent.get_hub().threadpool.spawn(_encode_or_error, image_path)
+            result.rawlink(lambda done: gevent.spawn(_finish_derivatives, image_path, *done.get()))
+            return result
+    except ImportError:
+        pass
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=IMAGE_TRANSCODE_WORKERS, thread_name_prefix="image-transcode")
+    return _executor.submit(transcode_image, image_path)
+
+
+def enqueue_image_derivatives(image_path):
+    """Schedule derivative generation in the background (no-op if already queued)"""
+    with _pending_lock:
+        if image_path in _pending:
+            return
+        _pending.add(image_path)
+    _submit(image_path)
+
+
+def derivatives_pending(image_path):
+    """True while derivatives for this image are queued or being generated"""
+    with _pending_lock:
+        return image_path in _pending
+
+
+def _parse_accept(accept_header):
+    """Mimetypes the client accepts (q > 0)"""
+    accepted = set()
+    for part in (accept_header or "").split(","):
+        mimetype, *params = [p.strip() for p in part.split(";")]
+        quality = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if mimetype and quality > 0:
+            accepted.add(mimetype.lower())
+    return accepted
+
+
+def _pick_width(requested):
+    """Smallest configured thumbnail width that is >= the requested width"""
+    if not requested:
+        return None
+    for width in sorted(IMAGE_DERIVATIVE_WIDTHS):
+        if width >= requested:
+            return width
+    return None
+
+
+def pick_image_variant(image_path, accept_header, requested_width=None, exists=os.path.exists):
+    """Return (path, mimetype) of the best existing variant for this client.
+
+    Falls back to the original PNG while derivatives are not generated yet, and
+    queues the generation in that case. `exists` lets a remote storage answer
+    for variants that are not on this node's disk.
+    """
+    accepted = _parse_accept(accept_header)
+    width = _pick_width(requested_width)
+    missing = False
+
+    for image_format in derivative_formats():
+        if FORMAT_MIMETYPES[image_format] not in accepted:
+            continue
+        for candidate_width in ([width, None] if width else [None]):
+            candidate = derivative_path(image_path, image_format, candidate_width)
+            if exists(candidate):
+                return candidate, FORMAT_MIMETYPES[image_format]
+        missing = True
+
+    if missing and os.path.exists(image_path):
+        enqueue_image_derivatives(image_path)
+    return image_path, None
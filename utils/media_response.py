@@ -0,0 +1,78 @@
+import mimetypes
+import os
+from urllib.parse import quote
+from flask import Response, current_app, request, send_from_directory
+from werkzeug.exceptions import NotFound
+from werkzeug.security import safe_join
+from config import (
+    MEDIA_OUTPUT_DIRS, MEDIA_SENDFILE_MODE, MEDIA_ACCEL_PREFIXES, MEDIA_IMMUTABLE_MAX_AGE
+)
+from utils.media_store import OBJECTS_DIRNAME
+
+# MEDIA_SENDFILE_MODE:
+#   ""           - Python worker tự gửi file (hỗ trợ Range/ETag qua werkzeug)
+#   "x-accel"    - trả header X-Accel-Redirect, nginx gửi file. Ví dụ cấu hình:
+#                      location /_protected/voices/ { internal; alias /path/to/voices/; }
+#                      location /_protected/images/ { internal; alias /path/to/images/; }
+#   "x-sendfile" - Apache mod_xsendfile / lighttpd (dùng USE_X_SENDFILE của Flask)
+
+
+def is_content_addressed(rel_path):
+    """Files under objects/ are named by their hash and never change"""
+    return rel_path.startswith(f"{OBJECTS_DIRNAME}/")
+
+
+def media_etag(rel_path):
+    """Strong ETag for content-addressed files (`<sha256>[_wNNN].<ext>`), None otherwise"""
+    if is_content_addressed(rel_path):
+        return os.path.basename(rel_path)
+    return None
+
+
+def send_media(module, rel_path, mimetype=None):
+    """Serve a file from the module's output dir with Range, ETag and cache headers.
+
+    Content-addressed objects get their hash as a strong ETag and an immutable
+    Cache-Control; other files (legacy dirs, voice samples) keep the default
+    max-age with an mtime/size based ETag.
+    """
+    base_dir = MEDIA_OUTPUT_DIRS[module]
+    etag = media_etag(rel_path)
+    immutable = etag is not None
+
+    if MEDIA_SENDFILE_MODE == "x-accel":
+        response = _accel_response(module, base_dir, rel_path, mimetype, etag)
+    else:
+        response = send_from_directory(
+            base_dir, rel_path, mimetype=mimetype, etag=etag or True, conditional=True,
+            max_age=MEDIA_IMMUTABLE_MAX_AGE if immutable else None
+        )
+
+    if immutable:
+        response.cache_control.public = True
+        response.cache_control.max_age = MEDIA_IMMUTABLE_MAX_AGE
+        response.cache_control.immutable = True
+    return response
+
+
+def _accel_response(module, base_dir, rel_path, mimetype, etag):
+    """Empty response that makes nginx send the file (nginx handles Range itself)"""
+    path = safe_join(base_dir, rel_path)
+    if not path or not os.path.isfile(path):
+        raise NotFound()
+
+    if etag is None:
+        stat = os.stat(path)
+        etag = f"{int(stat.st_mtime)}-{stat.st_size}"
+
+    response = Response(mimetype=mimetype or mimetypes.guess_type(path)[0] or "application/octet-stream")
+    response.headers["X-Accel-Redirect"] = f"{MEDIA_ACCEL_PREFIXES[module].rstrip('/')}/{quote(rel_path)}"
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = current_app.get_send_file_max_age(path)
+
+    # 304 trả ngay từ worker, không cần chuyển sang nginx
+    response.make_conditional(request)
+    if response.status_code == 304:
+        del response.headers["X-Accel-Redirect"]
+    return response
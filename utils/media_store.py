@@ -0,0 +1,196 @@
+import hashlib
+import os
+import re
+import shutil
+import threading
+import time
+import uuid
+from database import db_manager
+from utils.file_utils import create_unique_output_dir, ensure_dir
+from utils.tracing import traced
+
+# Layout trong VOICE_OUTPUT_DIR / IMAGE_OUTPUT_DIR:
+#   objects/ab/cd/<sha256>.<ext>   - nội dung, đặt tên theo hash (trùng bytes -> dùng chung)
+#   .staging/<timestamp_uuid>/     - thư mục tạm khi đang tạo file
+#   .staging/stream_<uuid>/<uuid>.<ext> - file đang stream (create_stream), tìm được từ tên public ở mọi worker
+# Tên public (<uuid>.<ext>) được map sang object qua bảng media_index.
+# URL cũ dạng <timestamp_uuid>/<file> vẫn được serve trực tiếp từ đĩa.
+OBJECTS_DIRNAME = "objects"
+STAGING_DIRNAME = ".staging"
+HASH_CHUNK_SIZE = 256 * 1024
+FOLLOW_CHUNK_SIZE = 64 * 1024
+FOLLOW_POLL_INTERVAL = 0.1  # giây giữa hai lần đọc khi chưa có dữ liệu mới
+FOLLOW_IDLE_TIMEOUT = 120  # file không lớn thêm lâu hơn -> dừng (worker tạo file đã chết)
+FOLLOW_INDEX_WAIT = 60  # file đã vào objects/ nhưng chưa được index (đang upload S3) -> chờ tối đa
+
+_PUBLIC_NAME_RE = re.compile(r"^[0-9a-f]{32}\.[a-z0-9]+$")
+
+_resolve_cache = {}
+_resolve_cache_lock = threading.Lock()
+RESOLVE_CACHE_MAX = 4096
+
+
+def create_staging_dir(base_dir):
+    """Scratch directory for a file that is still being generated"""
+    return create_unique_output_dir(os.path.join(base_dir, STAGING_DIRNAME))
+
+
+def discard_staging_dir(staging_dir):
+    """Remove a staging directory left behind by a failed generation"""
+    shutil.rmtree(staging_dir, ignore_errors=True)
+
+
+def stream_staging_path(base_dir, public_name):
+    """Staging file of a streamed output, derived from its public name so any worker can find it"""
+    return os.path.join(base_dir, STAGING_DIRNAME, f"stream_{os.path.splitext(public_name)[0]}", public_name)
+
+
+def open_growing_media(base_dir, filename):
+    """Open the staging file of an output still being streamed; None if there is none"""
+    if not _PUBLIC_NAME_RE.match(filename):
+        return None
+    path = stream_staging_path(base_dir, filename)
+    try:
+        return open(path, "rb"), path
+    except OSError:
+        return None
+
+
+def _wait_until_indexed(path, sha256):
+    """Return once the streamed file at `path` is stored and indexed; raise if the generation was discarded"""
+    public_name = os.path.basename(path)
+    base_dir = os.path.dirname(os.path.dirname(os.path.dirname(path)))
+    object_path = os.path.join(base_dir, object_rel_path(sha256, os.path.splitext(public_name)[1].lstrip(".")))
+    # store_media chuyển file vào objects/ trước rồi mới index: không có object = stream lỗi, file bị xóa
+    if not os.path.exists(object_path):
+        raise Exception(f"❌ Stream {public_name} bị hủy trước khi hoàn tất")
+    deadline = time.monotonic() + FOLLOW_INDEX_WAIT
+    while db_manager.get_media_object(public_name) is None:
+        if time.monotonic() > deadline:
+            raise Exception(f"❌ Stream {public_name} không được lưu")
+        time.sleep(FOLLOW_POLL_INTERVAL)
+
+
+def follow_growing_file(f, path):
+    """Yield a file's bytes as they are written, until store_media moves it away.
+
+    Raises (cutting the chunked response short) when the file is discarded or
+    stops growing, so a listener can tell a failed stream from a complete one.
+    """
+    digest = hashlib.sha256()
+    with f:
+        idle_since = time.monotonic()
+        while True:
+            data = f.read(FOLLOW_CHUNK_SIZE)
+            if data:
+                idle_since = time.monotonic()
+                digest.update(data)
+                yield data
+                continue
+            if not os.path.exists(path):
+                # Bên ghi đã xong hoặc đã bỏ file: đọc nốt phần còn lại qua file handle đang mở rồi kiểm tra
+                rest = f.read()
+                digest.update(rest)
+                _wait_until_indexed(path, digest.hexdigest())
+                if rest:
+                    yield rest
+                return
+            if time.monotonic() - idle_since > FOLLOW_IDLE_TIMEOUT:
+                raise Exception(f"❌ Stream {os.path.basename(path)} ngừng ghi quá {FOLLOW_IDLE_TIMEOUT}s")
+            time.sleep(FOLLOW_POLL_INTERVAL)
+
+
+def new_public_name(ext):
+    return f"{uuid.uuid4().hex}.{ext.lstrip('.').lower()}"
+
+
+def object_rel_path(sha256, ext):
+    return f"{OBJECTS_DIRNAME}/{sha256[:2]}/{sha256[2:4]}/{sha256}.{ext}"
+
+
+def hash_file(path):
+    """sha256 hex digest and size of a file, read in chunks"""
+    digest = hashlib.sha256()
+    size = 0
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            digest.update(block)
+            size += len(block)
+    return digest.hexdigest(), size
+
+
+def _remove_empty_staging_dir(path):
+    parent = os.path.dirname(path)
+    if os.path.basename(os.path.dirname(parent)) == STAGING_DIRNAME:
+        try:
+            os.rmdir(parent)
+        except OSError:
+            pass
+
+
+@traced("file.store_media")
+def store_media(base_dir, module, src_path, public_name=None):
+    """Move a finished file into the content-addressed tree and index it.
+
+    Identical bytes are stored once; the new public name just points at the
+    existing object. Returns (public_name, absolute object path).
+    """
+    ext = os.path.splitext(src_path)[1].lstrip(".").lower()
+    sha256, size = hash_file(src_path)
+    rel_path = object_rel_path(sha256, ext)
+    object_path = os.path.join(base_dir, rel_path)
+
+    if os.path.exists(object_path):
+        os.remove(src_path)
+        os.utime(object_path)  # Object được dùng lại -> không bị GC coi là cũ
+    else:
+        ensure_dir(os.path.dirname(object_path))
+        os.replace(src_path, object_path)
+    _remove_empty_staging_dir(src_path)
+
+    # Backend remote (S3): upload nếu bucket chưa có, bản local giữ lại làm cache
+    from utils.storage import get_storage
+    storage = get_storage()
+    if not storage.is_local and not storage.exists(module, rel_path):
+        storage.save(module, rel_path, object_path)
+
+    public_name = public_name or new_public_name(ext)
+    if not db_manager.add_media_object(public_name, module, rel_path, sha256, size):
+        raise Exception(f"Tên file đã tồn tại: {public_name}")
+    return public_name, object_path
+
+
+def resolve_media(module, filename):
+    """Return the index entry for a public name, or None for legacy/unknown names.
+
+    Entries never change once written, so hits are cached in-process.
+    """
+    if "/" in filename or "\\" in filename:
+        return None  # Tên public không có thư mục -> URL cũ
+
+    cached = _resolve_cache.get(filename)
+    if cached is None:
+        cached = db_manager.get_media_object(filename)
+        if not cached:
+            return None
+        with _resolve_cache_lock:
+            if len(_resolve_cache) >= RESOLVE_CACHE_MAX:
+                _resolve_cache.clear()
+            _resolve_cache[filename] = cached
+
+    return cached if cached["module"] == module else None
+
+
+def resolve_media_path(module, filename):
+    """Path (relative to the module's output dir) that serves `filename`"""
+    media = resolve_media(module, filename)
+    return media["object_path"] if media else filename
+
+
+def forget_media(public_name=None):
+    """Drop cached resolutions (all of them when public_name is None)"""
+    with _resolve_cache_lock:
+        if public_name is None:
+            _resolve_cache.clear()
+        else:
+            _resolve_cache.pop(public_name, None)
@@ -0,0 +1,177 @@
+import os
+import time
+from config import METRICS_ENABLED
+from utils.tracing import mask_key, mask_proxy
+
+# Prometheus metrics (/metrics). Qua gunicorn, gunicorn.conf.py đặt PROMETHEUS_MULTIPROC_DIR trong worker_tmp_dir (/dev/shm):
+# mỗi worker ghi giá trị vào file mmap của riêng nó, /metrics ở worker nào cũng đọc gộp file của mọi worker
+# (counter/histogram cộng lại, gauge hàng đợi chỉ cộng worker còn sống). Không có PROMETHEUS_MULTIPROC_DIR
+# (python app.py) thì chỉ có số liệu của process hiện tại.
+# METRICS_ENABLED=false (mặc định): các hàm observe_* không làm gì, timed_lock() trả lại nguyên lock.
+
+REQUEST_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60)
+UPSTREAM_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2, 4, 8, 15, 30, 60, 120)
+LOCK_WAIT_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+
+
+class _Metrics:
+    def __init__(self):
+        try:
+            from prometheus_client import Counter, Gauge, Histogram
+        except ImportError:
+            raise RuntimeError("❌ METRICS_ENABLED=true cần cài prometheus_client (pip install prometheus_client)")
+
+        self.request_duration = Histogram(
+            "cloudapi_request_duration_seconds", "Request latency by endpoint (method + url rule)",
+            ("endpoint", "module", "status"), buckets=REQUEST_BUCKETS
+        )
+        self.upstream_requests = Counter(
+            "cloudapi_upstream_requests_total", "Upstream call attempts by provider, key, proxy and outcome",
+            ("provider", "operation", "key", "proxy", "outcome")
+        )
+        self.upstream_duration = Histogram(
+            "cloudapi_upstream_duration_seconds", "Upstream call latency",
+            ("provider", "operation"), buckets=UPSTREAM_BUCKETS
+        )
+        self.db_lock_wait = Histogram(
+            "cloudapi_db_lock_wait_seconds", "Time spent waiting for the DatabaseManager lock",
+            buckets=LOCK_WAIT_BUCKETS
+        )
+        self.cache_requests = Counter(
+            "cloudapi_cache_requests_total", "Cache lookups by cache and result (hit/miss)",
+            ("cache", "result")
+        )
+        self.admission_in_flight = Gauge(
+            "cloudapi_admission_in_flight", "Requests holding an admission slot",
+            ("module",), multiprocess_mode="livesum"
+        )
+        self.admission_waiting = Gauge(
+            "cloudapi_admission_waiting", "Requests queued for an admission slot",
+            ("module",), multiprocess_mode="livesum"
+        )
+        self.admission_rejected = Counter(
+            "cloudapi_admission_rejected_total", "Requests rejected with 503 by admission control",
+            ("module", "lane", "reason")
+        )
+        self.media_gc_runs = Counter("cloudapi_media_gc_runs_total", "Media GC sweeps", ("dry_run",))
+        self.media_gc_evicted_files = Counter(
+            "cloudapi_media_gc_evicted_files_total", "Media files deleted by GC", ("module", "reason")
+        )
+        self.media_gc_evicted_bytes = Counter(
+            "cloudapi_media_gc_evicted_bytes_total", "Media bytes deleted by GC", ("module", "reason")
+        )
+        self.media_files = Gauge(
+            "cloudapi_media_files", "Media files on disk after the last GC sweep", ("module",), multiprocess_mode="mostrecent"
+        )
+        self.media_bytes = Gauge(
+            "cloudapi_media_bytes", "Media bytes on disk after the last GC sweep", ("module",), multiprocess_mode="mostrecent"
+        )
+        self.media_gc_duration = Gauge(
+            "cloudapi_media_gc_last_duration_seconds", "Duration of the last GC sweep", multiprocess_mode="mostrecent"
+        )
+        self.media_gc_last_run = Gauge(
+            "cloudapi_media_gc_last_run_timestamp_seconds", "Unix time of the last GC sweep", multiprocess_mode="mostrecent"
+        )
+
+
+_metrics = _Metrics() if METRICS_ENABLED else None
+
+
+def upstream_outcome(error=None, status_code=None):
+    """Outcome label of an upstream attempt: ok, http_<code>, timeout, proxy_error, connection_error or error"""
+    if status_code is None:
+        status_code = getattr(error, "status_code", None)
+    if status_code is not None:
+        return "ok" if status_code < 400 else f"http_{status_code}"
+    if error is None:
+        return "ok"
+    error_name = type(error).__name__.lower()
+    for marker, outcome in (("timeout", "timeout"), ("proxy", "proxy_error"), ("connect", "connection_error")):
+        if marker in error_name:
+            return outcome
+    return "error"
+
+
+def observe_request(endpoint, module, status, duration):
+    if _metrics is None:
+        return
+    _metrics.request_duration.labels(endpoint, module, str(status)).observe(duration)
+
+
+def observe_upstream(api_name, duration, outcome, api_key=None, proxy=None):
+    if _metrics is None:
+        return
+    provider, _, operation = api_name.partition(":")
+    operation = operation or "api"
+    _metrics.upstream_requests.labels(provider, operation, mask_key(api_key) or "", mask_proxy(proxy) or "direct", outcome).inc()
+    _metrics.upstream_duration.labels(provider, operation).observe(duration)
+
+
+def observe_cache(cache_name, hit):
+    if _metrics is None:
+        return
+    _metrics.cache_requests.labels(cache_name, "hit" if hit else "miss").inc()
+
+
+def set_admission_depth(module, in_flight, waiting):
+    if _metrics is None:
+        return
+    _metrics.admission_in_flight.labels(module).set(in_flight)
+    _metrics.admission_waiting.labels(module).set(waiting)
+
+
+def observe_admission_rejected(module, lane, reason):
+    if _metrics is None:
+        return
+    _metrics.admission_rejected.labels(module, lane, reason).inc()
+
+
+def observe_media_gc(report):
+    """Record a run_media_gc() report"""
+    if _metrics is None:
+        return
+    dry_run = bool(report.get("dry_run"))
+    _metrics.media_gc_runs.labels(str(dry_run).lower()).inc()
+    for module, stats in report.get("modules", {}).items():
+        files, size = stats["files"], stats["bytes"]
+        if not dry_run:
+            for reason, prefix in (("age", "expired"), ("quota", "quota")):
+                _metrics.media_gc_evicted_files.labels(module, reason).inc(stats[f"{prefix}_files"])
+                _metrics.media_gc_evicted_bytes.labels(module, reason).inc(stats[f"{prefix}_bytes"])
+                files -= stats[f"{prefix}_files"]
+                size -= stats[f"{prefix}_bytes"]
+        _metrics.media_files.labels(module).set(files)
+        _metrics.media_bytes.labels(module).set(size)
+    _metrics.media_gc_duration.set(report.get("duration", 0))
+    _metrics.media_gc_last_run.set(time.time())
+
+
+class _TimedLock:
+    def __init__(self, lock, histogram):
+        self._lock = lock
+        self._histogram = histogram
+
+    def __enter__(self):
+        started = time.perf_counter()
+        result = self._lock.__enter__()
+        self._histogram.observe(time.perf_counter() - started)
+        return result
+
+    def __exit__(self, exc_type, exc, tb):
+        return self._lock.__exit__(exc_type, exc, tb)
+
+
+def timed_lock(lock):
+    """Lock that records its wait time in cloudapi_db_lock_wait_seconds"""
+    return _TimedLock(lock, _metrics.db_lock_wait) if _metrics is not None else lock
+
+
+def render():
+    """(body, content_type) of the Prometheus exposition, merged across workers when multiprocess"""
+    from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, generate_latest, multiprocess
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
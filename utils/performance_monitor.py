@@ -1,30 +1,158 @@
+import math
 import time
 import psutil
 import threading
-from collections import defaultdict, deque
+from array import array
+from collections import defaultdict
 from functools import wraps
 import logging
+from config import PERFORMANCE_WINDOWS, PERFORMANCE_SLOT_SECONDS
+from utils import metrics
 
-# Performance monitoring
+# Latency lưu trong histogram log-linear: mỗi lũy thừa 2 (ms) chia thành HISTOGRAM_SUB_BUCKETS bucket đều nhau,
+# sai số tương đối của percentile <= 1/HISTOGRAM_SUB_BUCKETS. Mỗi histogram có 1 vòng slot PERFORMANCE_SLOT_SECONDS giây
+# (đủ cho cửa sổ dài nhất trong PERFORMANCE_WINDOWS) + 1 bảng tích lũy từ lúc start, nên bộ nhớ cố định dù bao nhiêu request.
+HISTOGRAM_SUB_BUCKETS = 8
+HISTOGRAM_MAX_EXPONENT = 18  # 2^18 ms ~ 262s, lâu hơn dồn vào bucket cuối
+HISTOGRAM_BUCKETS = 1 + HISTOGRAM_MAX_EXPONENT * HISTOGRAM_SUB_BUCKETS  # bucket 0: < 1ms
+
+
+def bucket_index(value_ms):
+    """Histogram bucket of a duration in milliseconds"""
+    if value_ms < 1:
+        return 0
+    mantissa, exponent = math.frexp(value_ms)  # value = mantissa * 2^exponent, mantissa trong [0.5, 1)
+    index = 1 + (exponent - 1) * HISTOGRAM_SUB_BUCKETS + int((mantissa * 2 - 1) * HISTOGRAM_SUB_BUCKETS)
+    return min(index, HISTOGRAM_BUCKETS - 1)
+
+
+def bucket_upper_bound(index):
+    """Upper bound (ms) of a histogram bucket"""
+    if index == 0:
+        return 1.0
+    exponent, sub = divmod(index - 1, HISTOGRAM_SUB_BUCKETS)
+    return 2 ** exponent * (1 + (sub + 1) / HISTOGRAM_SUB_BUCKETS)
+
+
+class _HistogramSlot:
+    __slots__ = ("epoch", "counts", "count", "total", "max")
+
+    def __init__(self):
+        self.epoch = -1
+        self.counts = array("L", bytes(array("L").itemsize * HISTOGRAM_BUCKETS))
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def reset(self, epoch):
+        self.epoch = epoch
+        self.counts = array("L", bytes(array("L").itemsize * HISTOGRAM_BUCKETS))
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, index, value_ms):
+        self.counts[index] += 1
+        self.count += 1
+        self.total += value_ms
+        if value_ms > self.max:
+            self.max = value_ms
+
+
+class LatencyHistogram:
+    """Fixed-bucket latency histogram with sliding windows (PERFORMANCE_WINDOWS)"""
+
+    def __init__(self, windows=PERFORMANCE_WINDOWS, slot_seconds=PERFORMANCE_SLOT_SECONDS):
+        self.windows = {name: max(1, math.ceil(seconds / slot_seconds)) for name, seconds in windows.items()}
+        self.slot_seconds = slot_seconds
+        self._slots = [None] * max(self.windows.values())  # cấp phát khi slot được dùng lần đầu
+        self._total = _HistogramSlot()
+        self._lock = threading.Lock()
+
+    def record(self, duration):
+        """Add one duration in seconds"""
+        value_ms = duration * 1000
+        index = bucket_index(value_ms)
+        epoch = int(time.time() // self.slot_seconds)
+        with self._lock:
+            position = epoch % len(self._slots)
+            slot = self._slots[position]
+            if slot is None:
+                slot = self._slots[position] = _HistogramSlot()
+            if slot.epoch != epoch:
+                slot.reset(epoch)
+            slot.add(index, value_ms)
+            self._total.add(index, value_ms)
+
+    @staticmethod
+    def _summary(counts, count, total, maximum):
+        summary = {
+            "count": count,
+            "average_ms": round(total / count, 3) if count else 0,
+            "max_ms": round(maximum, 3),
+        }
+        for name, quantile in (("p50_ms", 0.5), ("p90_ms", 0.9), ("p99_ms", 0.99)):
+            if not count:
+                summary[name] = 0
+                continue
+            rank = math.ceil(quantile * count)
+            seen = 0
+            for index, bucket_count in enumerate(counts):
+                seen += bucket_count
+                if seen >= rank:
+                    summary[name] = round(min(bucket_upper_bound(index), maximum), 3)
+                    break
+        return summary
+
+    def get_stats(self):
+        """All-time count/average/max plus p50/p90/p99 per window"""
+        epoch = int(time.time() // self.slot_seconds)
+        with self._lock:
+            total = self._total
+            stats = self._summary(total.counts, total.count, total.total, total.max)
+            live = [slot for slot in self._slots if slot is not None and slot.count and slot.epoch > epoch - len(self._slots)]
+            windows = {}
+            for name, slot_count in self.windows.items():
+                selected = [slot for slot in live if slot.epoch > epoch - slot_count]
+                counts = [sum(column) for column in zip(*(slot.counts for slot in selected))] if selected else []
+                windows[name] = self._summary(
+                    counts,
+                    sum(slot.count for slot in selected),
+                    sum(slot.total for slot in selected),
+                    max((slot.max for slot in selected), default=0.0),
+                )
+        stats["windows"] = windows
+        return stats
+
+
+# Performance monitoring (số liệu của worker hiện tại; request / upstream / cache được chuyển tiếp
+# sang utils.metrics để /metrics gộp được mọi worker)
 class PerformanceMonitor:
     def __init__(self):
-        self.request_times = deque(maxlen=1000)
-        self.api_call_times = defaultdict(lambda: deque(maxlen=100))
+        self.request_latency = defaultdict(LatencyHistogram)  # theo endpoint (url rule)
+        self.module_latency = defaultdict(LatencyHistogram)  # theo blueprint
+        self.api_call_latency = defaultdict(LatencyHistogram)  # theo upstream (provider:operation)
+        self.api_call_errors = defaultdict(int)
+        self.first_audio_latency = defaultdict(LatencyHistogram)
         self.error_counts = defaultdict(int)
         self.cache_hit_rates = defaultdict(lambda: {'hits': 0, 'misses': 0})
+        self.encode_stats = defaultdict(lambda: {'count': 0, 'total_time': 0.0, 'pcm_bytes': 0})
+        self.image_savings = defaultdict(lambda: {'count': 0, 'original_bytes': 0, 'derivative_bytes': 0})
         self.start_time = time.time()
         
-    def record_request_time(self, endpoint, duration):
+    def record_request_time(self, endpoint, duration, module=None, status=None):
         """Record request processing time"""
-        self.request_times.append({
-            'endpoint': endpoint,
-            'duration': duration,
-            'timestamp': time.time()
-        })
+        self.request_latency[endpoint].record(duration)
+        if module:
+            self.module_latency[module].record(duration)
+        metrics.observe_request(endpoint, module or "", status or "", duration)
     
-    def record_api_call_time(self, api_name, duration):
-        """Record API call time"""
-        self.api_call_times[api_name].append(duration)
+    def record_api_call_time(self, api_name, duration, success=True, api_key=None, proxy=None, outcome=None):
+        """Record API call time (api_key/proxy/outcome only go to the Prometheus labels)"""
+        self.api_call_latency[api_name].record(duration)
+        if not success:
+            self.api_call_errors[api_name] += 1
+        metrics.observe_upstream(api_name, duration, outcome or ("ok" if success else "error"), api_key, proxy)
     
     def record_error(self, endpoint, error_type):
         """Record error occurrence"""
@@ -36,17 +164,41 @@ class PerformanceMonitor:
             self.cache_hit_rates[cache_name]['hits'] += 1
         else:
             self.cache_hit_rates[cache_name]['misses'] += 1
+        metrics.observe_cache(cache_name, hit)
+    
+    def record_encode_time(self, audio_format, duration, pcm_bytes=0):
+        """Record audio encode cost per output format"""
+        stats = self.encode_stats[audio_format]
+        stats['count'] += 1
+        stats['total_time'] += duration
+        stats['pcm_bytes'] += pcm_bytes
+    
+    def record_first_audio_time(self, endpoint, duration):
+        """Record time-to-first-audio of a streaming endpoint"""
+        self.first_audio_latency[endpoint].record(duration)
+    
+    def record_image_savings(self, image_format, original_bytes, derivative_bytes):
+        """Record bytes saved by a transcoded image derivative"""
+        stats = self.image_savings[image_format]
+        stats['count'] += 1
+        stats['original_bytes'] += original_bytes
+        stats['derivative_bytes'] += derivative_bytes
     
     def get_performance_stats(self):
         """Get current performance statistics"""
         current_time = time.time()
         uptime = current_time - self.start_time
         
-        # Calculate average request time
-        if self.request_times:
-            avg_request_time = sum(r['duration'] for r in self.request_times) / len(self.request_times)
-        else:
-            avg_request_time = 0
+        # Latency theo endpoint / module / upstream (tích lũy + từng cửa sổ trượt)
+        endpoint_stats = {endpoint: histogram.get_stats() for endpoint, histogram in list(self.request_latency.items())}
+        module_stats = {module: histogram.get_stats() for module, histogram in list(self.module_latency.items())}
+        upstream_stats = {}
+        for api_name, histogram in list(self.api_call_latency.items()):
+            upstream_stats[api_name] = histogram.get_stats()
+            upstream_stats[api_name]['errors'] = self.api_call_errors.get(api_name, 0)
+        
+        total_requests = sum(stats['count'] for stats in endpoint_stats.values())
+        total_time_ms = sum(stats['count'] * stats['average_ms'] for stats in endpoint_stats.values())
         
         # Calculate cache hit rates
         cache_stats = {}
@@ -62,16 +214,48 @@ class PerformanceMonitor:
                 'misses': stats['misses']
             }
         
+        # Encode cost per audio format
+        encode_stats = {}
+        for audio_format, stats in self.encode_stats.items():
+            encode_stats[audio_format] = {
+                'count': stats['count'],
+                'total_time_ms': stats['total_time'] * 1000,
+                'average_time_ms': (stats['total_time'] / stats['count']) * 1000 if stats['count'] else 0,
+                'pcm_bytes': stats['pcm_bytes']
+            }
+        
+        # Time-to-first-audio của các endpoint streaming
+        first_audio_stats = {endpoint: histogram.get_stats() for endpoint, histogram in list(self.first_audio_latency.items())}
+        
+        # Dung lượng tiết kiệm được khi transcode ảnh
+        image_savings = {}
+        for image_format, stats in self.image_savings.items():
+            saved = stats['original_bytes'] - stats['derivative_bytes']
+            image_savings[image_format] = {
+                'count': stats['count'],
+                'bytes_saved': saved,
+                'average_bytes_saved': saved / stats['count'] if stats['count'] else 0,
+                'ratio': stats['derivative_bytes'] / stats['original_bytes'] if stats['original_bytes'] else 0
+            }
+        
         # System resource usage
-        cpu_percent = psutil.cpu_percent(interval=1)
+        cpu_percent = psutil.cpu_percent(interval=None)  # Non-blocking, so/với lần gọi trước
         memory = psutil.virtual_memory()
         
         return {
             'uptime_seconds': uptime,
-            'total_requests': len(self.request_times),
-            'average_request_time_ms': avg_request_time * 1000,
+            'total_requests': total_requests,
+            'average_request_time_ms': total_time_ms / total_requests if total_requests else 0,
+            'latency': {
+                'endpoints': endpoint_stats,
+                'modules': module_stats,
+                'upstreams': upstream_stats
+            },
             'error_counts': dict(self.error_counts),
             'cache_stats': cache_stats,
+            'encode_stats': encode_stats,
+            'time_to_first_audio': first_audio_stats,
+            'image_savings': image_savings,
             'system': {
                 'cpu_percent': cpu_percent,
                 'memory_percent': memory.percent,
@@ -118,21 +302,43 @@ def monitor_api_calls(api_name):
                 return result
             except Exception as e:
                 duration = time.time() - start_time
-                performance_monitor.record_api_call_time(api_name, duration)
+                performance_monitor.record_api_call_time(api_name, duration, success=False)
                 raise
         return wrapper
     return decorator
 
+def start_request_timer():
+    """before_request hook"""
+    from flask import g
+    g.request_started = time.perf_counter()
+
+def record_request_metrics(response):
+    """after_request hook: latency per endpoint (url rule) and module (blueprint)"""
+    from flask import g, request
+    started = g.pop('request_started', None)
+    if started is not None:
+        # Theo url rule thay vì path thật để số endpoint không tăng theo id trong URL
+        endpoint = f"{request.method} {request.url_rule.rule}" if request.url_rule else "unmatched"
+        performance_monitor.record_request_time(endpoint, time.perf_counter() - started, request.blueprint or "app", response.status_code)
+        if response.status_code >= 500:
+            performance_monitor.record_error(endpoint, f"http_{response.status_code}")
+    return response
+
 def get_cache_stats():
     """Get cache performance statistics"""
     return performance_monitor.get_performance_stats()
 
 def clear_performance_data():
     """Clear all performance monitoring data"""
-    performance_monitor.request_times.clear()
-    performance_monitor.api_call_times.clear()
+    performance_monitor.request_latency.clear()
+    performance_monitor.module_latency.clear()
+    performance_monitor.api_call_latency.clear()
+    performance_monitor.api_call_errors.clear()
     performance_monitor.error_counts.clear()
     performance_monitor.cache_hit_rates.clear()
+    performance_monitor.encode_stats.clear()
+    performance_monitor.first_audio_latency.clear()
+    performance_monitor.image_savings.clear()
     performance_monitor.start_time = time.time()
 
 # Background monitoring thread
@@ -0,0 +1,180 @@
+import threading
+import time
+from config import (
+    GEMINI_KEYS_FILE, SUDO_KEYS_FILE, EXPIRED_SUDO_KEYS_FILE,
+    PROVIDER_CREDENTIALS_CACHE_TTL, PROVIDER_CREDENTIALS_AUTO_IMPORT
+)
+from database import db_manager
+from utils.shared_cache import shared_cache
+
+# Key provider (Gemini, Suno, ...) lưu trong bảng provider_credentials thay cho việc đọc/ghi lại file txt.
+# Request chỉ đọc danh sách key active từ shared cache (hết hạn sau PROVIDER_CREDENTIALS_CACHE_TTL giây);
+# đổi state là 1 câu UPDATE có điều kiện nên nhiều worker cùng báo 1 key hết credit cũng không mất key nào.
+
+STATES = ("active", "exhausted", "disabled")
+
+# File txt cũ -> (provider, state) khi import. Sau lần import đầu, file không còn được đọc:
+# key mới/bị thu hồi phải đổi qua import_provider_credentials.py hoặc /admin/api/provider-credentials.
+LEGACY_FILES = {
+    "gemini": ((GEMINI_KEYS_FILE, "active"),),
+    "suno": ((SUDO_KEYS_FILE, "active"), (EXPIRED_SUDO_KEYS_FILE, "exhausted")),
+}
+
+
+def read_secrets_file(path):
+    """Non-empty, non-comment lines of a key file; None if the file is missing"""
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return [line.strip() for line in f if line.strip() and not line.startswith("#")]
+    except FileNotFoundError:
+        return None
+
+
+def mask_secret(secret):
+    return f"{secret[:8]}…{secret[-4:]}" if len(secret) > 16 else f"{secret[:4]}…"
+
+
+class ProviderCredentialStore:
+    def __init__(self, cache_ttl=PROVIDER_CREDENTIALS_CACHE_TTL, auto_import=PROVIDER_CREDENTIALS_AUTO_IMPORT):
+        self.cache_ttl = cache_ttl
+        self.auto_import = auto_import
+        self._checked = set()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _cache_key(provider):
+        return f"provider_credentials:{provider}"
+
+    def invalidate(self, provider):
+        shared_cache.invalidate(self._cache_key(provider))
+
+    def _ensure_imported(self, provider):
+        # Lần đầu dùng provider mà bảng chưa có dòng nào -> import file txt cũ (nâng cấp không cần bước tay)
+        if provider in self._checked:
+            return
+        with self._lock:
+            if provider in self._checked:
+                return
+            if provider in LEGACY_FILES:
+                if self.auto_import and not db_manager.count_provider_credentials(provider):
+                    imported = self.import_legacy_files(provider)
+                    if imported:
+                        print(f"📥 Đã import {imported} key {provider} từ file txt vào provider_credentials")
+                else:
+                    self._warn_if_legacy_files_differ(provider)
+            self._checked.add(provider)
+
+    def _warn_if_legacy_files_differ(self, provider):
+        # File txt bị sửa sau lần import (thêm key, xóa key bị thu hồi) không có tác dụng gì -> báo cho operator
+        stored = {}
+        for credential in db_manager.get_provider_credentials(provider):
+            stored.setdefault(credential["state"], set()).add(credential["secret"])
+        known = set().union(*stored.values()) if stored else set()
+        for path, state in LEGACY_FILES[provider]:
+            secrets = read_secrets_file(path)
+            if secrets is None:
+                continue
+            added = set(secrets) - known
+            removed = stored.get(state, set()) - set(secrets) if state == "active" else set()
+            if added or removed:
+                print(
+                    f"⚠️ {path} khác bảng provider_credentials ({len(added)} key chỉ có trong file, "
+                    f"{len(removed)} key active không còn trong file) nhưng file không còn được đọc: "
+                    f"dùng import_provider_credentials.py để thêm key, /admin/api/provider-credentials để tắt key"
+                )
+
+    def check_legacy_files(self):
+        """Auto-import / compare the legacy txt files of every provider now (app startup)"""
+        for provider in LEGACY_FILES:
+            try:
+                self._ensure_imported(provider)
+            except Exception as e:
+                print(f"⚠️ Không kiểm tra được file key {provider}: {e}")
+
+    def usable(self, provider):
+        """Active credentials of a provider: [{'secret', 'cooldown_until', 'remaining_credits'}]"""
+        self._ensure_imported(provider)
+        return shared_cache.get_or_load(
+            self._cache_key(provider),
+            lambda: db_manager.get_usable_provider_credentials(provider),
+            self.cache_ttl,
+        ) or []
+
+    def secrets(self, provider):
+        """Active secrets, keys not in cooldown first (cooling-down keys stay usable as fallback)"""
+        now = time.time()
+        credentials = self.usable(provider)
+        ready = [c["secret"] for c in credentials if c["cooldown_until"] <= now]
+        cooling = [c["secret"] for c in credentials if c["cooldown_until"] > now]
+        return ready + cooling
+
+    def cool_down(self, provider, secret, seconds, error=None):
+        """Rank an active credential last for `seconds` on every worker"""
+        if db_manager.set_provider_credential_cooldown(provider, secret, time.time() + seconds, error):
+            self.invalidate(provider)
+
+    def mark_exhausted(self, provider, secret, error=None):
+        """active -> exhausted (out of credits); True if this call made the transition"""
+        changed = db_manager.transition_provider_credential(
+            provider, secret, "exhausted", ("active",), last_error=error, remaining_credits=0
+        )
+        if changed:
+            self.invalidate(provider)
+            print(f"🪫 Key {provider} {mask_secret(secret)} hết credit -> exhausted")
+        return changed
+
+    def set_state(self, provider, secret, state, error=None, remaining_credits=None):
+        """Move a credential to `state` from any other state (admin)"""
+        if state not in STATES:
+            raise ValueError(f"state phải là một trong {', '.join(STATES)}")
+        from_states = tuple(s for s in STATES if s != state)
+        changed = db_manager.transition_provider_credential(
+            provider, secret, state, from_states, last_error=error, remaining_credits=remaining_credits
+        )
+        if changed:
+            self.invalidate(provider)
+        return changed
+
+    def set_state_by_id(self, credential_id, state):
+        """set_state for the credential with this id; None if there is no such credential"""
+        for credential in db_manager.get_provider_credentials():
+            if credential["id"] == credential_id:
+                return self.set_state(credential["provider"], credential["secret"], state)
+        return None
+
+    def import_secrets(self, provider, secrets, state="active"):
+        inserted = db_manager.add_provider_credentials(provider, secrets, state)
+        if inserted:
+            self.invalidate(provider)
+        return inserted
+
+    def import_legacy_files(self, provider):
+        """Import the provider's txt files (LEGACY_FILES); returns rows added"""
+        inserted = 0
+        for path, state in LEGACY_FILES.get(provider, ()):
+            secrets = read_secrets_file(path)
+            if secrets:
+                inserted += self.import_secrets(provider, secrets, state)
+        return inserted
+
+    def get_status(self):
+        now = time.time()
+        return {
+            "states": db_manager.get_provider_credential_stats(),
+            "credentials": [
+                {
+                    "id": c["id"],
+                    "provider": c["provider"],
+                    "secret": mask_secret(c["secret"]),
+                    "state": c["state"],
+                    "remaining_credits": c["remaining_credits"],
+                    "last_error": c["last_error"],
+                    "cooldown_seconds": max(0, round(c["cooldown_until"] - now)),
+                    "updated_at": c["updated_at"],
+                }
+                for c in db_manager.get_provider_credentials()
+            ],
+        }
+
+
+provider_credentials = ProviderCredentialStore()
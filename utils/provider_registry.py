@@ -0,0 +1,213 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import threading
+import time
+from config import PROVIDER_WATCH_MODE, PROVIDER_WATCH_POLL_INTERVAL, PROVIDER_SNAPSHOT_TTL
+from utils.shared_cache import shared_cache
+
+# Registry trung tâm cho file cấu hình provider (proxies.txt, ...). Key Gemini/Suno không còn đọc từ file txt
+# mà nằm trong bảng provider_credentials (utils.provider_credentials).
+# Request chỉ đọc snapshot trong RAM (không stat file). Mỗi worker có 1 thread theo dõi file:
+#   inotify - kernel báo ngay khi file được ghi/đổi tên (Linux)
+#   poll    - stat các file mỗi PROVIDER_WATCH_POLL_INTERVAL giây (không có inotify)
+# File đổi -> parse lại rồi thay snapshot một lần (không bao giờ thấy file đọc dở).
+# Worker mới lấy snapshot từ shared cache nếu mtime còn khớp, khỏi đọc lại file.
+
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_FROM = 0x00000040
+_IN_MOVED_TO = 0x00000080
+_IN_DELETE = 0x00000200
+_WATCH_MASK = _IN_CLOSE_WRITE | _IN_MOVED_FROM | _IN_MOVED_TO | _IN_DELETE
+_EVENT_HEADER = struct.Struct("iIII")
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+class _Snapshot:
+    def __init__(self, value, mtime):
+        self.value = value
+        self.mtime = mtime
+        self.loaded_at = time.time()
+
+
+class InotifyWatcher:
+    """Watch the directories of registered files; calls on_change(path)"""
+    mode = "inotify"
+
+    def __init__(self, on_change):
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._fd = libc.inotify_init1(os.O_CLOEXEC | os.O_NONBLOCK)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self._on_change = on_change
+        self._dirs = {}  # wd -> (dir, {basename})
+        self._lock = threading.Lock()
+
+    def add(self, path):
+        directory, name = os.path.split(os.path.abspath(path))
+        with self._lock:
+            for wd, (watched_dir, names) in self._dirs.items():
+                if watched_dir == directory:
+                    names.add(name)
+                    return
+            wd = self._add_watch(self._fd, directory.encode(), _WATCH_MASK)
+            if wd < 0:
+                raise OSError(ctypes.get_errno(), f"inotify_add_watch failed: {directory}")
+            self._dirs[wd] = (directory, {name})
+
+    def run(self):
+        while True:
+            select.select([self._fd], [], [])  # gevent patch select -> không block cả worker
+            try:
+                data = os.read(self._fd, 64 * 1024)
+            except BlockingIOError:
+                continue
+
+            changed = set()
+            offset = 0
+            while offset < len(data):
+                wd, _mask, _cookie, length = _EVENT_HEADER.unpack_from(data, offset)
+                name = data[offset + _EVENT_HEADER.size:offset + _EVENT_HEADER.size + length].rstrip(b"\0").decode(errors="ignore")
+                offset += _EVENT_HEADER.size + length
+                with self._lock:
+                    directory, names = self._dirs.get(wd, (None, ()))
+                if name in names:
+                    changed.add(os.path.join(directory, name))
+            for path in changed:
+                self._on_change(path)
+
+
+class PollWatcher:
+    """Fallback: stat registered files every PROVIDER_WATCH_POLL_INTERVAL seconds"""
+    mode = "poll"
+
+    def __init__(self, on_change):
+        self._on_change = on_change
+        self._mtimes = {}
+
+    def add(self, path):
+        self._mtimes.setdefault(os.path.abspath(path), _mtime(path))
+
+    def run(self):
+        while True:
+            time.sleep(PROVIDER_WATCH_POLL_INTERVAL)
+            for path, old_mtime in list(self._mtimes.items()):
+                mtime = _mtime(path)
+                if mtime != old_mtime:
+                    self._mtimes[path] = mtime
+                    self._on_change(path)
+
+
+class ProviderRegistry:
+    def __init__(self):
+        self._parsers = {}
+        self._snapshots = {}
+        self._lock = threading.Lock()
+        self._watcher = None
+        self._watcher_pid = None
+
+    def get(self, path, parser):
+        """Current parsed content of `path` (parser(path) is run only when the file changes)"""
+        path = os.path.abspath(path)
+        snapshot = self._snapshots.get(path)
+        if snapshot is not None and self._watcher_pid == os.getpid():
+            return snapshot.value
+
+        with self._lock:
+            if path not in self._parsers:
+                self._parsers[path] = parser
+                if self._watcher is not None:
+                    self._watch(path)
+            self._ensure_watcher()
+            snapshot = self._snapshots.get(path)
+            if snapshot is None:
+                snapshot = self._warm_up(path)
+        return snapshot.value
+
+    def _watch(self, path):
+        try:
+            self._watcher.add(path)
+        except OSError as e:
+            print(f"⚠️ Không theo dõi được {path}: {e}")
+
+    def _ensure_watcher(self):
+        # Thread theo dõi tạo sau fork: mỗi worker gunicorn có 1 thread riêng
+        if self._watcher_pid == os.getpid():
+            return
+        watcher = None
+        if PROVIDER_WATCH_MODE != "poll":
+            try:
+                watcher = InotifyWatcher(self._on_change)
+            except (OSError, AttributeError) as e:
+                print(f"⚠️ Không dùng được inotify, chuyển sang polling: {e}")
+        self._watcher = watcher or PollWatcher(self._on_change)
+        self._watcher_pid = os.getpid()
+        for path in self._parsers:
+            self._watch(path)
+        # File có thể đổi trong lúc chưa có watcher (trước fork)
+        for path, snapshot in list(self._snapshots.items()):
+            if snapshot.mtime != _mtime(path):
+                self._snapshots.pop(path, None)
+        threading.Thread(target=self._run_watcher, args=(self._watcher,), name="provider-watch", daemon=True).start()
+
+    def _run_watcher(self, watcher):
+        try:
+            watcher.run()
+        except Exception as e:
+            print(f"❌ Lỗi theo dõi file provider ({watcher.mode}): {e}")
+            self._watcher_pid = None  # request sau sẽ khởi động lại
+
+    def _warm_up(self, path):
+        mtime = _mtime(path)
+        cached = shared_cache.get(f"provider:{path}")
+        if cached is not None and cached["mtime"] == mtime:
+            snapshot = _Snapshot(cached["value"], mtime)
+            self._snapshots[path] = snapshot
+            return snapshot
+        return self._load(path)
+
+    def _load(self, path):
+        mtime = _mtime(path)
+        value = self._parsers[path](path)
+        snapshot = _Snapshot(value, mtime)
+        self._snapshots[path] = snapshot  # thay cả snapshot một lần
+        shared_cache.set(f"provider:{path}", {"mtime": mtime, "value": value}, PROVIDER_SNAPSHOT_TTL)
+        return snapshot
+
+    def _on_change(self, path):
+        try:
+            snapshot = self._load(path)
+            count = len(snapshot.value) if snapshot.value is not None else 0
+            print(f"🔄 Đã nạp lại {os.path.basename(path)} ({count} dòng)")
+        except Exception as e:
+            print(f"⚠️ Lỗi nạp lại {path}, giữ dữ liệu cũ: {e}")
+
+    def reload(self, path):
+        """Re-read a file now (e.g. after the app itself rewrote it)"""
+        path = os.path.abspath(path)
+        if path in self._parsers:
+            self._on_change(path)
+
+    def get_status(self):
+        return {
+            "mode": self._watcher.mode if self._watcher_pid == os.getpid() else None,
+            "files": {
+                path: {
+                    "entries": len(snapshot.value) if snapshot.value is not None else None,
+                    "loaded_at": snapshot.loaded_at,
+                }
+                for path, snapshot in self._snapshots.items()
+            },
+        }
+
+
+provider_registry = ProviderRegistry()
@@ -0,0 +1,192 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from config import SHARED_CACHE_BACKEND, SHARED_CACHE_DIR, SHARED_CACHE_REDIS_URL, SHARED_CACHE_L1_TTL
+from utils.performance_monitor import performance_monitor
+
+# Cache 2 tầng dùng chung giữa các worker gunicorn:
+#   L1 - dict trong process, sống tối đa SHARED_CACHE_L1_TTL giây (invalidate lan sang worker khác trong khoảng này)
+#   L2 - shm:   mỗi key là 1 file JSON trên tmpfs (/dev/shm), còn nguyên khi worker bị recycle
+#        redis: Redis (hoặc server cùng giao thức) cho nhiều node
+#        none:  chỉ dùng L1
+# Value phải serialize được bằng JSON.
+
+
+class ShmCacheStore:
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, hashlib.sha1(key.encode("utf-8")).hexdigest() + ".json")
+
+    def get(self, key):
+        try:
+            with open(self._path(key), "r", encoding="utf-8") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if entry.get("key") != key or entry["expires_at"] <= time.time():
+            return None
+        return entry
+
+    def set(self, key, value, ttl):
+        entry = {"key": key, "value": value, "expires_at": time.time() + ttl}
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(entry, f, ensure_ascii=False)
+        os.replace(tmp_path, path)  # worker khác không bao giờ đọc file ghi dở
+        return entry
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def clear(self):
+        with os.scandir(self.cache_dir) as entries:
+            for entry in entries:
+                if entry.name.endswith((".json", ".tmp")):
+                    try:
+                        os.remove(entry.path)
+                    except OSError:
+                        pass
+
+
+class RedisCacheStore:
+    PREFIX = "cloudapi:cache:"
+
+    def __init__(self, url):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError("❌ SHARED_CACHE_BACKEND=redis cần cài redis (pip install redis)")
+        self.client = redis.Redis.from_url(url)
+
+    def get(self, key):
+        raw = self.client.get(self.PREFIX + key)
+        if raw is None:
+            return None
+        entry = json.loads(raw)
+        return entry if entry["expires_at"] > time.time() else None
+
+    def set(self, key, value, ttl):
+        entry = {"key": key, "value": value, "expires_at": time.time() + ttl}
+        self.client.set(self.PREFIX + key, json.dumps(entry, ensure_ascii=False), ex=max(1, int(ttl)))
+        return entry
+
+    def delete(self, key):
+        self.client.delete(self.PREFIX + key)
+
+    def clear(self):
+        for redis_key in self.client.scan_iter(match=self.PREFIX + "*"):
+            self.client.delete(redis_key)
+
+
+class SharedCache:
+    def __init__(self, store=None, l1_ttl=SHARED_CACHE_L1_TTL):
+        self.store = store
+        self.l1_ttl = l1_ttl
+        self._l1 = {}
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def _count(self, key, field):
+        namespace = key.split(":", 1)[0]
+        with self._lock:
+            stats = self._stats.setdefault(namespace, {"l1_hits": 0, "l2_hits": 0, "misses": 0, "l2_errors": 0, "invalidations": 0})
+            stats[field] += 1
+        if field in ("l1_hits", "l2_hits", "misses"):
+            performance_monitor.record_cache_hit(f"shared:{namespace}", hit=field != "misses")
+
+    def _remember(self, key, entry):
+        # L1 không sống lâu hơn L2
+        expires_at = min(entry["expires_at"], time.time() + self.l1_ttl)
+        self._l1[key] = (entry["value"], expires_at)
+
+    def get(self, key, default=None):
+        cached = self._l1.get(key)
+        if cached and cached[1] > time.time():
+            self._count(key, "l1_hits")
+            return cached[0]
+
+        if self.store is not None:
+            try:
+                entry = self.store.get(key)
+            except Exception as e:
+                self._count(key, "l2_errors")
+                print(f"⚠️ Lỗi đọc shared cache '{key}': {e}")
+                entry = None
+            if entry is not None:
+                self._count(key, "l2_hits")
+                self._remember(key, entry)
+                return entry["value"]
+
+        self._count(key, "misses")
+        return default
+
+    def set(self, key, value, ttl):
+        entry = {"key": key, "value": value, "expires_at": time.time() + ttl}
+        if self.store is not None:
+            try:
+                entry = self.store.set(key, value, ttl)
+            except Exception as e:
+                self._count(key, "l2_errors")
+                print(f"⚠️ Lỗi ghi shared cache '{key}': {e}")
+        self._remember(key, entry)
+
+    def get_or_load(self, key, loader, ttl):
+        """Cached value of `key`, else loader() (not cached when it returns None)"""
+        missing = object()
+        value = self.get(key, missing)
+        if value is not missing:
+            return value
+        value = loader()
+        if value is not None:
+            self.set(key, value, ttl)
+        return value
+
+    def invalidate(self, key):
+        """Drop a key here and in L2; other workers drop their L1 copy within l1_ttl"""
+        self._l1.pop(key, None)
+        if self.store is not None:
+            try:
+                self.store.delete(key)
+            except Exception as e:
+                print(f"⚠️ Lỗi xóa shared cache '{key}': {e}")
+        self._count(key, "invalidations")
+
+    def clear(self):
+        self._l1.clear()
+        if self.store is not None:
+            self.store.clear()
+
+    def get_stats(self):
+        with self._lock:
+            stats = {namespace: dict(values) for namespace, values in self._stats.items()}
+        for values in stats.values():
+            lookups = values["l1_hits"] + values["l2_hits"] + values["misses"]
+            values["hit_rate"] = (values["l1_hits"] + values["l2_hits"]) / lookups * 100 if lookups else 0
+        return {
+            "backend": SHARED_CACHE_BACKEND if self.store is not None else "none",
+            "l1_entries": len(self._l1),
+            "namespaces": stats,
+        }
+
+
+def _create_store():
+    try:
+        if SHARED_CACHE_BACKEND == "redis":
+            return RedisCacheStore(SHARED_CACHE_REDIS_URL)
+        if SHARED_CACHE_BACKEND == "shm":
+            return ShmCacheStore(SHARED_CACHE_DIR)
+    except Exception as e:
+        print(f"⚠️ Không dùng được shared cache '{SHARED_CACHE_BACKEND}', chỉ cache trong process: {e}")
+    return None
+
+
+shared_cache = SharedCache(_create_store())
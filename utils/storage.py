@@ -0,0 +1,172 @@
+import mimetypes
+import os
+import threading
+import time
+from collections import OrderedDict
+from flask import redirect
+from werkzeug.exceptions import NotFound
+from config import (
+    MEDIA_OUTPUT_DIRS, STORAGE_BACKEND, S3_BUCKET, S3_ENDPOINT_URL, S3_REGION,
+    S3_ACCESS_KEY_ID, S3_SECRET_ACCESS_KEY, S3_PREFIX, S3_PRESIGN_TTL, MEDIA_IMMUTABLE_MAX_AGE
+)
+from utils.media_response import send_media, is_content_addressed
+
+# Backend lưu media đã tạo (voice/image):
+#   local - file nằm trong VOICE_OUTPUT_DIR / IMAGE_OUTPUT_DIR (mặc định, 1 node)
+#   s3    - object trên S3/MinIO, play route redirect sang presigned URL (nhiều node sau LB).
+#           Thư mục local vẫn giữ bản copy làm cache (transcode ảnh, serve nhanh trên node tạo ra file);
+#           retention của bucket nên cấu hình bằng lifecycle rule.
+S3_MISSING_CACHE_TTL = 30  # giây nhớ "object chưa có" (derivative ảnh đang transcode)
+S3_EXISTS_CACHE_TTL = 3600  # giây nhớ "object có" (object theo hash không đổi, file cũ có thể bị xóa)
+S3_EXISTS_CACHE_MAX = 10000  # LRU: tên file do client gửi (probe 404) không làm cache lớn mãi
+
+
+class LocalStorage:
+    is_local = True
+
+    def local_path(self, module, rel_path):
+        return os.path.join(MEDIA_OUTPUT_DIRS[module], rel_path)
+
+    def exists(self, module, rel_path):
+        return os.path.exists(self.local_path(module, rel_path))
+
+    def save(self, module, rel_path, src_path):
+        """Nothing to do: store_media already moved the file into the output dir"""
+
+    def delete(self, module, rel_path):
+        try:
+            os.remove(self.local_path(module, rel_path))
+        except FileNotFoundError:
+            pass
+
+    def response(self, module, rel_path, mimetype=None):
+        return send_media(module, rel_path, mimetype=mimetype)
+
+
+class S3Storage:
+    is_local = False
+
+    def __init__(self):
+        try:
+            import boto3
+            from boto3.s3.transfer import TransferConfig
+        except ImportError:
+            raise RuntimeError("❌ STORAGE_BACKEND=s3 cần cài boto3 (pip install boto3)")
+        if not S3_BUCKET:
+            raise RuntimeError("❌ STORAGE_BACKEND=s3 cần cấu hình S3_BUCKET")
+
+        self.client = boto3.client(
+            "s3",
+            endpoint_url=S3_ENDPOINT_URL or None,
+            region_name=S3_REGION or None,
+            aws_access_key_id=S3_ACCESS_KEY_ID or None,
+            aws_secret_access_key=S3_SECRET_ACCESS_KEY or None,
+        )
+        # Multipart upload theo chunk 8MB: không đọc cả file vào RAM
+        self.transfer_config = TransferConfig(multipart_threshold=8 * 1024 * 1024, multipart_chunksize=8 * 1024 * 1024)
+        self._exists_cache = OrderedDict()  # (module, rel_path) -> (exists, checked_at), cũ nhất ở đầu
+        self._exists_lock = threading.Lock()
+
+    def object_key(self, module, rel_path):
+        return f"{S3_PREFIX.strip('/')}/{module}/{rel_path}".lstrip("/")
+
+    def local_path(self, module, rel_path):
+        return os.path.join(MEDIA_OUTPUT_DIRS[module], rel_path)
+
+    def _extra_args(self, rel_path):
+        args = {"ContentType": mimetypes.guess_type(rel_path)[0] or "application/octet-stream"}
+        if is_content_addressed(rel_path):
+            args["CacheControl"] = f"public, max-age={MEDIA_IMMUTABLE_MAX_AGE}, immutable"
+        return args
+
+    def _remember(self, module, rel_path, exists):
+        with self._exists_lock:
+            self._exists_cache[(module, rel_path)] = (exists, time.time())
+            self._exists_cache.move_to_end((module, rel_path))
+            while len(self._exists_cache) > S3_EXISTS_CACHE_MAX:
+                self._exists_cache.popitem(last=False)
+
+    def _cached_exists(self, module, rel_path):
+        with self._exists_lock:
+            cached = self._exists_cache.get((module, rel_path))
+            if cached is None:
+                return None
+            exists, checked_at = cached
+            if time.time() - checked_at >= (S3_EXISTS_CACHE_TTL if exists else S3_MISSING_CACHE_TTL):
+                del self._exists_cache[(module, rel_path)]
+                return None
+            self._exists_cache.move_to_end((module, rel_path))
+            return exists
+
+    def exists(self, module, rel_path):
+        # "có" nhớ lâu (S3_EXISTS_CACHE_TTL), "chưa có" chỉ nhớ ngắn
+        cached = self._cached_exists(module, rel_path)
+        if cached is not None:
+            return cached
+        try:
+            self.client.head_object(Bucket=S3_BUCKET, Key=self.object_key(module, rel_path))
+            exists = True
+        except self.client.exceptions.ClientError as e:
+            if e.response.get("Error", {}).get("Code") not in ("404", "NoSuchKey", "NotFound"):
+                raise
+            exists = False
+        self._remember(module, rel_path, exists)
+        return exists
+
+    def save(self, module, rel_path, src_path):
+        """Stream a local file to the bucket (the local copy stays as a cache)"""
+        self.client.upload_file(
+            src_path, S3_BUCKET, self.object_key(module, rel_path),
+            ExtraArgs=self._extra_args(rel_path), Config=self.transfer_config
+        )
+        self._remember(module, rel_path, True)
+
+    def save_fileobj(self, module, rel_path, fileobj):
+        """Stream any readable file object to the bucket"""
+        self.client.upload_fileobj(
+            fileobj, S3_BUCKET, self.object_key(module, rel_path),
+            ExtraArgs=self._extra_args(rel_path), Config=self.transfer_config
+        )
+        self._remember(module, rel_path, True)
+
+    def delete(self, module, rel_path):
+        self.client.delete_object(Bucket=S3_BUCKET, Key=self.object_key(module, rel_path))
+        self._remember(module, rel_path, False)
+        try:
+            os.remove(self.local_path(module, rel_path))
+        except FileNotFoundError:
+            pass
+
+    def presigned_url(self, module, rel_path, mimetype=None):
+        params = {"Bucket": S3_BUCKET, "Key": self.object_key(module, rel_path)}
+        if mimetype:
+            params["ResponseContentType"] = mimetype
+        return self.client.generate_presigned_url("get_object", Params=params, ExpiresIn=S3_PRESIGN_TTL)
+
+    def response(self, module, rel_path, mimetype=None):
+        # Node còn bản local (vừa tạo file, voice sample) -> serve luôn, khỏi round trip S3
+        if os.path.isfile(self.local_path(module, rel_path)):
+            return send_media(module, rel_path, mimetype=mimetype)
+
+        # Object không có trên bucket -> 404 luôn, không redirect sang presigned URL hỏng
+        if not self.exists(module, rel_path):
+            raise NotFound()
+
+        response = redirect(self.presigned_url(module, rel_path, mimetype), code=302)
+        response.cache_control.private = True
+        response.cache_control.max_age = S3_PRESIGN_TTL // 2  # URL còn hạn khi client dùng lại
+        return response
+
+
+_storage = None
+_storage_lock = threading.Lock()
+
+
+def get_storage():
+    """Storage backend configured by STORAGE_BACKEND (created once per process)"""
+    global _storage
+    if _storage is None:
+        with _storage_lock:
+            if _storage is None:
+                _storage = S3Storage() if STORAGE_BACKEND == "s3" else LocalStorage()
+    return _storage
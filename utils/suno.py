@@ -1,36 +1,10 @@
 import requests
 import random
-from config import SUDO_KEYS_FILE, EXPIRED_SUDO_KEYS_FILE
-
-
-def load_sudo_keys():
-    try:
-        with open(SUDO_KEYS_FILE, "r") as file:
-            return file.read().splitlines()
-    except Exception as e:
-        print(f"Error loading API keys: {e}")
-        return []
-
-
-def update_sudo_keys(api_key_to_remove):
-    try:
-        with open(SUDO_KEYS_FILE, "r") as file:
-            keys = file.readlines()
-
-        # Remove the expired API key from the list
-        with open(SUDO_KEYS_FILE, "w") as file:
-            for key in keys:
-                if api_key_to_remove.strip() != key.strip():
-                    file.write(key)
-
-        print(f"Removed expired key: {api_key_to_remove}")
-
-        # Add the expired key to the expired keys file
-        with open(EXPIRED_SUDO_KEYS_FILE, "a") as expired_file:
-            expired_file.write(f"{api_key_to_remove}\n")
-
-    except Exception as e:
-        print(f"Error updating keys: {e}")
+import time
+from utils.provider_credentials import provider_credentials
+from utils.performance_monitor import performance_monitor
+from utils.metrics import upstream_outcome
+from utils.tracing import tracer, mask_key, mask_proxy
 
 
 def generate_music(prompt_text, title, style, instrumental, api_key_list, proxies=None):
@@ -40,6 +14,7 @@ def generate_music(prompt_text, title, style, instrumental, api_key_list, proxie
     print(f"Proxies: {proxies}")
 
     def task(api_key, proxy_dict):
+        response = None
         try:
             url = "https://api.sunoapi.org/api/v1/generate"
             headers = {
@@ -69,8 +44,8 @@ def generate_music(prompt_text, title, style, instrumental, api_key_list, proxie
             res_json = response.json()
 
             if res_json.get("code") == 429:
-                print(f"Key {api_key[:20]} failed due to insufficient credits. Moving to expired keys.")
-                update_sudo_keys(api_key)
+                print(f"Key {api_key[:20]} failed due to insufficient credits. Marking as exhausted.")
+                provider_credentials.mark_exhausted("suno", api_key, res_json.get("msg") or "Insufficient credits.")
                 return {"success": False, "message": "Insufficient credits."}
 
             task_id = res_json.get("data", {}).get("taskId", None)
@@ -84,8 +59,8 @@ def generate_music(prompt_text, title, style, instrumental, api_key_list, proxie
         except Exception as e:
             print(f"Key {api_key[:20]} error: {e}")
             if response and response.status_code == 429:
-                print(f"Key {api_key[:20]} failed due to insufficient credits. Moving to expired keys.")
-                update_sudo_keys(api_key)
+                print(f"Key {api_key[:20]} failed due to insufficient credits. Marking as exhausted.")
+                provider_credentials.mark_exhausted("suno", api_key, str(e)[:300])
             return {"success": False, "message": f"Error: {str(e)}"}
 
     # Distribute proxy across API keys
@@ -95,7 +70,16 @@ def generate_music(prompt_text, title, style, instrumental, api_key_list, proxie
         print(f"[MUSIC] Trying key {i+1}/{len(api_key_list)}: {api_key[:20]} with proxy: {proxy_str}")
 
         # Call task function and retry with the next API key if this one fails
-        result = task(api_key, proxy_dict)
+        with tracer.span("upstream.suno", **{
+            "upstream.operation": "generate", "upstream.key": mask_key(api_key), "upstream.proxy": mask_proxy(proxy_str)
+        }) as span:
+            started = time.time()
+            result = task(api_key, proxy_dict)
+            performance_monitor.record_api_call_time(
+                "suno:generate", time.time() - started, bool(result.get("success")), api_key, proxy_str
+            )
+            if not result.get("success"):
+                span.record_error(result.get("message") or "Music generation failed.")
         if result.get("success"):
             return result  # Return task_id and the corresponding API key
         else:
@@ -124,7 +108,12 @@ def check_task_status(task_id, api_key, proxies=None):
 
         # Send request to check task status
         params = {"taskId": task_id}
+        started = time.time()
         response = requests.get(status_url, headers=headers, params=params, proxies=selected_proxy, timeout=30)
+        performance_monitor.record_api_call_time(
+            "suno:status", time.time() - started, response.status_code == 200, api_key,
+            (selected_proxy or {}).get("https"), upstream_outcome(status_code=response.status_code)
+        )
 
         # Handle HTTP response
         if response.status_code == 200:
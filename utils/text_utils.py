@@ -0,0 +1,52 @@
+import re
+
+# Kết thúc câu: . ! ? … và dấu câu CJK, hoặc xuống dòng
+_SENTENCE_SPLIT_RE = re.compile(r'(?<=[.!?…。！？])\s+|\n+')
+# Khi một câu vẫn quá dài thì cắt tiếp ở dấu phẩy/chấm phẩy
+_CLAUSE_SPLIT_RE = re.compile(r'(?<=[,;:，；])\s+')
+
+
+def split_sentences(text):
+    """Split text into sentences, keeping the punctuation"""
+    return [s.strip() for s in _SENTENCE_SPLIT_RE.split(text or "") if s.strip()]
+
+
+def _split_long_sentence(sentence, max_chars):
+    """Split a sentence longer than max_chars at clauses, then at whitespace"""
+    pieces = []
+    for clause in _CLAUSE_SPLIT_RE.split(sentence):
+        while len(clause) > max_chars:
+            cut = clause.rfind(" ", 0, max_chars)
+            if cut <= 0:
+                cut = max_chars
+            pieces.append(clause[:cut].strip())
+            clause = clause[cut:].strip()
+        if clause:
+            pieces.append(clause)
+    return pieces
+
+
+def split_text_for_tts(text, max_chars):
+    """Group sentences into chunks of at most max_chars, never cutting mid-sentence unless a sentence alone is too long"""
+    chunks = []
+    current = ""
+    for sentence in split_sentences(text):
+        parts = [sentence] if len(sentence) <= max_chars else _split_long_sentence(sentence, max_chars)
+        for part in parts:
+            if current and len(current) + 1 + len(part) > max_chars:
+                chunks.append(current)
+                current = part
+            else:
+                current = f"{current} {part}" if current else part
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def split_text_for_streaming(text, max_chars):
+    """Like split_text_for_tts, but the first sentence is its own chunk so it can be played first"""
+    sentences = split_sentences(text)
+    if not sentences:
+        return []
+    first = split_text_for_tts(sentences[0], max_chars)
+    return first[:1] + split_text_for_tts(" ".join(first[1:] + sentences[1:]), max_chars)
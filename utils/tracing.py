@@ -0,0 +1,356 @@
+import contextvars
+import json
+import os
+import queue
+import random
+import threading
+import time
+from functools import wraps
+from urllib.parse import urlsplit
+try:
+    import fcntl
+except ImportError:  # Windows (chạy app.py khi dev): bỏ lock giữa các process
+    fcntl = None
+from config import (
+    TRACING_ENABLED, TRACING_SAMPLE_RATE, TRACING_EXPORTER, TRACING_OTLP_ENDPOINT,
+    TRACING_JSONL_PATH, TRACING_JSONL_MAX_BYTES, TRACING_JSONL_BACKUPS,
+    TRACING_SERVICE_NAME, TRACING_QUEUE_SIZE, TRACING_EXPORT_INTERVAL
+)
+
+# Tracing nhẹ, không cần OpenTelemetry SDK: mỗi request được lấy mẫu (TRACING_SAMPLE_RATE) có 1 span gốc,
+# các span con (auth, db.*, upstream.*, audio.encode, file.write, ...) gắn vào span đang chạy qua contextvars.
+# Span kết thúc được đẩy vào hàng đợi, 1 thread nền / worker export theo lô sang:
+#   jsonl - file JSONL xoay vòng (TRACING_JSONL_PATH, .1 ... .N), nhiều worker ghi chung có flock
+#   otlp  - collector OpenTelemetry qua OTLP/HTTP JSON (TRACING_OTLP_ENDPOINT)
+# TRACING_ENABLED=false: traced()/trace_methods()/traced_lock() trả lại nguyên hàm/lock, span() trả NOOP_SPAN.
+
+_current_span = contextvars.ContextVar("cloudapi_current_span", default=None)
+
+
+def mask_key(api_key):
+    """Enough of a provider key to tell keys apart in traces"""
+    return f"{api_key[:8]}…" if api_key else None
+
+
+def mask_proxy(proxy):
+    """host:port of a proxy URL (credentials dropped)"""
+    if not proxy:
+        return None
+    parts = urlsplit(proxy if "://" in proxy else f"http://{proxy}")
+    return f"{parts.hostname}:{parts.port}" if parts.port else parts.hostname
+
+
+class Span:
+    __slots__ = ("name", "trace_id", "span_id", "parent_id", "start_ns", "end_ns", "attributes", "error", "_token")
+
+    def __init__(self, name, trace_id, parent_id, attributes):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = f"{random.getrandbits(64):016x}"
+        self.parent_id = parent_id
+        self.attributes = attributes
+        self.error = None
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self._token = None
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def record_error(self, error):
+        """Mark the span failed with an exception or a message"""
+        self.error = (error if isinstance(error, str) else f"{type(error).__name__}: {error}")[:300]
+        status_code = getattr(error, "status_code", None)
+        if status_code is not None:
+            self.attributes["http.status_code"] = status_code
+
+    def __enter__(self):
+        self._token = _current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.end_ns = time.time_ns()
+        if exc is not None:
+            self.record_error(exc)
+        try:
+            _current_span.reset(self._token)
+        except ValueError:
+            _current_span.set(None)  # kết thúc ở context khác (hook teardown)
+        tracer.export(self)
+        return False
+
+
+class _NoopSpan:
+    def set_attribute(self, key, value):
+        pass
+
+    def record_error(self, error):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+class JsonlExporter:
+    def __init__(self, path, max_bytes, backups):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    def _rotate(self):
+        for index in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{index}"):
+                os.replace(f"{self.path}.{index}", f"{self.path}.{index + 1}")
+        os.replace(self.path, f"{self.path}.1")
+
+    def export(self, spans):
+        lines = "".join(json.dumps({
+            "trace_id": span.trace_id,
+            "span_id": span.span_id,
+            "parent_id": span.parent_id,
+            "name": span.name,
+            "start": span.start_ns / 1e9,
+            "duration_ms": round((span.end_ns - span.start_ns) / 1e6, 3),
+            "attributes": span.attributes,
+            "error": span.error,
+            "pid": os.getpid(),
+        }, ensure_ascii=False, default=str) + "\n" for span in spans)
+
+        # Lock file dùng chung: worker khác không ghi vào file đang bị xoay vòng
+        with open(f"{self.path}.lock", "w") as lock_file:
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                if os.path.exists(self.path) and os.path.getsize(self.path) >= self.max_bytes:
+                    self._rotate()
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write(lines)
+            finally:
+                if fcntl:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+class OtlpHttpExporter:
+    def __init__(self, endpoint, service_name):
+        import requests
+        self.endpoint = endpoint
+        self.session = requests.Session()
+        self.resource = {"attributes": [
+            {"key": "service.name", "value": {"stringValue": service_name}},
+            {"key": "process.pid", "value": {"intValue": str(os.getpid())}},
+        ]}
+
+    @staticmethod
+    def _value(value):
+        if isinstance(value, bool):
+            return {"boolValue": value}
+        if isinstance(value, int):
+            return {"intValue": str(value)}
+        if isinstance(value, float):
+            return {"doubleValue": value}
+        return {"stringValue": str(value)}
+
+    def _span(self, span):
+        otlp_span = {
+            "traceId": span.trace_id,
+            "spanId": span.span_id,
+            "name": span.name,
+            "kind": 2 if span.parent_id is None else 1,  # SERVER cho span gốc, INTERNAL cho span con
+            "startTimeUnixNano": str(span.start_ns),
+            "endTimeUnixNano": str(span.end_ns),
+            "attributes": [{"key": key, "value": self._value(value)} for key, value in span.attributes.items() if value is not None],
+            "status": {"code": 2, "message": span.error} if span.error else {"code": 0},
+        }
+        if span.parent_id:
+            otlp_span["parentSpanId"] = span.parent_id
+        return otlp_span
+
+    def export(self, spans):
+        payload = {"resourceSpans": [{
+            "resource": self.resource,
+            "scopeSpans": [{"scope": {"name": "cloudapi"}, "spans": [self._span(span) for span in spans]}],
+        }]}
+        response = self.session.post(self.endpoint, json=payload, timeout=5)
+        if response.status_code >= 300:
+            raise Exception(f"OTLP collector trả về {response.status_code}: {response.text[:200]}")
+
+
+class Tracer:
+    def __init__(self, enabled=TRACING_ENABLED, sample_rate=TRACING_SAMPLE_RATE):
+        self.enabled = enabled
+        self.sample_rate = sample_rate
+        self._queue = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._stats = {"traces": 0, "spans": 0, "dropped": 0, "export_errors": 0}
+
+    def start_trace(self, name, **attributes):
+        """Root span of a new trace, or NOOP_SPAN when this trace is not sampled"""
+        if not self.enabled or random.random() >= self.sample_rate:
+            return NOOP_SPAN
+        self._stats["traces"] += 1
+        return Span(name, f"{random.getrandbits(128):032x}", None, attributes)
+
+    def span(self, name, **attributes):
+        """Child of the current span; NOOP_SPAN outside a sampled trace"""
+        if not self.enabled:
+            return NOOP_SPAN
+        parent = _current_span.get()
+        if parent is None:
+            return NOOP_SPAN
+        return Span(name, parent.trace_id, parent.span_id, attributes)
+
+    def current_span(self):
+        return (_current_span.get() if self.enabled else None) or NOOP_SPAN
+
+    def _ensure_exporter(self):
+        # Thread export tạo sau fork (mỗi worker 1 thread)
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            if TRACING_EXPORTER == "otlp":
+                exporter = OtlpHttpExporter(TRACING_OTLP_ENDPOINT, TRACING_SERVICE_NAME)
+            else:
+                exporter = JsonlExporter(TRACING_JSONL_PATH, TRACING_JSONL_MAX_BYTES, TRACING_JSONL_BACKUPS)
+            self._queue = queue.Queue(maxsize=TRACING_QUEUE_SIZE)
+            threading.Thread(target=self._export_loop, args=(self._queue, exporter), name="trace-export", daemon=True).start()
+            self._pid = os.getpid()
+
+    def export(self, span):
+        self._ensure_exporter()
+        try:
+            self._queue.put_nowait(span)
+            self._stats["spans"] += 1
+        except queue.Full:
+            self._stats["dropped"] += 1
+
+    def _export_loop(self, span_queue, exporter):
+        while True:
+            batch = [span_queue.get()]
+            deadline = time.monotonic() + TRACING_EXPORT_INTERVAL
+            while len(batch) < 512:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(span_queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            try:
+                exporter.export(batch)
+            except Exception as e:
+                self._stats["export_errors"] += 1
+                self._stats["dropped"] += len(batch)
+                print(f"⚠️ Lỗi export trace ({TRACING_EXPORTER}): {e}")
+
+    def get_stats(self):
+        return dict(self._stats, enabled=self.enabled, sample_rate=self.sample_rate, exporter=TRACING_EXPORTER,
+                    queued=self._queue.qsize() if self._queue is not None and self._pid == os.getpid() else 0)
+
+
+tracer = Tracer()
+
+
+def traced(name):
+    """Run the function in a child span (no wrapper at all when tracing is disabled)"""
+    def decorator(func):
+        if not TRACING_ENABLED:
+            return func
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if _current_span.get() is None:
+                return func(*args, **kwargs)
+            with tracer.span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def trace_methods(prefix, exclude=()):
+    """Class decorator: traced(f"{prefix}.{method}") on every public method"""
+    def decorator(cls):
+        if TRACING_ENABLED:
+            for name, member in list(vars(cls).items()):
+                if callable(member) and not name.startswith("_") and name not in exclude:
+                    setattr(cls, name, traced(f"{prefix}.{name}")(member))
+        return cls
+    return decorator
+
+
+class _TracedLock:
+    def __init__(self, lock, attribute):
+        self._lock = lock
+        self._attribute = attribute
+
+    def __enter__(self):
+        span = _current_span.get()
+        if span is None:
+            return self._lock.__enter__()
+        started = time.perf_counter()
+        result = self._lock.__enter__()
+        span.set_attribute(self._attribute, round((time.perf_counter() - started) * 1000, 3))
+        return result
+
+    def __exit__(self, exc_type, exc, tb):
+        return self._lock.__exit__(exc_type, exc, tb)
+
+
+def traced_lock(lock, attribute="db.lock_wait_ms"):
+    """Lock that records its wait time on the current span"""
+    return _TracedLock(lock, attribute) if TRACING_ENABLED else lock
+
+
+def propagate(func):
+    """Keep the current span as parent when func runs on another thread (executor)"""
+    if not TRACING_ENABLED:
+        return func
+    parent = _current_span.get()
+    if parent is None:
+        return func
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        token = _current_span.set(parent)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _current_span.reset(token)
+    return wrapper
+
+
+def start_request_trace():
+    """before_request hook: root span of the request"""
+    from flask import g, request
+    span = tracer.start_trace(
+        f"{request.method} {request.url_rule.rule if request.url_rule else request.path}",
+        **{"http.method": request.method, "http.target": request.path}
+    )
+    if span is not NOOP_SPAN:
+        g.trace_span = span.__enter__()
+
+
+def record_request_status(response):
+    """after_request hook"""
+    from flask import g
+    span = g.get("trace_span")
+    if span is not None:
+        span.set_attribute("http.status_code", response.status_code)
+    return response
+
+
+def end_request_trace(error=None):
+    """teardown_request hook"""
+    from flask import g
+    span = g.pop("trace_span", None)
+    if span is not None:
+        span.__exit__(type(error) if error else None, error, None)
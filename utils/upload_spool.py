@@ -0,0 +1,94 @@
+import hashlib
+import os
+import uuid
+import ffmpeg
+from config import UPLOAD_SPOOL_DIR, UPLOAD_CHUNK_SIZE
+from utils.file_utils import ensure_dir
+from utils.tracing import traced
+
+# File upload được ghi thẳng xuống tmpfs (/dev/shm) theo từng chunk, hash trong lúc ghi.
+# Tên file luôn do server sinh ra, không dùng filename của client.
+CLONE_VOICE_UPLOAD_EXTS = ("mp3", "wav")
+
+
+class SpooledUpload:
+    def __init__(self, path, sha256, size):
+        self.path = path
+        self.sha256 = sha256
+        self.size = size
+
+
+def _upload_ext(filename, allowed_exts):
+    ext = os.path.splitext(filename or "")[1].lstrip(".").lower()
+    if ext not in allowed_exts:
+        raise ValueError(f"❌ File không hợp lệ. Chỉ hỗ trợ {' hoặc '.join(allowed_exts)}.")
+    return ext
+
+
+def _spool_path(ext):
+    ensure_dir(UPLOAD_SPOOL_DIR)
+    return os.path.join(UPLOAD_SPOOL_DIR, f"{uuid.uuid4().hex}.{ext}")
+
+
+def _copy_stream(stream, write):
+    """Pipe an upload stream chunk by chunk into `write`; returns (sha256, size)"""
+    digest = hashlib.sha256()
+    size = 0
+    for chunk in iter(lambda: stream.read(UPLOAD_CHUNK_SIZE), b""):
+        digest.update(chunk)
+        size += len(chunk)
+        write(chunk)
+    return digest.hexdigest(), size
+
+
+@traced("file.spool_upload")
+def spool_audio_upload(file_storage):
+    """Stream a clone-voice sample to tmpfs as WAV.
+
+    MP3 uploads are piped through ffmpeg while they are read, so neither the
+    MP3 nor the decoded audio is ever held in memory. The hash is of the
+    original upload bytes.
+    """
+    ext = _upload_ext(file_storage.filename, CLONE_VOICE_UPLOAD_EXTS)
+    wav_path = _spool_path("wav")
+
+    try:
+        if ext == "wav":
+            with open(wav_path, "wb") as f:
+                sha256, size = _copy_stream(file_storage.stream, f.write)
+        else:
+            process = (
+                ffmpeg.input("pipe:", format="mp3")
+                .output(wav_path, format="wav", loglevel="error")
+                .overwrite_output()
+                .run_async(pipe_stdin=True, pipe_stderr=True)
+            )
+            try:
+                sha256, size = _copy_stream(file_storage.stream, process.stdin.write)
+            finally:
+                process.stdin.close()
+                stderr = process.stderr.read()
+                process.stderr.close()
+                returncode = process.wait()
+            if returncode != 0:
+                raise ValueError(f"❌ Lỗi khi convert MP3 sang WAV: {stderr.decode(errors='ignore').strip()}")
+    except BrokenPipeError:
+        discard_upload(wav_path)
+        raise ValueError("❌ Lỗi khi convert MP3 sang WAV: file audio không hợp lệ")
+    except Exception:
+        discard_upload(wav_path)
+        raise
+    finally:
+        file_storage.close()
+
+    if size == 0:
+        discard_upload(wav_path)
+        raise ValueError("❌ File audio rỗng")
+    return SpooledUpload(wav_path, sha256, size)
+
+
+def discard_upload(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass